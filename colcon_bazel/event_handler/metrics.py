@@ -0,0 +1,48 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+from colcon_bazel.task.bazel.metrics import get_metrics_recorder
+from colcon_core.event.job import JobEnded
+from colcon_core.event.job import JobStarted
+from colcon_core.event_handler import EventHandlerExtensionPoint
+from colcon_core.event_reactor import EventReactorShutdown
+from colcon_core.plugin_system import satisfies_version
+
+
+class BazelMetricsEventHandler(EventHandlerExtensionPoint):
+    """
+    Export the metrics of the Bazel tasks at the end of the invocation.
+
+    The duration of each job is recorded as the `total` phase.
+    The metrics are only recorded if the environment variable
+    `BAZEL_METRICS_FILE` sets the file to export them to.
+
+    The extension handles events of the following types:
+    - :py:class:`colcon_core.event.job.JobStarted`
+    - :py:class:`colcon_core.event.job.JobEnded`
+    - :py:class:`colcon_core.event_reactor.EventReactorShutdown`
+    """
+
+    def __init__(self):  # noqa: D107
+        super().__init__()
+        satisfies_version(
+            EventHandlerExtensionPoint.EXTENSION_POINT_VERSION, '^1.0')
+        self._jobs = {}
+
+    def __call__(self, event):  # noqa: D102
+        data = event[0]
+        recorder = get_metrics_recorder()
+        if not recorder.enabled:
+            return
+
+        if isinstance(data, JobStarted):
+            measurement = recorder.measure(data.identifier, 'job', 'total')
+            self._jobs[data.identifier] = measurement.__enter__()
+
+        elif isinstance(data, JobEnded):
+            measurement = self._jobs.pop(data.identifier, None)
+            if measurement is not None:
+                measurement.__exit__(None, None, None)
+
+        elif isinstance(data, EventReactorShutdown):
+            recorder.export()
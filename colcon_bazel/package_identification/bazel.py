@@ -1,10 +1,20 @@
 # Copyright 2018 Mickael Gaillard
 # Licensed under the Apache License, Version 2.0
 
+import ast
+from collections import defaultdict
+from functools import partial
 import os
 from pathlib import Path
 import re
 
+from colcon_bazel.package_identification.starlark import \
+    evaluate_build_file
+from colcon_bazel.package_identification.starlark import resolve_label
+from colcon_bazel.package_identification.starlark import UNKNOWN
+from colcon_bazel.task.bazel.metrics import get_metrics_recorder
+from colcon_bazel.task.bazel.output_base import find_workspace_root
+from colcon_bazel.task.bazel.workspace import WORKSPACE_ROOT_METADATA
 from colcon_core.package_identification import logger
 from colcon_core.package_identification \
     import PackageIdentificationExtensionPoint
@@ -21,6 +31,19 @@ from pyparsing import pyparsing_common
 from pyparsing import QuotedString
 from pyparsing import Word
 
+# Files defining a Bazel package, the first one takes precedence
+BUILD_FILENAMES = ('BUILD.bazel', 'BUILD')
+
+# Files of a workspace affecting the build of all of its packages, e.g. the
+# external dependencies, the flags and the Bazel version
+WORKSPACE_SOURCE_FILENAMES = (
+    '.bazelignore', '.bazelrc', '.bazelversion', 'MODULE.bazel',
+    'MODULE.bazel.lock', 'REPO.bazel', 'WORKSPACE', 'WORKSPACE.bazel',
+    'WORKSPACE.bzlmod', 'user.bazelrc')
+
+# Labels within the main repository, e.g. `"//a/b:c"` or `"@//a/b:c"`
+ABSOLUTE_LABEL_PATTERN = r'["\'](@{0,2}//[^"\'\s]*)["\']'
+
 
 class BazelPackageIdentification(PackageIdentificationExtensionPoint):
     """Identify Bazel packages with `BUILD` files."""
@@ -41,6 +64,15 @@ class BazelPackageIdentification(PackageIdentificationExtensionPoint):
         if desc.type is not None and desc.type != 'bazel':
             return
 
+        with get_metrics_recorder().measure(
+            None, 'identify', 'identify'
+        ) as measurement:
+            self._identify(desc)
+            if desc.type == 'bazel':
+                measurement.package = desc.name
+
+    def _identify(self, desc):
+
         build_file = desc.path / 'BUILD.bazel'
         if not build_file.is_file():
             # Dangerous, but valid for Bazel !
@@ -48,47 +80,236 @@ class BazelPackageIdentification(PackageIdentificationExtensionPoint):
             if not build_file.is_file():
                 return
 
-        data = extract_data(build_file)
-        if not data['name']:
+        name = extract_name(build_file)
+        if not name:
             msg = ("Failed to extract project name from '%s'" % build_file)
             logger.error(msg)
             raise RuntimeError(msg)
 
-        if desc.name is not None and desc.name != data['name']:
+        if desc.name is not None and desc.name != name:
             msg = 'Package name already set to different value'
             logger.error(msg)
             raise RuntimeError(msg)
 
         desc.type = 'bazel'
         if desc.name is None:
-            desc.name = data['name']
-        desc.dependencies['build'] |= data['depends']['build']
-        desc.dependencies['run'] |= data['depends']['run']
-        desc.dependencies['test'] |= data['depends']['test']
+            desc.name = name
 
+        # crawling and parsing all BUILD files is deferred until the
+        # dependencies are needed
+        def resolve(dependencies):
+            with get_metrics_recorder().measure(
+                name, 'identify', 'dependencies'
+            ):
+                depends = extract_depends(build_file, name)
+            dependencies['build'] |= depends['build']
+            dependencies['run'] |= depends['run']
+            dependencies['test'] |= depends['test']
 
-def extract_data(build_file):
+        desc.dependencies = LazyDependencies(resolve, desc.dependencies)
+
+        # packages of the same workspace can be grouped by the tasks
+        workspace_root = find_workspace_root(desc.path)
+        if workspace_root is not None:
+            desc.metadata[WORKSPACE_ROOT_METADATA] = workspace_root
+
+        # evaluating the globs is deferred as well
+        desc.metadata['get_bazel_sources'] = partial(
+            extract_sources, desc.path)
+
+
+class LazyDependencies(defaultdict):
     """
-    Extract the project name and dependencies from a BUILD file.
+    Dependencies of a package descriptor which are resolved on first access.
 
-    :param Path build_file: The path of the BUILD file
-    :rtype: dict
+    This behaves like the `defaultdict(set)` of a
+    :py:class:`colcon_core.package_descriptor.PackageDescriptor`.
     """
-    content = extract_content(build_file)
 
-    data = {}
-    data['name'] = extract_project_name(content)
+    def __init__(self, resolver, dependencies=None):
+        """
+        Construct the lazy dependencies.
+
+        :param resolver: The callable which adds the dependencies to the
+          mapping passed as its only argument
+        :param dependencies: The already known dependencies
+        """
+        super().__init__(set)
+        for key, value in (dependencies or {}).items():
+            super().__setitem__(key, set(value))
+        self._resolver = resolver
+
+    @property
+    def resolved(self):
+        """Check if the dependencies have been resolved."""
+        return self._resolver is None
+
+    def resolve(self):
+        """Resolve the dependencies if that hasn't happened yet."""
+        resolver, self._resolver = self._resolver, None
+        if resolver is not None:
+            resolver(self)
+
+    def __getitem__(self, key):  # noqa: D105
+        self.resolve()
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):  # noqa: D105
+        self.resolve()
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):  # noqa: D105
+        self.resolve()
+        super().__delitem__(key)
+
+    def __contains__(self, key):  # noqa: D105
+        self.resolve()
+        return super().__contains__(key)
+
+    def __iter__(self):  # noqa: D105
+        self.resolve()
+        return super().__iter__()
+
+    def __len__(self):  # noqa: D105
+        self.resolve()
+        return super().__len__()
+
+    def __eq__(self, other):  # noqa: D105
+        self.resolve()
+        return super().__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self):  # noqa: D105
+        self.resolve()
+        return repr(defaultdict(set, self))
+
+    def __copy__(self):  # noqa: D105
+        return self.copy()
+
+    def __reduce__(self):  # noqa: D105
+        self.resolve()
+        return (defaultdict, (set, ), None, None, iter(super().items()))
+
+    def copy(self):  # noqa: D102
+        self.resolve()
+        return defaultdict(set, super().items())
+
+    def get(self, key, default=None):  # noqa: D102
+        self.resolve()
+        return super().get(key, default)
+
+    def items(self):  # noqa: D102
+        self.resolve()
+        return super().items()
+
+    def keys(self):  # noqa: D102
+        self.resolve()
+        return super().keys()
+
+    def values(self):  # noqa: D102
+        self.resolve()
+        return super().values()
+
+    def pop(self, *args):  # noqa: D102
+        self.resolve()
+        return super().pop(*args)
+
+    def setdefault(self, *args):  # noqa: D102
+        self.resolve()
+        return super().setdefault(*args)
+
+    def update(self, *args, **kwargs):  # noqa: D102
+        self.resolve()
+        super().update(*args, **kwargs)
+
+
+def extract_name(build_file):
+    """
+    Extract the project name from the top-level BUILD file.
+
+    Only the given file is read, the BUILD files in sub-directories aren't.
+    The loaded .bzl files are only evaluated if the name of the first rule
+    may be a loaded constant.
+
+    :param Path build_file: The path of the BUILD file
+    :returns: The project name, the directory name as a fall back
+    :rtype: str
+    """
+    name = None
+    try:
+        module = evaluate_build_file(build_file, follow_loads=False)
+        rules = module.rules
+        first = next((
+            attributes['name'] for _, attributes in rules
+            if 'name' in attributes), None)
+        if first is UNKNOWN and module.aliases:
+            rules = evaluate_build_file(build_file).rules
+    except SyntaxError:
+        rules = []
+    for _, attributes in rules:
+        if isinstance(attributes.get('name'), str):
+            name = attributes['name']
+            break
+    if name is None:
+        name = extract_project_name(extract_content(build_file))
     # fall back to use the directory name
-    if data['name'] is None:
-        data['name'] = build_file.parent.name
+    if name is None:
+        name = build_file.parent.name
+    return name
+
+
+def extract_depends(build_file, name):
+    """
+    Extract the dependencies from all BUILD files of the project.
+
+    The BUILD files are evaluated as Starlark, files which aren't valid
+    Starlark are parsed with the grammar of :func:`parse_config` instead.
+
+    :param Path build_file: The path of the top-level BUILD file
+    :param str name: The project name to exclude self references
+    :returns: The dependencies by category
+    :rtype: dict
+    """
+    workspace_root = find_workspace_root(build_file.parent) or \
+        build_file.parent
 
     # extract dependencies from all Bazel files in the project directory
-    depends_content = content + extract_content(
-        build_file.parent, exclude=[build_file])
+    rules = []
+    for path in [build_file] + _get_nested_build_files(build_file.parent):
+        try:
+            rules += evaluate_build_file(
+                path, workspace_root=workspace_root).rules
+        except SyntaxError:
+            config = parse_config(extract_content(path))
+            rules += list(config.items())
+    return extract_dependencies(rules, exclude=name)
+
+
+def _get_nested_build_files(path):
+    build_files = []
+    for dirpath, dirnames, filenames in os.walk(str(path)):
+        # skip sub-directories starting with a dot
+        dirnames[:] = sorted(
+            filter(lambda d: not d.startswith('.'), dirnames))
+        if dirpath == str(path):
+            continue
+        build_file = _get_build_file(Path(dirpath), filenames)
+        if build_file is not None:
+            build_files.append(build_file)
+    return build_files
 
-    config = parse_config(depends_content)
-    data['depends'] = extract_dependencies(config, exclude=data['name'])
 
+def extract_data(build_file):
+    """
+    Extract the project name and dependencies from a BUILD file.
+
+    :param Path build_file: The path of the BUILD file
+    :rtype: dict
+    """
+    data = {}
+    data['name'] = extract_name(build_file)
+    data['depends'] = extract_depends(build_file, data['name'])
     return data
 
 
@@ -129,6 +350,215 @@ def _remove_bazel_comments(content):
     return result
 
 
+def extract_sources(path, dependencies=()):
+    """
+    Get the source files of all Bazel packages within a project.
+
+    The sources are the BUILD and `.bzl` files, the files matched by the
+    `glob()` calls and the files referenced by relative labels.
+    The workspace files like `MODULE.bazel` and `.bazelrc` of the project
+    directory and of the enclosing workspace root are sources as well.
+    Globs are evaluated like Bazel does, they don't descend into nested
+    Bazel packages which contribute their own sources instead.
+
+    Absolute labels, including the ones of `load()` statements, are resolved
+    within the workspace and the referenced files are sources as well,
+    loaded `.bzl` files outside of the project are searched for labels too.
+    Labels of external repositories are covered by the workspace files.
+
+    :param Path path: The project directory
+    :param dependencies: The names of the packages whose changes are
+      detected otherwise, labels of their targets don't need to be resolved
+    :returns: The absolute paths of the existing source files, None if a
+      label outside of the project can't be resolved to a file and doesn't
+      refer to one of the dependencies
+    :rtype: list
+    """
+    sources = set()
+    project = Path(path).resolve()
+    directories = [Path(path)]
+    workspace_root = find_workspace_root(path)
+    if workspace_root is not None and workspace_root != project:
+        directories.append(workspace_root)
+    for directory in directories:
+        sources.update(
+            directory / name for name in WORKSPACE_SOURCE_FILENAMES
+            if (directory / name).is_file())
+
+    contents = []
+    for dirpath, dirnames, filenames in os.walk(str(path)):
+        # skip sub-directories starting with a dot
+        dirnames[:] = filter(lambda d: not d.startswith('.'), dirnames)
+        directory = Path(dirpath)
+        for name in filenames:
+            if name.endswith('.bzl'):
+                sources.add(directory / name)
+                contents.append(_remove_bazel_comments(
+                    (directory / name).read_text(errors='replace')))
+
+        build_file = _get_build_file(directory, filenames)
+        if build_file is None:
+            continue
+        sources.add(build_file)
+        content = _remove_bazel_comments(
+            build_file.read_text(errors='replace'))
+        contents.append(content)
+        for include, exclude in extract_globs(content):
+            sources.update(evaluate_glob(directory, include, exclude))
+        # labels of files in the same package, e.g. `"main.cc"`
+        labels = re.findall(r'["\']:?([^"\':@/\s][^"\':\s]*)["\']', content)
+        for label in labels:
+            candidate = directory / label
+            if '..' not in candidate.parts[len(directory.parts):] and \
+                    candidate.is_file():
+                sources.add(candidate)
+
+    # labels of files and targets outside of the project
+    root = workspace_root or project
+    while contents:
+        content = contents.pop()
+        for label in re.findall(ABSOLUTE_LABEL_PATTERN, content):
+            if label.startswith(('//visibility:', '//conditions:')):
+                continue
+            candidate = resolve_label(label, project, root)
+            if candidate is None:
+                # external repositories are pinned by the workspace files
+                continue
+            if project in candidate.parents or candidate == project:
+                continue
+            if candidate.is_file():
+                if candidate not in sources:
+                    sources.add(candidate)
+                    if candidate.name.endswith('.bzl'):
+                        contents.append(_remove_bazel_comments(
+                            candidate.read_text(errors='replace')))
+                continue
+            if candidate.name not in dependencies:
+                logger.debug(
+                    "Can't determine the sources of '{label}' referenced by "
+                    "'{path}'".format_map(locals()))
+                return None
+    return sorted(sources)
+
+
+def extract_globs(content):
+    """
+    Extract the arguments of the `glob()` calls in a BUILD file.
+
+    Calls whose patterns aren't string literals are ignored.
+
+    :param str content: The Bazel BUILD file content.
+    :returns: The include and exclude patterns of each call
+    :rtype: list
+    """
+    globs = []
+    for call in _find_calls(content, 'glob'):
+        try:
+            node = ast.parse(call.strip(), mode='eval').body
+        except SyntaxError:
+            logger.warning("Failed to parse '{call}'".format_map(locals()))
+            continue
+        arguments = {
+            keyword.arg: keyword.value for keyword in node.keywords}
+        if node.args:
+            arguments.setdefault('include', node.args[0])
+        if len(node.args) > 1:
+            arguments.setdefault('exclude', node.args[1])
+        try:
+            include = ast.literal_eval(arguments['include'])
+            exclude = ast.literal_eval(arguments['exclude']) \
+                if 'exclude' in arguments else []
+        except (KeyError, ValueError):
+            continue
+        globs.append((list(include), list(exclude)))
+    return globs
+
+
+def evaluate_glob(directory, include, exclude=None):
+    """
+    Evaluate glob patterns like Bazel does.
+
+    `*` matches within a path segment and `**` matches any number of
+    segments.
+    Directories containing a BUILD file are nested packages and aren't
+    descended into.
+
+    :param Path directory: The directory of the Bazel package
+    :param list include: The patterns of the files to match
+    :param list exclude: The patterns of the files to skip
+    :returns: The matched files
+    :rtype: list
+    """
+    include = [_glob_to_regex(pattern) for pattern in include]
+    exclude = [_glob_to_regex(pattern) for pattern in exclude or []]
+    if not include:
+        return []
+
+    matches = []
+    for dirpath, dirnames, filenames in os.walk(str(directory)):
+        dirnames[:] = [
+            d for d in dirnames if not d.startswith('.') and
+            _get_build_file(Path(dirpath) / d) is None]
+        for name in filenames:
+            path = Path(dirpath) / name
+            relative = path.relative_to(directory).as_posix()
+            if any(regex.match(relative) for regex in include) and \
+                    not any(regex.match(relative) for regex in exclude):
+                matches.append(path)
+    return sorted(matches)
+
+
+def _glob_to_regex(pattern):
+    segments = pattern.split('/')
+    regex = ''
+    for i, segment in enumerate(segments):
+        last = i == len(segments) - 1
+        if segment == '**':
+            regex += '(?:[^/]+/)*[^/]+' if last else '(?:[^/]+/)*'
+            continue
+        regex += re.escape(segment).replace('\\*', '[^/]*')
+        if not last:
+            regex += '/'
+    return re.compile(regex + '$')
+
+
+def _get_build_file(directory, filenames=None):
+    for name in BUILD_FILENAMES:
+        if filenames is not None:
+            if name in filenames:
+                return directory / name
+        elif (directory / name).is_file():
+            return directory / name
+    return None
+
+
+def _find_calls(content, function_name):
+    # yield the source of each call including the balanced parentheses
+    for match in re.finditer(
+        r'\b' + re.escape(function_name) + r'\s*\(', content
+    ):
+        depth = 0
+        quote = None
+        i = match.end() - 1
+        while i < len(content):
+            c = content[i]
+            if quote:
+                if c == '\\':
+                    i += 1
+                elif c == quote:
+                    quote = None
+            elif c in '"\'':
+                quote = c
+            elif c in '([{':
+                depth += 1
+            elif c in ')]}':
+                depth -= 1
+                if not depth:
+                    yield function_name + content[match.end() - 1:i + 1]
+                    break
+            i += 1
+
+
 def extract_project_name(content):
     """
     Extract the Bazel project name from the BUILD file.
@@ -163,14 +593,17 @@ def extract_dependencies(depends_content, exclude=None):
     """
     Extract the Bazel project name from the BUILD file.
 
-    :param set depends_content: The Bazel BUILD files merged content.
+    :param depends_content: The attributes of the rules by kind, either as
+      a dict or a list of pairs.
     :param str exclude: exclude self references.
     :returns: List of dependencies, otherwise None.
     :rtype: set
     """
     depends = {'build': set(), 'run': set(), 'test': set()}
 
-    for key, value in depends_content.items() or []:
+    if isinstance(depends_content, dict):
+        depends_content = depends_content.items()
+    for key, value in depends_content or []:
         if 'binary' in key:
             _extra_deps(value, 'deps', depends['build'], exclude)
             _extra_deps(value, 'runtime_deps', depends['run'], exclude)
@@ -222,7 +655,7 @@ def parse_config(content):
 
 
 def _extra_deps(value, entry, depends_target, exclude=None):
-    if entry in value:
+    if isinstance(value.get(entry), (list, tuple)):
         pattern = Group(
             Optional(Group(
                 Literal('@') +
@@ -235,6 +668,8 @@ def _extra_deps(value, entry, depends_target, exclude=None):
         )
 
         for dep in value.get(entry):
+            if not isinstance(dep, str):
+                continue
             try:
                 extract_name = pattern.parseString(dep)[0][0]
                 if extract_name != exclude:  # exclude self references
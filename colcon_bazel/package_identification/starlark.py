@@ -0,0 +1,334 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+import ast
+import os
+from pathlib import Path
+
+from colcon_bazel.task.bazel.output_base import find_workspace_root
+from colcon_core.environment_variable import EnvironmentVariable
+from colcon_core.package_identification import logger
+
+"""Environment variable to map macros to the rule kinds they create"""
+BAZEL_MACRO_KINDS_ENVIRONMENT_VARIABLE = EnvironmentVariable(
+    'BAZEL_MACRO_KINDS',
+    'Comma separated mapping of Bazel macros to the kinds of rules they '
+    'create, e.g. my_library=cc_library,my_test=cc_test')
+
+
+class _Unknown:
+    """A value which can't be determined without executing Starlark."""
+
+    def __repr__(self):  # noqa: D105
+        return 'UNKNOWN'
+
+
+UNKNOWN = _Unknown()
+
+# The evaluated .bzl files by path
+_modules = {}
+
+
+class Module:
+    """The statically known symbols of a BUILD or .bzl file."""
+
+    def __init__(self):  # noqa: D107
+        # constants by name
+        self.constants = {}
+        # original names of loaded symbols by local name
+        self.aliases = {}
+        # rule kinds created by a macro by name
+        self.macros = {}
+        # the instantiated rules as pairs of kind and attributes
+        self.rules = []
+        self._configured_kinds = get_macro_kinds()
+
+    def get_kinds(self, name):
+        """
+        Get the rule kinds created by calling a symbol.
+
+        :param str name: The local name of the symbol
+        :returns: The configured rule kinds, the ones inferred from the
+          macro definition or the original name for other symbols
+        :rtype: list
+        """
+        original = self.aliases.get(name, name)
+        if original in self._configured_kinds:
+            return self._configured_kinds[original]
+        if name in self.macros:
+            return self.macros[name]
+        return [original]
+
+
+def get_macro_kinds():
+    """
+    Get the configured mapping of macros to rule kinds.
+
+    :returns: The rule kinds by macro name
+    :rtype: dict
+    """
+    mapping = {}
+    value = os.getenv(BAZEL_MACRO_KINDS_ENVIRONMENT_VARIABLE.name) or ''
+    for entry in value.split(','):
+        macro, separator, kind = entry.partition('=')
+        if not separator or not macro.strip() or not kind.strip():
+            if entry.strip():
+                logger.warning(
+                    "Invalid entry '{entry}' in environment variable "
+                    "'{name}'".format(
+                        entry=entry,
+                        name=BAZEL_MACRO_KINDS_ENVIRONMENT_VARIABLE.name))
+            continue
+        mapping.setdefault(macro.strip(), []).append(kind.strip())
+    return mapping
+
+
+def evaluate_build_file(
+    build_file, *, workspace_root=None, follow_loads=True
+):
+    """
+    Evaluate the declarative subset of Starlark in a BUILD file.
+
+    Constants, lists, concatenation and `select()` are evaluated, the
+    latter as the union of all branches.
+    Symbols are resolved through `load()` statements, macros defined in
+    loaded .bzl files are mapped to the rule kinds they create.
+    Anything else evaluates to :data:`UNKNOWN`.
+
+    :param Path build_file: The path of the BUILD file
+    :param Path workspace_root: The root of the Bazel workspace, if None it
+      is determined from the location of the BUILD file
+    :param bool follow_loads: The flag if the loaded .bzl files should be
+      evaluated, otherwise loaded symbols are only recorded as aliases
+    :returns: The evaluated module
+    :rtype: Module
+    :raises SyntaxError: if the file isn't valid Starlark
+    """
+    if not follow_loads:
+        return _evaluate(
+            build_file, build_file.read_text(errors='replace'), None, None)
+    if workspace_root is None:
+        workspace_root = find_workspace_root(build_file.parent) or \
+            build_file.parent
+    return _evaluate(
+        build_file, build_file.read_text(errors='replace'), workspace_root,
+        set())
+
+
+def load_module(path, workspace_root, loading=None):
+    """
+    Load a .bzl file.
+
+    The result is memoized until the file is modified, shared .bzl files
+    are therefore only evaluated once.
+
+    :param Path path: The path of the .bzl file
+    :param Path workspace_root: The root of the Bazel workspace
+    :param set loading: The files currently being loaded to detect cycles
+    :returns: The evaluated module, None if the file can't be loaded
+    :rtype: Module
+    """
+    loading = loading or set()
+    try:
+        key = (str(path), path.stat().st_mtime_ns)
+    except OSError:
+        return None
+    if key in _modules:
+        return _modules[key]
+    if str(path) in loading:
+        logger.warning("Cyclic load of '{path}'".format_map(locals()))
+        return None
+    try:
+        module = _evaluate(
+            path, path.read_text(errors='replace'), workspace_root,
+            loading | {str(path)})
+    except SyntaxError as e:
+        logger.warning(
+            "Failed to parse '{path}': {e}".format(path=path, e=e))
+        module = None
+    _modules[key] = module
+    return module
+
+
+def resolve_label(label, directory, workspace_root):
+    """
+    Resolve the label of a file within the workspace.
+
+    :param str label: The label, e.g. `//tools:defs.bzl` or `:defs.bzl`
+    :param Path directory: The directory of the referring file
+    :param Path workspace_root: The root of the Bazel workspace
+    :returns: The path, None for labels of external repositories
+    :rtype: Path
+    """
+    if label.startswith('@@'):
+        label = label[1:]
+    if label.startswith('@'):
+        repository, separator, label = label[1:].partition('//')
+        # only the main repository is available
+        if repository or not separator:
+            return None
+        label = '//' + label
+    if label.startswith('//'):
+        package, _, name = label[2:].partition(':')
+        if not name:
+            name = package.rsplit('/', 1)[-1]
+        return Path(workspace_root, package, name)
+    return Path(directory, label.lstrip(':'))
+
+
+def _evaluate(path, content, workspace_root, loading):
+    # loaded files aren't evaluated if `loading` is None
+    tree = ast.parse(content, filename=str(path))
+    module = Module()
+    for statement in tree.body:
+        if isinstance(statement, ast.Expr) and \
+                isinstance(statement.value, ast.Call):
+            _evaluate_call(
+                statement.value, module, path, workspace_root, loading)
+        elif isinstance(statement, ast.Assign):
+            value = _evaluate_expression(statement.value, module)
+            for target in statement.targets:
+                if isinstance(target, ast.Name):
+                    module.constants[target.id] = value
+        elif isinstance(statement, ast.FunctionDef):
+            module.macros[statement.name] = _get_created_kinds(
+                statement, module)
+    return module
+
+
+def _evaluate_call(call, module, path, workspace_root, loading):
+    name = _get_name(call.func)
+    if name is None:
+        return
+    if name == 'load':
+        _load(call, module, path, workspace_root, loading)
+        return
+
+    attributes = {
+        keyword.arg: _evaluate_expression(keyword.value, module)
+        for keyword in call.keywords if keyword.arg is not None}
+    for kind in module.get_kinds(name):
+        module.rules.append((kind, attributes))
+
+
+def _load(call, module, path, workspace_root, loading):
+    arguments = [_evaluate_expression(arg, module) for arg in call.args]
+    if not arguments or not isinstance(arguments[0], str):
+        return
+    symbols = {
+        symbol: symbol for symbol in arguments[1:]
+        if isinstance(symbol, str)}
+    for keyword in call.keywords:
+        original = _evaluate_expression(keyword.value, module)
+        if keyword.arg is not None and isinstance(original, str):
+            symbols[keyword.arg] = original
+
+    bzl_path = None
+    if loading is not None:
+        bzl_path = resolve_label(arguments[0], path.parent, workspace_root)
+    loaded = None
+    if bzl_path is not None:
+        loaded = load_module(bzl_path, workspace_root, loading)
+    for local, original in symbols.items():
+        module.aliases[local] = original
+        if loaded is None:
+            continue
+        if original in loaded.macros:
+            module.macros[local] = loaded.macros[original]
+        elif loaded.constants.get(original, UNKNOWN) is not UNKNOWN:
+            module.constants[local] = loaded.constants[original]
+        else:
+            module.aliases[local] = loaded.aliases.get(original, original)
+
+
+def _get_created_kinds(function, module):
+    # the rules created by a macro are the native rules and the loaded
+    # rules or macros it calls
+    kinds = []
+    for node in ast.walk(function):
+        if not isinstance(node, ast.Call):
+            continue
+        func = node.func
+        if isinstance(func, ast.Attribute) and \
+                isinstance(func.value, ast.Name) and \
+                func.value.id == 'native':
+            names = [func.attr]
+        elif isinstance(func, ast.Name) and (
+            func.id in module.macros or func.id in module.aliases
+        ):
+            names = module.get_kinds(func.id)
+        else:
+            continue
+        for name in names:
+            if name not in kinds:
+                kinds.append(name)
+    return kinds
+
+
+def _get_name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        parent = _get_name(node.value)
+        if parent is not None:
+            return parent + '.' + node.attr
+    return None
+
+
+def _evaluate_expression(node, module):
+    try:
+        # literals including lists, tuples and dicts of literals
+        return ast.literal_eval(node)
+    except (TypeError, ValueError):
+        pass
+
+    if isinstance(node, ast.Name):
+        return module.constants.get(node.id, UNKNOWN)
+    if isinstance(node, (ast.List, ast.Tuple)):
+        values = []
+        for element in node.elts:
+            value = _evaluate_expression(element, module)
+            if value is not UNKNOWN:
+                values.append(value)
+        return values
+    if isinstance(node, ast.Dict):
+        keys = [_evaluate_expression(key, module) for key in node.keys]
+        values = [_evaluate_expression(value, module) for value in node.values]
+        return {
+            key: value for key, value in zip(keys, values)
+            if isinstance(key, str)}
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        return _add(
+            _evaluate_expression(node.left, module),
+            _evaluate_expression(node.right, module))
+    if isinstance(node, ast.Call):
+        name = _get_name(node.func)
+        if name == 'select' and node.args:
+            return _select(_evaluate_expression(node.args[0], module))
+    return UNKNOWN
+
+
+def _add(left, right):
+    if isinstance(left, list) and isinstance(right, list):
+        return left + right
+    if isinstance(left, str) and isinstance(right, str):
+        return left + right
+    if isinstance(left, dict) and isinstance(right, dict):
+        return dict(left, **right)
+    # keep the known part of a partially unknown list
+    if isinstance(left, list) and right is UNKNOWN:
+        return left
+    if isinstance(right, list) and left is UNKNOWN:
+        return right
+    return UNKNOWN
+
+
+def _select(branches):
+    # all branches are considered since the configuration isn't known
+    if not isinstance(branches, dict):
+        return UNKNOWN
+    values = []
+    for value in branches.values():
+        if isinstance(value, list):
+            values.extend(v for v in value if v not in values)
+    return values
@@ -3,16 +3,84 @@
 
 import os
 from pathlib import Path
-import re
 import shutil
 
+from colcon_bazel.task.bazel.output_base import get_output_base
+from colcon_bazel.task.bazel.output_base import get_output_user_root
+from colcon_bazel.task.bazel.output_base import get_repository_cache
+from colcon_bazel.task.bazel.output_base import ISOLATION_PACKAGE
+from colcon_bazel.task.bazel.output_base import ISOLATION_STRATEGIES
+from colcon_bazel.task.bazel.workspace import get_group_root
+from colcon_bazel.task.bazel.workspace import get_package_pattern
 from colcon_core.environment_variable import EnvironmentVariable
 from colcon_core.subprocess import check_output
 
 BZL_COMAND = 'build'
 BZL_OUTPUT = '--output_base'
 BZL_INSTALL = '--install_base'
+BZL_OUTPUT_USER_ROOT = '--output_user_root'
 BZL_SYMLYNK = '--symlink_prefix'
+BZL_REPOSITORY_CACHE = '--repository_cache'
+BZL_SEPARATOR = '--'
+
+# Startup options which must be placed in front of the command
+BZL_STARTUP_OPTIONS = (
+    '--autodetect_server_javabase', '--batch', '--batch_cpu_scheduling',
+    '--bazelrc', '--block_for_lock', '--client_debug',
+    '--connect_timeout_secs', '--digest_function',
+    '--expand_configs_in_place', '--experimental_cgroup_parent',
+    '--experimental_run_in_user_cgroup', '--failure_detail_out',
+    '--fatal_event_bus_exceptions', '--home_rc', '--host_jvm_args',
+    '--host_jvm_debug', '--host_jvm_profile', '--idle_server_tasks',
+    '--ignore_all_rc_files', '--install_base', '--io_nice_level',
+    '--local_startup_timeout_secs', '--macos_qos_class', '--max_idle_secs',
+    '--output_base', '--output_user_root', '--preemptible', '--quiet',
+    '--server_javabase', '--server_jvm_out', '--shutdown_on_low_sys_mem',
+    '--system_rc', '--unlimit_coredumps', '--watchfs',
+    '--windows_enable_symlinks', '--workspace_rc', '--write_command_log',
+)
+
+# Options which don't take a separate value, negated options like
+# `--nobatch` and options of the form `--name=value` don't either
+BZL_BOOLEAN_OPTIONS = (
+    # startup options
+    '--autodetect_server_javabase', '--batch', '--batch_cpu_scheduling',
+    '--block_for_lock', '--client_debug', '--expand_configs_in_place',
+    '--experimental_run_in_user_cgroup', '--fatal_event_bus_exceptions',
+    '--home_rc', '--host_jvm_debug', '--idle_server_tasks',
+    '--ignore_all_rc_files', '--preemptible', '--quiet',
+    '--shutdown_on_low_sys_mem', '--system_rc', '--unlimit_coredumps',
+    '--watchfs', '--windows_enable_symlinks', '--workspace_rc',
+    '--write_command_log',
+    # common flags of the commands
+    '--announce_rc', '--build', '--build_runfile_links', '--build_tests_only',
+    '--cache_test_results', '--check_up_to_date', '--collect_code_coverage',
+    '--compile_one_dependency', '--expunge', '--expunge_async',
+    '--keep_going', '--show_loading_progress',
+    '--show_progress', '--stamp', '--subcommands', '--test_keep_going',
+    '--test_verbose_timeout_warnings', '--verbose_failures',
+    '--verbose_explanations', '-k', '-s',
+)
+
+# Commands accepting the options of the build command
+BZL_BUILD_COMMANDS = (
+    'aquery', 'build', 'coverage', 'cquery', 'mobile-install', 'run',
+    'test')
+
+# Other commands which download external repositories
+BZL_FETCH_COMMANDS = ('fetch', 'query', 'sync')
+
+# Flags passed to every command unless set by the user
+BZL_DEFAULT_FLAGS = ('--noshow_progress', )
+
+# Flags passed to every build command unless set by the user
+BZL_DEFAULT_BUILD_FLAGS = (
+    # Disable symbolic link in source folder.
+    BZL_SYMLYNK + '=/',
+    # Define verbose mode.
+    '--show_result=-1', '--noshow_progress', '--noshow_loading_progress',
+    '--logging=0', '--verbose_failures',
+)
 
 """Environment variable to override the Bazel executable"""
 BAZEL_COMMAND_ENVIRONMENT_VARIABLE = EnvironmentVariable(
@@ -85,6 +153,42 @@ async def get_bazel_tasks(path):
     return [line.split(separator)[0] for line in lines if separator in line]
 
 
+def add_bazel_arguments(parser):
+    """
+    Add the arguments shared by all Bazel tasks.
+
+    :param parser: The argument parser
+    """
+    parser.add_argument(
+        '--bazel-args',
+        nargs='*', metavar='*', type=str.lstrip,
+        help='Pass arguments to Bazel projects. '
+        'Arguments matching other options must be prefixed by a space,\n'
+        'e.g. --bazel-args " --help"')
+    parser.add_argument(
+        '--bazel-task',
+        help='Run a specific task instead of the default task')
+    parser.add_argument(
+        '--bazel-output-base',
+        choices=ISOLATION_STRATEGIES, default=ISOLATION_PACKAGE,
+        help='Use a separate Bazel output base (and server) per package, '
+        'per workspace root or one shared by all packages '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '--bazel-minimal-env',
+        action='store_true',
+        help='Pass only the variables set by the dependencies and a few '
+        'essential ones like PATH and HOME to Bazel, unrelated changes of '
+        'the environment then leave its server and caches untouched')
+    parser.add_argument(
+        '--bazel-group-by-workspace',
+        action='store_true',
+        help='Build and test the Bazel packages of the same workspace '
+        '(WORKSPACE or MODULE.bazel root) from its root with a shared '
+        'server, packages ready at the same time are batched into a single '
+        'Bazel invocation')
+
+
 def get_bazel_executable(args):
     """
     Get executable path of bazel.
@@ -110,22 +214,7 @@ def get_bazel_startup_options(args):
     :returns: startup options
     :rtype: list
     """
-    bazel_args = (args.bazel_args or [])
-    tmp_args = ' '.join(bazel_args)
-
-    regex = '.*(' + BZL_OUTPUT + '|' + BZL_INSTALL + ').*'
-    if (not re.match(regex, tmp_args)):
-        # Default Bazel 'build' & 'install' folder for colcon.
-        output_path = BZL_OUTPUT + '=' + args.build_base + '/bazel'
-        install_path = BZL_INSTALL + '=' + args.install_base + '/bazel'
-        cmd_startup_options = [output_path, install_path]
-    else:
-        # Do not override the default Bazel 'build' & 'install'
-        # folder for colcon.
-        msg = "Could not use 'output_base' and 'install_base' arguments."
-        raise RuntimeError(msg)
-
-    return cmd_startup_options
+    return list(create_bazel_command(args).startup_options)
 
 
 def get_bazel_command(args, default_cmd=BZL_COMAND):
@@ -136,7 +225,7 @@ def get_bazel_command(args, default_cmd=BZL_COMAND):
     :returns: The target command
     :rtype: str
     """
-    if args.bazel_task:
+    if getattr(args, 'bazel_task', None):
         cmd_command = args.bazel_task
     else:
         cmd_command = default_cmd
@@ -152,19 +241,284 @@ def get_bazel_arguments(args):
     :returns: target arguments
     :rtype: list
     """
-    cmd_args = (args.bazel_args or [])
-    tmp_args = ' '.join(cmd_args)
+    return list(create_bazel_command(args).flags)
 
-    # Disable symbolic link in source folder.
-    if (not re.match('.*' + BZL_SYMLYNK + '.*', ' '.join(tmp_args))):
-        cmd_args += [BZL_SYMLYNK + '=/']
 
-    # Define verbose mode.
-    cmd_args += ['--show_result=-1', '--noshow_progress',
-                 '--noshow_loading_progress', '--logging=0',
-                 '--verbose_failures']
+class BazelCommand:
+    """
+    Immutable Bazel command line.
+
+    The command line is composed of
+    `<executable> <startup options> <command> <flags> -- <target patterns>`,
+    see https://docs.bazel.build/versions/master/command-line-reference.html
+    Use :meth:`replace` and the `with_*` methods to derive other commands
+    sharing the same server.
+    """
+
+    __slots__ = (
+        'executable', 'startup_options', 'command', 'flags',
+        'target_patterns')
+
+    def __init__(
+        self, executable, command, *, startup_options=(), flags=(),
+        target_patterns=()
+    ):
+        """
+        Construct a Bazel command line.
+
+        :param str executable: The path of the Bazel executable
+        :param str command: The Bazel command, e.g. `build`
+        :param startup_options: The startup options
+        :param flags: The flags of the command
+        :param target_patterns: The target patterns
+        """
+        object.__setattr__(self, 'executable', executable)
+        object.__setattr__(self, 'startup_options', tuple(startup_options))
+        object.__setattr__(self, 'command', command)
+        object.__setattr__(self, 'flags', tuple(flags))
+        object.__setattr__(self, 'target_patterns', tuple(target_patterns))
+
+    def __setattr__(self, name, value):  # noqa: D105
+        raise AttributeError(
+            "'{}' object is immutable".format(type(self).__name__))
+
+    def __eq__(self, other):  # noqa: D105
+        if not isinstance(other, BazelCommand):
+            return NotImplemented
+        return self.to_list() == other.to_list()
+
+    def __hash__(self):  # noqa: D105
+        return hash(tuple(self.to_list()))
+
+    def __repr__(self):  # noqa: D105
+        return '{}({!r})'.format(type(self).__name__, self.to_list())
+
+    def replace(self, **kwargs):
+        """
+        Get a copy of the command with some of the parts replaced.
+
+        :param kwargs: The parts to replace, see :meth:`__init__`
+        :rtype: BazelCommand
+        """
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(kwargs)
+        return BazelCommand(
+            values.pop('executable'), values.pop('command'), **values)
+
+    def with_startup_options(self, *options):
+        """
+        Get a copy of the command with additional startup options.
+
+        :param options: The startup options to append
+        :rtype: BazelCommand
+        """
+        return self.replace(startup_options=self.startup_options + options)
+
+    def with_flags(self, *flags):
+        """
+        Get a copy of the command with additional flags.
+
+        :param flags: The flags to append
+        :rtype: BazelCommand
+        """
+        return self.replace(flags=self.flags + flags)
+
+    def has_startup_option(self, name):
+        """
+        Check if a startup option is set, either positive or negated.
+
+        :param str name: The option name including the leading dashes
+        :rtype: bool
+        """
+        return has_bazel_option(self.startup_options, name)
+
+    def has_flag(self, name):
+        """
+        Check if a flag is set, either positive or negated.
+
+        :param str name: The flag name including the leading dashes
+        :rtype: bool
+        """
+        return has_bazel_option(self.flags, name)
+
+    def to_list(self):
+        """
+        Get the command line.
+
+        :rtype: list
+        """
+        cmd = [self.executable]
+        cmd.extend(self.startup_options)
+        cmd.append(self.command)
+        cmd.extend(self.flags)
+        if self.target_patterns:
+            cmd.append(BZL_SEPARATOR)
+            cmd.extend(self.target_patterns)
+        return cmd
+
+
+def create_bazel_command(
+    args, default_cmd=BZL_COMAND, default_target_patterns=('//...',)
+):
+    """
+    Create the Bazel command line of a package.
+
+    The `--bazel-args` are split into startup options, flags and target
+    patterns; the arguments of the package args are not modified.
+    The colcon specific defaults are added unless the user overrides them.
+
+    :param args: Arguments of package descriptor.
+    :param str default_cmd: The command if not overridden by `--bazel-task`
+    :param default_target_patterns: The target patterns if none are given,
+      in grouping mode the default is the pattern of the package within its
+      workspace
+    :rtype: BazelCommand
+    """
+    startup_options, flags, target_patterns = parse_bazel_arguments(
+        getattr(args, 'bazel_args', None) or [])
 
-    return cmd_args
+    if has_bazel_option(startup_options, BZL_OUTPUT) or \
+            has_bazel_option(startup_options, BZL_INSTALL):
+        # Do not override the default Bazel 'build' & 'install'
+        # folder for colcon.
+        msg = "Could not use 'output_base' and 'install_base' arguments."
+        raise RuntimeError(msg)
+
+    # Default Bazel 'build' & 'install' folder for colcon, the install bases
+    # are shared by all packages to extract each Bazel version only once.
+    executable = get_bazel_executable(args)
+    defaults = [BZL_OUTPUT + '=' + str(get_output_base(args))]
+    if not has_bazel_option(startup_options, BZL_OUTPUT_USER_ROOT):
+        defaults.append(
+            BZL_OUTPUT_USER_ROOT + '=' + str(get_output_user_root(args)))
+    startup_options = defaults + startup_options
+
+    # the commands of grouped packages are run from the workspace root
+    root = get_group_root(args)
+    if root is not None:
+        default_target_patterns = (get_package_pattern(args.path, root), )
+
+    command = get_bazel_command(args, default_cmd)
+    default_flags = BZL_DEFAULT_BUILD_FLAGS \
+        if command in BZL_BUILD_COMMANDS else BZL_DEFAULT_FLAGS
+    for flag in default_flags:
+        if not has_bazel_option(flags, flag):
+            flags.append(flag)
+
+    # Share downloaded external repositories between all output bases.
+    if command in BZL_BUILD_COMMANDS + BZL_FETCH_COMMANDS and \
+            not has_bazel_option(flags, BZL_REPOSITORY_CACHE):
+        flags.append(
+            BZL_REPOSITORY_CACHE + '=' + str(get_repository_cache(args)))
+
+    return BazelCommand(
+        executable, command,
+        startup_options=startup_options, flags=flags,
+        target_patterns=target_patterns or default_target_patterns)
+
+
+def parse_bazel_arguments(bazel_args):
+    """
+    Split Bazel arguments into startup options, flags and target patterns.
+
+    Known startup options are moved in front of the command.
+    Everything after a `--` separator as well as labels starting with `//`,
+    `@` or `:` and patterns ending with `...` are target patterns.
+    A single argument which isn't a long (`--name`) or short (`-c`) option is
+    considered to be the value of the preceding option unless the option
+    doesn't take a separate value, e.g. `--name=value`, `--noname` or one of
+    the :data:`BZL_BOOLEAN_OPTIONS`.
+    Other arguments are relative target patterns like `a/b:c`.
+
+    :param list bazel_args: The arguments
+    :returns: The startup options, flags and target patterns
+    :rtype: tuple
+    """
+    startup_options = []
+    flags = []
+    target_patterns = []
+    destination = None
+    for i, arg in enumerate(bazel_args):
+        if arg == BZL_SEPARATOR:
+            target_patterns.extend(bazel_args[i + 1:])
+            break
+        if arg.startswith(('//', '@', ':', '-//')) or \
+                _is_recursive_pattern(arg):
+            target_patterns.append(arg)
+            destination = None
+        elif arg.startswith('--') or (len(arg) == 2 and arg[0] == '-'):
+            container = startup_options \
+                if has_bazel_option(BZL_STARTUP_OPTIONS, arg) else flags
+            container.append(arg)
+            destination = None if _is_value_less_option(arg) else container
+        elif destination is not None:
+            destination.append(arg)
+            destination = None
+        else:
+            target_patterns.append(arg)
+    return startup_options, flags, target_patterns
+
+
+def _is_recursive_pattern(arg):
+    pattern = arg.lstrip('-').split(':', 1)[0]
+    return pattern == '...' or pattern.endswith('/...')
+
+
+def _is_value_less_option(option):
+    if '=' in option:
+        return True
+    if not option.startswith('--'):
+        return option in BZL_BOOLEAN_OPTIONS
+    return option.startswith('--no') or \
+        has_bazel_option(BZL_BOOLEAN_OPTIONS, option)
+
+
+def get_bazel_option_name(option):
+    """
+    Get the name of an option without its value.
+
+    :param str option: The option, e.g. `--jobs=4`
+    :returns: The option name, e.g. `--jobs`
+    :rtype: str
+    """
+    return option.split('=', 1)[0]
+
+
+def get_bazel_option_value(options, name):
+    """
+    Get the value of an option, the last occurrence takes precedence.
+
+    :param options: The options
+    :param str name: The option name including the leading dashes
+    :returns: The value, None if the option isn't set with a value
+    :rtype: str
+    """
+    value = None
+    for option in options:
+        if option.startswith(name + '='):
+            value = option.split('=', 1)[1]
+    return value
+
+
+def has_bazel_option(options, name):
+    """
+    Check if an option is part of a sequence of options.
+
+    Negated boolean options like `--noshow_progress` match `--show_progress`
+    and vice versa.
+
+    :param options: The options
+    :param str name: The option name including the leading dashes, an
+      optional value is ignored
+    :rtype: bool
+    """
+    bare = get_bazel_option_name(name).lstrip('-')
+    names = {'--' + bare}
+    if bare.startswith('no'):
+        names.add('--' + bare[2:])
+    else:
+        names.add('--no' + bare)
+    return any(get_bazel_option_name(o) in names for o in options)
 
 
 def _has_local_executable(args):
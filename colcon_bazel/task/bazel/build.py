@@ -1,14 +1,39 @@
 # Copyright 2018 Mickael Gaillard
 # Licensed under the Apache License, Version 2.0
 
-from colcon_bazel.task.bazel import get_bazel_arguments
+import os
+from pathlib import Path
+
+from colcon_bazel.task.bazel import add_bazel_arguments
+from colcon_bazel.task.bazel import BZL_COMAND
+from colcon_bazel.task.bazel import create_bazel_command
 from colcon_bazel.task.bazel import get_bazel_command
-from colcon_bazel.task.bazel import get_bazel_executable
-from colcon_bazel.task.bazel import get_bazel_startup_options
+from colcon_bazel.task.bazel import get_bazel_option_value
+from colcon_bazel.task.bazel.environment import get_environment
+from colcon_bazel.task.bazel.execution_profile import add_profile_arguments
+from colcon_bazel.task.bazel.execution_profile import apply_execution_limits
+from colcon_bazel.task.bazel.execution_profile import apply_execution_profile
+from colcon_bazel.task.bazel.execution_profile import BUILD_EVENTS_FILENAME
+from colcon_bazel.task.bazel.execution_profile import is_auto_tuned
+from colcon_bazel.task.bazel.execution_profile import record_execution_profile
+from colcon_bazel.task.bazel.execution_profile import select_execution_profile
+from colcon_bazel.task.bazel.file_state import get_file_state_database
+from colcon_bazel.task.bazel.flaky import BZL_BUILD_EVENT_JSON_FILE
+from colcon_bazel.task.bazel.install import get_output_files
+from colcon_bazel.task.bazel.install import install_files
+from colcon_bazel.task.bazel.install import is_installed
+from colcon_bazel.task.bazel.install import MANIFEST_FILENAME
+from colcon_bazel.task.bazel.memory import get_memory_governor
+from colcon_bazel.task.bazel.metrics import get_metrics_recorder
+from colcon_bazel.task.bazel.output_base import find_workspace_root
+from colcon_bazel.task.bazel.output_base import get_output_base
+from colcon_bazel.task.bazel.query import BazelQueryTask
+from colcon_bazel.task.bazel.query import BZL_QUERY_COMMANDS
+from colcon_bazel.task.bazel.workspace import get_group_root
+from colcon_bazel.task.bazel.workspace import run_bazel_command
 from colcon_core.environment import create_environment_scripts
 from colcon_core.logging import colcon_logger
 from colcon_core.plugin_system import satisfies_version
-from colcon_core.shell import get_command_environment
 from colcon_core.task import check_call
 from colcon_core.task import TaskExtensionPoint
 
@@ -23,15 +48,13 @@ class BazelBuildTask(TaskExtensionPoint):
         satisfies_version(TaskExtensionPoint.EXTENSION_POINT_VERSION, '^1.0')
 
     def add_arguments(self, *, parser):  # noqa: D102
+        add_bazel_arguments(parser)
+        add_profile_arguments(parser)
         parser.add_argument(
-            '--bazel-args',
-            nargs='*', metavar='*', type=str.lstrip,
-            help='Pass arguments to Bazel projects. '
-            'Arguments matching other options must be prefixed by a space,\n'
-            'e.g. --bazel-args " --help"')
-        parser.add_argument(
-            '--bazel-task',
-            help='Run a specific task instead of the default task')
+            '--bazel-skip-unchanged',
+            action='store_true',
+            help='Skip Bazel packages whose sources, arguments and Bazel '
+            'dependencies are unchanged since their last successful build')
 
     async def build(  # noqa: D102
         self, *, additional_hooks=None, skip_hook_creation=False
@@ -39,42 +62,185 @@ class BazelBuildTask(TaskExtensionPoint):
         pkg = self.context.pkg
         args = self.context.args
 
+        # query commands don't build anything but dump their result
+        if get_bazel_command(args) in BZL_QUERY_COMMANDS:
+            task = BazelQueryTask()
+            task.set_context(context=self.context)
+            rc = await task.query()
+            if rc:
+                return rc
+            if not skip_hook_creation:
+                self._create_environment_scripts(additional_hooks)
+            return
+
         logger.info(
             "Building Bazel package in '{args.path}'".format_map(locals()))
 
+        metrics = get_metrics_recorder()
+        try:
+            bzl_cmd = create_bazel_command(args)
+        except RuntimeError as e:
+            logger.error(str(e))
+            return 1
+
+        fingerprint = None
+        if getattr(args, 'bazel_skip_unchanged', False):
+            with metrics.measure(pkg.name, 'build', 'fingerprint'):
+                fingerprint, unchanged = self._get_fingerprint(
+                    args, bzl_cmd)
+            if unchanged:
+                logger.info(
+                    "Skipping unchanged Bazel package in '{args.path}'"
+                    .format_map(locals()))
+                if not skip_hook_creation:
+                    self._create_environment_scripts(additional_hooks)
+                return
+
         try:
-            env = await get_command_environment(
-                'build', args.build_base, self.context.dependencies)
+            with metrics.measure(pkg.name, 'build', 'environment'):
+                env = await get_environment(
+                    'build', args, self.context.dependencies)
         except RuntimeError as e:
             logger.error(str(e))
             return 1
 
-        rc = await self._build(args, env)
-        if rc and rc.returncode:
-            return rc.returncode
+        # Limit the memory of the Bazel server and its local actions
+        governor = get_memory_governor()
+        bzl_cmd = governor.apply(bzl_cmd)
+        bzl_cmd, profile = apply_execution_profile(
+            bzl_cmd, select_execution_profile(args, pkg, 'build'))
+        bzl_cmd = apply_execution_limits(bzl_cmd, args, pkg)
+
+        # The build events report the executed actions which the
+        # auto-tuning compares the profiles by, grouped packages can only be
+        # batched with an identical command line
+        build_events = None
+        if profile is not None and is_auto_tuned(args, pkg):
+            build_events = get_bazel_option_value(
+                bzl_cmd.flags, BZL_BUILD_EVENT_JSON_FILE)
+            if build_events is None and get_group_root(args, pkg) is None:
+                build_events = str(
+                    Path(args.build_base) / BUILD_EVENTS_FILENAME)
+                bzl_cmd = bzl_cmd.with_flags(
+                    BZL_BUILD_EVENT_JSON_FILE + '=' + build_events)
+            if build_events is not None and os.path.exists(build_events):
+                # don't confuse the events of a previous run with this one
+                os.remove(build_events)
+
+        # hold the memory until the server is shut down, the calls of the
+        # install step use the server as well
+        async with governor.reserve(args, pkg, bzl_cmd, env=env):
+            rc = await self._build(args, env, bzl_cmd)
+            if rc and rc.returncode:
+                return rc.returncode
+            if build_events is not None:
+                record_execution_profile(
+                    args, pkg, 'build', profile, self._bazel_seconds,
+                    build_events)
+
+            if bzl_cmd.command == BZL_COMAND:
+                with metrics.measure(pkg.name, 'build', 'install'):
+                    rc = await self._install(args, env, bzl_cmd)
+                if rc:
+                    return rc
+
+        if fingerprint is not None:
+            with get_file_state_database(args) as database:
+                database.set_package_fingerprint(pkg.name, fingerprint)
 
         if not skip_hook_creation:
-            create_environment_scripts(
-                pkg, args, additional_hooks=additional_hooks)
+            self._create_environment_scripts(additional_hooks)
+
+    def _get_fingerprint(self, args, bzl_cmd):
+        # Get the fingerprint of the package to record after the build and
+        # if the package is unchanged since its last successful build
+        pkg = self.context.pkg
+        get_sources = pkg.metadata.get('get_bazel_sources')
+        if get_sources is None:
+            return None, False
 
-    async def _build(self, args, env):
+        with get_file_state_database(args) as database:
+            previous = database.get_package_fingerprint(pkg.name)
+            # forget the last build in case this one fails
+            database.set_package_fingerprint(pkg.name, None)
+
+            sources = get_sources(set(self.context.dependencies))
+            if sources is None:
+                # changes of files outside of the package can't be detected
+                return None, False
+
+            extra = [' '.join(bzl_cmd.to_list())]
+            for name in sorted(self.context.dependencies):
+                dependency = database.get_package_fingerprint(name)
+                if dependency is None:
+                    # changes of other packages can't be detected
+                    return None, False
+                extra.append(name + '=' + dependency)
+            fingerprint = database.get_fingerprint(sources, extra=extra)
+
+            if fingerprint == previous and (
+                bzl_cmd.command != BZL_COMAND or is_installed(
+                    args.install_base,
+                    Path(args.build_base) / MANIFEST_FILENAME)
+            ):
+                database.set_package_fingerprint(pkg.name, fingerprint)
+                return fingerprint, True
+        return fingerprint, False
+
+    async def _build(self, args, env, bzl_cmd):
         self.progress('build')
+        self._bazel_seconds = None
 
-        bzl_exec_path = get_bazel_executable(args)
-        bzl_startup_options = get_bazel_startup_options(args)
-        bzl_command = get_bazel_command(args)
-        bzl_args = get_bazel_arguments(args)
-        bzl_target_patterns = ['//...']
-
-        # Make full command
-        # https://docs.bazel.build/versions/master/command-line-reference.html
-        cmd = [bzl_exec_path]
-        cmd.extend(bzl_startup_options)
-        cmd.append(bzl_command)
-        cmd.extend(bzl_args)
-        cmd.append('--')
-        cmd.extend(bzl_target_patterns)
-
-        # invoke build step
-        return await check_call(
-            self.context, cmd, cwd=args.path, env=env)
+        async def invoke(cmd, cwd):
+            async with get_metrics_recorder().measure(
+                self.context.pkg.name, 'build', 'bazel',
+                output_base=get_output_base(args)
+            ) as measurement:
+                rc = await check_call(
+                    self.context, cmd.to_list(), cwd=cwd, env=env)
+            # the time of a batched invocation isn't attributed to a package
+            if cmd == bzl_cmd:
+                self._bazel_seconds = measurement.seconds
+            return rc
+
+        return await run_bazel_command(
+            args, self.context.pkg, bzl_cmd, invoke, env=env)
+
+    async def _install(self, args, env, bzl_cmd):
+        self.progress('install')
+
+        try:
+            files = await get_output_files(bzl_cmd, cwd=args.path, env=env)
+        except AssertionError as e:
+            logger.error(
+                'Failed to determine the outputs of the Bazel package: ' +
+                str(e))
+            return 1
+
+        root = find_workspace_root(args.path)
+        package_path = None
+        if root is not None:
+            package_path = Path(args.path).resolve().relative_to(
+                root).as_posix()
+        try:
+            installed, skipped = install_files(
+                files, args.install_base, self.context.pkg.name,
+                Path(args.build_base) / MANIFEST_FILENAME,
+                package_path=package_path,
+                symlink=bool(getattr(args, 'symlink_install', False)))
+        except OSError as e:
+            logger.error(
+                'Failed to install the outputs of the Bazel package: ' +
+                str(e))
+            return 1
+        logger.info(
+            "Installed {installed} files into '{args.install_base}', "
+            '{skipped} unchanged files skipped'.format_map(locals()))
+
+    def _create_environment_scripts(self, additional_hooks):
+        with get_metrics_recorder().measure(
+            self.context.pkg.name, 'build', 'hooks'
+        ):
+            create_environment_scripts(
+                self.context.pkg, self.context.args,
+                additional_hooks=additional_hooks)
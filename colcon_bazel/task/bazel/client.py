@@ -0,0 +1,205 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+import asyncio
+
+from colcon_bazel.task.bazel import BZL_OUTPUT
+from colcon_bazel.task.bazel import get_bazel_option_name
+from colcon_bazel.task.bazel.output_base import find_workspace_root
+from colcon_core.logging import colcon_logger
+from colcon_core.subprocess import check_output
+
+logger = colcon_logger.getChild(__name__)
+
+# The number of concurrent informational Bazel calls per output base, the
+# Bazel server runs the commands of an output base one at a time anyway
+DEFAULT_CONCURRENCY = 1
+
+_client = None
+
+
+class BazelClient:
+    """
+    Run informational Bazel commands like `info` and `query`.
+
+    The keys requested from `bazel info` are batched into a single call and
+    the values are memoized per output base and workspace for the rest of
+    the invocation.
+    The number of concurrent calls is bounded per output base since each of
+    them occupies the Bazel server of its output base, calls using
+    different output bases don't wait for each other.
+    """
+
+    def __init__(self, *, concurrency=DEFAULT_CONCURRENCY):
+        """
+        Construct a Bazel client.
+
+        :param int concurrency: The maximum number of concurrent calls per
+          output base
+        """
+        self.concurrency = concurrency
+        self._info = {}
+        self._pending = {}
+        self._semaphores = {}
+        self._loop = None
+
+    async def get_info(self, bazel_command, keys, *, cwd, env=None):
+        """
+        Get values of `bazel info`.
+
+        The command is run without flags, the values are therefore those of
+        the default configuration.
+        Values which weren't memoized yet are requested in a single call,
+        values requested concurrently by another caller are shared.
+        Values like `execution_root` depend on the workspace, the values are
+        therefore only shared by callers within the same workspace.
+
+        :param BazelCommand bazel_command: A command using the output base
+        :param keys: The info keys, e.g. `execution_root`
+        :param str cwd: The working directory
+        :param dict env: The environment
+        :returns: The values by key
+        :rtype: dict
+        :raises AssertionError: if the Bazel call fails
+        """
+        output_base = get_command_output_base(bazel_command, cwd)
+        self._get_semaphore(output_base)
+        workspace = str(find_workspace_root(cwd) or cwd)
+
+        missing = [
+            key for key in keys
+            if (output_base, workspace, key) not in self._info and
+            (output_base, workspace, key) not in self._pending]
+        if missing:
+            future = asyncio.get_event_loop().create_future()
+            for key in missing:
+                self._pending[(output_base, workspace, key)] = future
+            try:
+                info_command = bazel_command.replace(
+                    command='info', flags=(), target_patterns=())
+                output = await self.check_output(
+                    info_command.to_list() + missing, cwd=cwd, env=env,
+                    output_base=output_base)
+                values = parse_info(output.decode(), missing)
+            except AssertionError as e:
+                future.set_exception(e)
+                # avoid a warning if there are no concurrent callers
+                future.exception()
+                raise
+            else:
+                for key, value in values.items():
+                    self._info[(output_base, workspace, key)] = value
+                future.set_result(None)
+            finally:
+                if not future.done():
+                    future.cancel()
+                for key in missing:
+                    self._pending.pop((output_base, workspace, key), None)
+
+        for key in keys:
+            if (output_base, workspace, key) not in self._info:
+                await self._pending[(output_base, workspace, key)]
+        return {
+            key: self._info[(output_base, workspace, key)] for key in keys}
+
+    async def query(self, bazel_command, *, cwd, env=None):
+        """
+        Run a query command.
+
+        The results aren't memoized since they depend on the sources.
+
+        :param BazelCommand bazel_command: The query command
+        :param str cwd: The working directory
+        :param dict env: The environment
+        :returns: The output of the command
+        :rtype: bytes
+        :raises AssertionError: if the Bazel call fails
+        """
+        return await self.check_output(
+            bazel_command.to_list(), cwd=cwd, env=env,
+            output_base=get_command_output_base(bazel_command, cwd))
+
+    async def check_output(self, cmd, *, cwd, env=None, output_base=None):
+        """
+        Run a command once a concurrency slot of its output base is free.
+
+        :param list cmd: The command line
+        :param str cwd: The working directory
+        :param dict env: The environment
+        :param str output_base: The output base the command uses, if None
+          the working directory
+        :rtype: bytes
+        """
+        async with self._get_semaphore(output_base or str(cwd)):
+            logger.debug('Invoking {cmd}'.format_map(locals()))
+            return await check_output(cmd, cwd=cwd, env=env)
+
+    def clear(self):
+        """Forget all memoized values."""
+        self._info.clear()
+
+    def _get_semaphore(self, output_base):
+        # the semaphores and pending futures are bound to the running loop
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            self._semaphores = {}
+            self._pending = {}
+            self._loop = loop
+        semaphore = self._semaphores.get(output_base)
+        if semaphore is None:
+            semaphore = self._semaphores[output_base] = asyncio.Semaphore(
+                self.concurrency)
+        return semaphore
+
+
+def get_bazel_client():
+    """
+    Get the Bazel client shared by all Bazel tasks of this invocation.
+
+    :rtype: BazelClient
+    """
+    global _client
+    if _client is None:
+        _client = BazelClient()
+    return _client
+
+
+def get_command_output_base(bazel_command, cwd):
+    """
+    Get the output base a Bazel command uses.
+
+    :param BazelCommand bazel_command: The command
+    :param str cwd: The working directory, identifying the output base if it
+      isn't passed explicitly
+    :rtype: str
+    """
+    for option in reversed(bazel_command.startup_options):
+        if get_bazel_option_name(option) == BZL_OUTPUT:
+            return option.split('=', 1)[1]
+    return str(cwd)
+
+
+def parse_info(output, keys):
+    """
+    Parse the output of `bazel info`.
+
+    For a single key Bazel only prints the value, otherwise each line has
+    the form `<key>: <value>`.
+
+    :param str output: The output
+    :param list keys: The requested keys
+    :returns: The values by key
+    :rtype: dict
+    """
+    if len(keys) == 1:
+        return {keys[0]: output.strip()}
+    values = {}
+    for line in output.splitlines():
+        key, separator, value = line.partition(': ')
+        if separator and key in keys:
+            values[key] = value.strip()
+    missing = [key for key in keys if key not in values]
+    if missing:
+        raise AssertionError(
+            "'bazel info' didn't report {}".format(', '.join(missing)))
+    return values
@@ -0,0 +1,278 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+import asyncio
+from collections import OrderedDict
+import os
+from pathlib import Path
+import shutil
+
+from colcon_bazel.task.bazel import add_bazel_arguments
+from colcon_bazel.task.bazel import create_bazel_command
+from colcon_bazel.task.bazel.client import get_bazel_client
+from colcon_bazel.task.bazel.client import get_command_output_base
+from colcon_bazel.task.bazel.environment import get_environment
+from colcon_bazel.task.bazel.memory import get_memory_governor
+from colcon_bazel.task.bazel.metrics import get_metrics_recorder
+from colcon_bazel.task.bazel.output_base import get_output_base
+from colcon_bazel.task.bazel.workspace import run_bazel_command
+from colcon_core.logging import colcon_logger
+from colcon_core.plugin_system import satisfies_version
+from colcon_core.task import check_call
+from colcon_core.task import TaskExtensionPoint
+
+logger = colcon_logger.getChild(__name__)
+
+BZL_COMBINED_REPORT = '--combined_report'
+
+# The combined report relative to the Bazel output path
+COMBINED_REPORT_PATH = Path('_coverage') / '_coverage_report.dat'
+
+# The copy of the combined report of a package in its build base
+PACKAGE_REPORT_FILENAME = 'bazel_coverage_report.dat'
+
+# The workspace report relative to the root of the build base
+WORKSPACE_REPORT_FILENAME = 'bazel_coverage.info'
+
+# The workspace reports which were started by this invocation
+_started_reports = set()
+
+# The locks of the combined reports by output base
+_report_locks = {}
+_report_loop = None
+
+
+class BazelCoverageTask(TaskExtensionPoint):
+    """Gather the coverage of Bazel packages."""
+
+    def __init__(self):  # noqa: D107
+        super().__init__()
+        satisfies_version(TaskExtensionPoint.EXTENSION_POINT_VERSION, '^1.0')
+
+    def add_arguments(self, *, parser):  # noqa: D102
+        add_bazel_arguments(parser)
+
+    async def coverage(self, *, additional_hooks=None):  # noqa: D102
+        args = self.context.args
+
+        logger.info(
+            "Gathering coverage of Bazel package in '{args.path}'"
+            .format_map(locals()))
+
+        try:
+            env = await get_environment(
+                'coverage', args, self.context.dependencies)
+        except RuntimeError as e:
+            logger.error(str(e))
+            return 1
+
+        # Limit the memory of the Bazel server and its local actions
+        governor = get_memory_governor()
+        try:
+            bzl_cmd = governor.apply(create_bazel_command(args, 'coverage'))
+        except RuntimeError as e:
+            logger.error(str(e))
+            return 1
+        if not bzl_cmd.has_flag(BZL_COMBINED_REPORT):
+            bzl_cmd = bzl_cmd.with_flags(BZL_COMBINED_REPORT + '=lcov')
+
+        self.progress('coverage')
+        report = None
+
+        async def invoke(cmd, cwd):
+            nonlocal report
+            # the combined report is overwritten by the next coverage command
+            # using the output base, it is copied before that can start
+            async with get_report_lock(get_command_output_base(cmd, cwd)):
+                async with get_metrics_recorder().measure(
+                    self.context.pkg.name, 'coverage', 'bazel',
+                    output_base=get_output_base(args)
+                ):
+                    rc = await check_call(
+                        self.context, cmd.to_list(), cwd=cwd, env=env)
+                if rc and rc.returncode:
+                    return rc
+                info = await get_bazel_client().get_info(
+                    cmd, ['output_path'], cwd=cwd, env=env)
+                combined_report = Path(info['output_path']) / \
+                    COMBINED_REPORT_PATH
+                report = Path(args.build_base) / PACKAGE_REPORT_FILENAME
+                if report.exists():
+                    report.unlink()
+                if combined_report.is_file():
+                    report.parent.mkdir(parents=True, exist_ok=True)
+                    shutil.copyfile(str(combined_report), str(report))
+                else:
+                    logger.warning(
+                        "No coverage report found in '{combined_report}'"
+                        .format_map(locals()))
+            return rc
+
+        # hold the memory until the server is shut down, the call
+        # determining the report uses the server as well
+        async with governor.reserve(args, self.context.pkg, bzl_cmd, env=env):
+            try:
+                rc = await run_bazel_command(
+                    args, self.context.pkg, bzl_cmd, invoke, env=env)
+            except AssertionError as e:
+                logger.error(
+                    'Failed to determine the Bazel output path: ' + str(e))
+                return 1
+        if rc and rc.returncode:
+            return rc.returncode
+        if report is None:
+            # the report of a batched invocation is merged by the package
+            # which ran it
+            return
+        if not report.is_file():
+            return
+
+        workspace_report = Path(args.build_base).parent / \
+            WORKSPACE_REPORT_FILENAME
+        add_to_workspace_report(report, workspace_report)
+        logger.info(
+            "Added coverage of '{args.path}' to '{workspace_report}'"
+            .format_map(locals()))
+
+
+def get_report_lock(output_base):
+    """
+    Get the lock of the combined coverage report of an output base.
+
+    :param str output_base: The output base
+    :rtype: asyncio.Lock
+    """
+    global _report_loop
+    # the locks are bound to the running loop
+    loop = asyncio.get_event_loop()
+    if _report_loop is not loop:
+        _report_locks.clear()
+        _report_loop = loop
+    lock = _report_locks.get(output_base)
+    if lock is None:
+        lock = _report_locks[output_base] = asyncio.Lock()
+    return lock
+
+
+def add_to_workspace_report(report, workspace_report):
+    """
+    Merge the coverage report of a package into the workspace report.
+
+    A workspace report left over from a previous invocation is replaced
+    instead of being merged.
+
+    :param Path report: The LCOV report of the package
+    :param Path workspace_report: The LCOV report of the workspace
+    """
+    inputs = [report]
+    if workspace_report in _started_reports and workspace_report.is_file():
+        inputs.insert(0, workspace_report)
+    _started_reports.add(workspace_report)
+    merge_lcov_reports(inputs, workspace_report)
+
+
+def merge_lcov_reports(reports, output):
+    """
+    Merge LCOV tracefiles.
+
+    The reports are read line by line and only the aggregated counters of
+    each source file are kept in memory.
+    Hits of the same line, function and branch are summed up.
+    The output is written atomically and may be one of the inputs.
+
+    :param list reports: The paths of the LCOV reports
+    :param Path output: The path of the merged report
+    """
+    sources = OrderedDict()
+    for report in reports:
+        with report.open('r', errors='replace') as h:
+            _read_lcov_records(h, sources)
+
+    tmp = output.parent / (output.name + '.tmp')
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with tmp.open('w') as h:
+        for source, record in sources.items():
+            _write_lcov_record(h, source, record)
+    os.replace(str(tmp), str(output))
+
+
+def _read_lcov_records(lines, sources):
+    record = None
+    for line in lines:
+        line = line.rstrip('\n')
+        key, _, value = line.partition(':')
+        if key == 'SF':
+            record = sources.setdefault(value, {
+                'FN': OrderedDict(), 'FNDA': {}, 'DA': OrderedDict(),
+                'BRDA': OrderedDict()})
+        elif record is None:
+            continue
+        elif line == 'end_of_record':
+            record = None
+        else:
+            try:
+                _read_lcov_line(key, value, record)
+            except ValueError:
+                logger.debug(
+                    "Skipping malformed LCOV line '{line}'"
+                    .format_map(locals()))
+
+
+def _read_lcov_line(key, value, record):
+    if key == 'FN':
+        # LCOV 2 adds the end line: FN:<start>,<end>,<name>
+        parts = value.split(',', 2)
+        int(parts[0])
+        if len(parts) == 3 and parts[1].isdigit():
+            line_number, name = parts[0] + ',' + parts[1], parts[2]
+        else:
+            line_number, name = value.split(',', 1)
+        record['FN'].setdefault(name, line_number)
+    elif key == 'FNDA':
+        hits, name = value.split(',', 1)
+        record['FNDA'][name] = record['FNDA'].get(name, 0) + int(hits)
+    elif key == 'DA':
+        line_number, hits = value.split(',')[:2]
+        line_number = int(line_number)
+        record['DA'][line_number] = \
+            record['DA'].get(line_number, 0) + int(hits)
+    elif key == 'BRDA':
+        # LCOV 2 allows an expression containing commas as the branch
+        parts = value.split(',')
+        if len(parts) < 4:
+            raise ValueError(value)
+        line_number, block, taken = parts[0], parts[1], parts[-1]
+        branch = ','.join(parts[2:-1])
+        branch_key = (int(line_number), block, branch)
+        # '-' marks a branch which was never evaluated
+        taken = None if taken == '-' else int(taken)
+        previous = record['BRDA'].get(branch_key)
+        if previous is not None:
+            taken = previous + (taken or 0)
+        record['BRDA'][branch_key] = taken
+
+
+def _write_lcov_record(h, source, record):
+    h.write('SF:{}\n'.format(source))
+    for name, line_number in record['FN'].items():
+        h.write('FN:{},{}\n'.format(line_number, name))
+    for name in record['FN']:
+        h.write('FNDA:{},{}\n'.format(record['FNDA'].get(name, 0), name))
+    h.write('FNF:{}\n'.format(len(record['FN'])))
+    h.write('FNH:{}\n'.format(
+        sum(1 for hits in record['FNDA'].values() if hits)))
+    for (line_number, block, branch), taken in sorted(
+        record['BRDA'].items()
+    ):
+        h.write('BRDA:{},{},{},{}\n'.format(
+            line_number, block, branch, '-' if taken is None else taken))
+    if record['BRDA']:
+        h.write('BRF:{}\n'.format(len(record['BRDA'])))
+        h.write('BRH:{}\n'.format(
+            sum(1 for taken in record['BRDA'].values() if taken)))
+    for line_number, hits in sorted(record['DA'].items()):
+        h.write('DA:{},{}\n'.format(line_number, hits))
+    h.write('LF:{}\n'.format(len(record['DA'])))
+    h.write('LH:{}\n'.format(
+        sum(1 for hits in record['DA'].values() if hits)))
+    h.write('end_of_record\n')
@@ -0,0 +1,184 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+from collections import OrderedDict
+import json
+import os
+from pathlib import Path
+
+from colcon_bazel.task.bazel.file_state import get_file_state_database
+from colcon_bazel.task.bazel.output_base import get_cache_base
+from colcon_core.logging import colcon_logger
+from colcon_core.shell import get_command_environment
+
+logger = colcon_logger.getChild(__name__)
+
+ENVIRONMENT_CACHE_DIRNAME = 'environment'
+
+# Variables passed to Bazel with a minimal environment, besides the ones
+# set or changed by the dependencies
+MINIMAL_ENVIRONMENT_VARIABLES = (
+    'BAZEL_COMMAND', 'BAZEL_HOME', 'HOME', 'LANG', 'LC_ALL', 'LC_CTYPE',
+    'LOGNAME', 'PATH', 'SHELL', 'SYSTEMROOT', 'TEMP', 'TMP', 'TMPDIR',
+    'USER', 'USERPROFILE',
+)
+
+# Variables set by the shell computing the environment, which would make
+# the environment specific to the build base of a package
+SHELL_VARIABLES = ('OLDPWD', 'PWD', 'SHLVL', '_')
+
+# The computed environments by cache key
+_environments = {}
+
+
+async def get_environment(task_name, args, dependencies):
+    """
+    Get the environment variables to invoke Bazel.
+
+    Sourcing the environment scripts of the dependencies is costly, the
+    result is therefore cached on disk and shared by all tasks and
+    packages with the same dependencies.
+    The cache key covers the ordered dependencies, the content of their
+    hook files in the install space and the environment of this process.
+    Reinstalling a dependency with different hooks therefore invalidates
+    the cached environment.
+    Only the variables set, changed or unset by the dependencies are
+    cached, the others are taken from the environment of this process.
+
+    :param str task_name: The task name, e.g. `build`
+    :param args: Arguments of package descriptor.
+    :param dependencies: The ordered dictionary mapping dependency names to
+      their paths
+    :returns: The environment, a minimal one if requested by the arguments
+    :rtype: dict
+    :raises RuntimeError: if no shell extension can compute the environment
+    """
+    key = get_environment_key(args, dependencies)
+    env = _environments.get(key)
+    if env is None:
+        path = get_cache_base(args) / ENVIRONMENT_CACHE_DIRNAME / (
+            key + '.json')
+        env = _load_environment(path)
+        if env is None:
+            env = await get_command_environment(
+                task_name, args.build_base, dependencies)
+            for name in SHELL_VARIABLES:
+                if name in os.environ:
+                    env[name] = os.environ[name]
+                else:
+                    env.pop(name, None)
+            _save_environment(path, env)
+        _environments[key] = env
+
+    if getattr(args, 'bazel_minimal_env', False):
+        return get_minimal_environment(env)
+    return dict(env)
+
+
+def get_environment_key(args, dependencies):
+    """
+    Get the cache key of the environment of dependencies.
+
+    :param args: Arguments of package descriptor.
+    :param dependencies: The ordered dictionary mapping dependency names to
+      their paths
+    :rtype: str
+    """
+    dependencies = OrderedDict(dependencies or ())
+    extra = [
+        '{}={}'.format(name, path) for name, path in dependencies.items()]
+    extra += sorted(
+        '{}={}'.format(name, value) for name, value in os.environ.items())
+    paths = []
+    for name, path in dependencies.items():
+        paths += get_hook_files(name, path)
+    with get_file_state_database(args) as database:
+        return database.get_fingerprint(paths, extra=extra)
+
+
+def get_hook_files(name, path):
+    """
+    Get the files in the install space defining the environment of a package.
+
+    Only the scripts sourced by the environment scripts are considered, other
+    installed resources of the package don't affect the environment.
+
+    :param str name: The name of the package
+    :param str path: The install prefix of the package
+    :returns: The package scripts and hooks, the prefix scripts and the
+      package marker, including the expected `package.sh` even if it doesn't
+      exist
+    :rtype: list
+    """
+    prefix = Path(path)
+    share = prefix / 'share'
+    files = {
+        share / name / 'package.sh',
+        share / 'colcon-core' / 'packages' / name}
+    files.update(prefix.glob('local_setup.*'))
+    files.update(
+        p for p in (share / name).glob('package.*') if p.is_file())
+    files.update(
+        p for p in (share / name / 'hook').glob('*') if p.is_file())
+    return sorted(files)
+
+
+def get_minimal_environment(env):
+    """
+    Reduce an environment to the variables relevant to Bazel.
+
+    The variables not set or changed by the dependencies are dropped except
+    for a few essential ones.
+    Unrelated changes of the environment of the invocation therefore don't
+    affect Bazel.
+
+    :param dict env: The environment including the dependencies
+    :rtype: dict
+    """
+    return {
+        name: value for name, value in sorted(env.items())
+        if name in MINIMAL_ENVIRONMENT_VARIABLES or
+        os.environ.get(name) != value}
+
+
+def clear_environment_cache():
+    """Forget the environments computed in this process."""
+    _environments.clear()
+
+
+def _load_environment(path):
+    try:
+        changes = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(changes, dict) or \
+            not isinstance(changes.get('set'), dict) or \
+            not isinstance(changes.get('unset'), list):
+        return None
+    logger.debug(
+        "Using cached environment from '{path}'".format_map(locals()))
+    env = dict(os.environ)
+    env.update(changes['set'])
+    for name in changes['unset']:
+        env.pop(name, None)
+    return env
+
+
+def _save_environment(path, env):
+    # the environment of this process is part of the cache key, storing
+    # only the changes keeps e.g. credentials out of the build directory
+    changes = {
+        'set': {
+            name: value for name, value in env.items()
+            if os.environ.get(name) != value},
+        'unset': sorted(set(os.environ) - set(env)),
+    }
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.parent / (path.name + '.{}.tmp'.format(os.getpid()))
+        tmp.write_text(json.dumps(changes, sort_keys=True))
+        os.replace(str(tmp), str(path))
+    except OSError as e:
+        logger.warning(
+            "Failed to cache the environment in '{path}': {e}".format(
+                path=path, e=e))
@@ -0,0 +1,371 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+from collections import OrderedDict
+import json
+import os
+import statistics
+
+from colcon_bazel.task.bazel import BZL_BUILD_COMMANDS
+from colcon_bazel.task.bazel import has_bazel_option
+from colcon_bazel.task.bazel.output_base import get_cache_base
+from colcon_core.logging import colcon_logger
+
+logger = colcon_logger.getChild(__name__)
+
+BZL_JOBS = '--jobs'
+BZL_SPAWN_STRATEGY = '--spawn_strategy'
+BZL_STRATEGY = '--strategy'
+BZL_WORKER_MAX_INSTANCES = '--worker_max_instances'
+
+# Metadata of a package descriptor, e.g. set in a colcon.pkg file, selecting
+# the execution profile of the package
+PROFILE_METADATA = 'bazel_profile'
+# Metadata of a package descriptor overriding the execution limits
+JOBS_METADATA = 'bazel_jobs'
+WORKER_INSTANCES_METADATA = 'bazel_worker_instances'
+
+# Select the fastest profile based on the recorded run times
+PROFILE_AUTO = 'auto'
+
+# The flags of the execution profiles by name
+EXECUTION_PROFILES = OrderedDict([
+    ('sandboxed', (BZL_SPAWN_STRATEGY + '=sandboxed', )),
+    ('local-fast', (BZL_SPAWN_STRATEGY + '=local', )),
+    ('persistent-workers', (BZL_SPAWN_STRATEGY + '=worker,sandboxed', )),
+])
+
+HISTORY_FILENAME = 'execution_profiles.json'
+BUILD_EVENTS_FILENAME = 'bazel_build_events.json'
+
+# The number of informative runs of each profile before the auto-tuning
+# settles
+MIN_SAMPLES = 3
+# The number of recent runs of each profile which are kept
+MAX_SAMPLES = 5
+# Every n-th informative run uses the least recently run profile, the
+# relative speed of the profiles changes with the package
+RESAMPLE_INTERVAL = 10
+
+
+def add_profile_arguments(parser):
+    """
+    Add the arguments to select the execution profile and limits.
+
+    :param parser: The argument parser
+    """
+    parser.add_argument(
+        '--bazel-profile',
+        choices=list(EXECUTION_PROFILES) + [PROFILE_AUTO],
+        help='Execute the actions of Bazel packages with a named profile or '
+        "with the fastest one recorded for each package ('auto'), the "
+        "'{PROFILE_METADATA}' metadata of a package takes precedence"
+        .format_map(globals()))
+    parser.add_argument(
+        '--bazel-jobs',
+        type=int, metavar='N',
+        help='The number of concurrent Bazel jobs of each package, the '
+        "'{JOBS_METADATA}' metadata of a package takes precedence"
+        .format_map(globals()))
+    parser.add_argument(
+        '--bazel-worker-instances',
+        type=int, metavar='N',
+        help='The number of instances of each persistent worker of Bazel, '
+        "the '{WORKER_INSTANCES_METADATA}' metadata of a package takes "
+        'precedence'.format_map(globals()))
+
+
+def get_profile_name(args, pkg):
+    """
+    Get the execution profile selected for a package.
+
+    :param args: Arguments of package descriptor.
+    :param pkg: The package descriptor
+    :returns: The profile name, `auto` or None if not selected
+    :rtype: str
+    """
+    name = pkg.metadata.get(PROFILE_METADATA) or \
+        getattr(args, 'bazel_profile', None)
+    if name is None or name == PROFILE_AUTO or name in EXECUTION_PROFILES:
+        return name
+    logger.warning(
+        "Unknown Bazel execution profile '{name}' of package '{pkg.name}', "
+        'choose one of: {choices}'.format(
+            name=name, pkg=pkg, choices=', '.join(
+                list(EXECUTION_PROFILES) + [PROFILE_AUTO])))
+    return None
+
+
+def apply_execution_profile(bazel_command, profile):
+    """
+    Add the flags of an execution profile to a Bazel command line.
+
+    The profile isn't applied if the command doesn't execute actions or the
+    user passes an execution strategy explicitly.
+
+    :param BazelCommand bazel_command: The command line
+    :param str profile: The profile name
+    :returns: The command line and the applied profile, None if it wasn't
+      applied
+    :rtype: tuple
+    """
+    if profile is None or bazel_command.command not in BZL_BUILD_COMMANDS:
+        return bazel_command, None
+    if has_bazel_option(bazel_command.flags, BZL_SPAWN_STRATEGY) or \
+            has_bazel_option(bazel_command.flags, BZL_STRATEGY):
+        return bazel_command, None
+    return bazel_command.with_flags(*EXECUTION_PROFILES[profile]), profile
+
+
+class ProfileHistory:
+    """
+    The run times of the Bazel commands of packages by execution profile.
+
+    The times are recorded per package and task since e.g. building and
+    testing a package can favor different profiles.
+    Each sample is the duration of the execution phase per executed action,
+    which makes cold and incremental runs comparable.
+    Runs which didn't execute any action aren't informative and must not be
+    recorded.
+    """
+
+    def __init__(self, path):
+        """
+        Load the history.
+
+        :param Path path: The history file
+        """
+        self.path = path
+        try:
+            self.packages = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            self.packages = {}
+        if not isinstance(self.packages, dict):
+            self.packages = {}
+
+    def get_samples(self, package, task):
+        """
+        Get the recorded samples of a task of a package.
+
+        :param str package: The package name
+        :param str task: The task, e.g. `build`
+        :returns: The seconds per executed action by profile name
+        :rtype: dict
+        """
+        return {
+            name: profile['samples'] for name, profile in
+            self._get_entry(package, task)['profiles'].items()}
+
+    def select(self, package, task):
+        """
+        Select the profile to use for a task of a package.
+
+        Each profile is tried until it has a few samples, afterwards the
+        profile with the lowest median is used.
+        Every few runs the least recently run profile is sampled again.
+
+        :param str package: The package name
+        :param str task: The task, e.g. `build`
+        :returns: The profile name
+        :rtype: str
+        """
+        entry = self._get_entry(package, task)
+        profiles = entry['profiles']
+        for name in EXECUTION_PROFILES:
+            if len(profiles.get(name, {}).get('samples', ())) < MIN_SAMPLES:
+                return name
+        if entry['runs'] % RESAMPLE_INTERVAL == 0:
+            return min(
+                EXECUTION_PROFILES,
+                key=lambda name: profiles[name]['last_run'])
+        return min(
+            EXECUTION_PROFILES,
+            key=lambda name: statistics.median(profiles[name]['samples']))
+
+    def add(self, package, task, profile, seconds_per_action):
+        """
+        Record an informative run of a task of a package.
+
+        :param str package: The package name
+        :param str task: The task, e.g. `build`
+        :param str profile: The profile name
+        :param float seconds_per_action: The duration of the execution phase
+          per executed action
+        """
+        entry = self._get_entry(package, task)
+        entry['runs'] += 1
+        data = entry['profiles'].setdefault(
+            profile, {'samples': [], 'last_run': 0})
+        data['samples'].append(round(seconds_per_action, 6))
+        del data['samples'][:-MAX_SAMPLES]
+        data['last_run'] = entry['runs']
+
+    def save(self):
+        """Write the history file."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.parent / (
+            self.path.name + '.{}.tmp'.format(os.getpid()))
+        tmp.write_text(json.dumps(self.packages, indent=2, sort_keys=True))
+        os.replace(str(tmp), str(self.path))
+
+    def _get_entry(self, package, task):
+        tasks = self.packages.setdefault(package, {})
+        entry = tasks.get(task)
+        if not isinstance(entry, dict) or \
+                not isinstance(entry.get('profiles'), dict):
+            # discard entries of an unknown format
+            entry = tasks[task] = {'runs': 0, 'profiles': {}}
+        return entry
+
+
+def get_execution_metrics(build_events):
+    """
+    Get the executed actions and the execution time from the build events.
+
+    :param str build_events: The file written with `--build_event_json_file`
+    :returns: The number of executed actions and the duration of the
+      execution phase in seconds, the latter is None if Bazel doesn't
+      report it.
+      None if the build events don't contain the build metrics.
+    :rtype: tuple
+    """
+    try:
+        h = open(str(build_events), 'r', errors='replace')
+    except OSError:
+        return None
+    metrics = None
+    with h:
+        for line in h:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if 'buildMetrics' in event.get('id', {}):
+                metrics = event.get('buildMetrics', {})
+    if metrics is None:
+        return None
+    try:
+        actions = int(
+            metrics.get('actionSummary', {}).get('actionsExecuted', 0))
+        milliseconds = metrics.get('timingMetrics', {}).get(
+            'executionPhaseTimeInMs')
+        seconds = int(milliseconds) / 1000 if milliseconds else None
+    except (AttributeError, TypeError, ValueError):
+        return None
+    return actions, seconds
+
+
+def get_profile_history(args):
+    """
+    Get the execution profile history shared by all packages.
+
+    :param args: Arguments of package descriptor.
+    :rtype: ProfileHistory
+    """
+    return ProfileHistory(get_cache_base(args) / HISTORY_FILENAME)
+
+
+def select_execution_profile(args, pkg, task):
+    """
+    Select the execution profile of a task of a package.
+
+    :param args: Arguments of package descriptor.
+    :param pkg: The package descriptor
+    :param str task: The task, e.g. `build`
+    :returns: The profile name, None if no profile is selected
+    :rtype: str
+    """
+    name = get_profile_name(args, pkg)
+    if name != PROFILE_AUTO:
+        return name
+    name = get_profile_history(args).select(pkg.name, task)
+    logger.info(
+        "Using Bazel execution profile '{name}' for package '{pkg.name}'"
+        .format_map(locals()))
+    return name
+
+
+def is_auto_tuned(args, pkg):
+    """
+    Check if the execution profile of a package is tuned automatically.
+
+    :param args: Arguments of package descriptor.
+    :param pkg: The package descriptor
+    :rtype: bool
+    """
+    return get_profile_name(args, pkg) == PROFILE_AUTO
+
+
+def apply_execution_limits(bazel_command, args, pkg):
+    """
+    Add the configured number of jobs and worker instances.
+
+    The metadata of the package takes precedence over the arguments, the
+    flags passed by the user take precedence over both.
+
+    :param BazelCommand bazel_command: The command line
+    :param args: Arguments of package descriptor.
+    :param pkg: The package descriptor
+    :rtype: BazelCommand
+    """
+    if bazel_command.command not in BZL_BUILD_COMMANDS:
+        return bazel_command
+    flags = []
+    for flag, metadata, attribute in (
+        (BZL_JOBS, JOBS_METADATA, 'bazel_jobs'),
+        (BZL_WORKER_MAX_INSTANCES, WORKER_INSTANCES_METADATA,
+         'bazel_worker_instances'),
+    ):
+        value = pkg.metadata.get(metadata)
+        if value is None:
+            value = getattr(args, attribute, None)
+        if value is None or has_bazel_option(bazel_command.flags, flag):
+            continue
+        try:
+            value = int(value)
+        except ValueError:
+            logger.warning(
+                "Invalid '{metadata}' metadata '{value}' of package "
+                "'{pkg.name}'".format_map(locals()))
+            continue
+        flags.append('{flag}={value}'.format_map(locals()))
+    return bazel_command.with_flags(*flags)
+
+
+def record_execution_profile(
+    args, pkg, task, profile, seconds, build_events
+):
+    """
+    Record a run of a task of a package using a profile.
+
+    Runs which didn't execute any action, e.g. because all outputs were
+    cached, are skipped.
+
+    :param args: Arguments of package descriptor.
+    :param pkg: The package descriptor
+    :param str task: The task, e.g. `build`
+    :param str profile: The profile name
+    :param float seconds: The wall time of the Bazel command, used if the
+      build events don't report the duration of the execution phase
+    :param str build_events: The build events of the run
+    """
+    metrics = get_execution_metrics(build_events)
+    if metrics is None or not metrics[0]:
+        logger.debug(
+            "Not recording the Bazel execution profile '{profile}' of "
+            "package '{pkg.name}' since no actions were executed"
+            .format_map(locals()))
+        return
+    actions, execution_seconds = metrics
+    if execution_seconds is None:
+        execution_seconds = seconds
+
+    # reload the history to keep the times recorded by other packages
+    history = get_profile_history(args)
+    history.add(pkg.name, task, profile, execution_seconds / actions)
+    try:
+        history.save()
+    except OSError as e:
+        logger.warning(
+            'Failed to record the Bazel execution profile history in '
+            "'{path}': {e}".format(path=history.path, e=e))
@@ -0,0 +1,145 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+import hashlib
+import os
+import sqlite3
+import time
+
+from colcon_bazel.task.bazel.output_base import get_cache_base
+
+DATABASE_FILENAME = 'file_state.sqlite3'
+
+# Files modified more recently might still change within the resolution of
+# the file system timestamps, their hash isn't recorded
+MIN_AGE_NS = 2 * 10 ** 9
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS files ('
+    'path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, hash TEXT)',
+    'CREATE TABLE IF NOT EXISTS packages ('
+    'name TEXT PRIMARY KEY, fingerprint TEXT)',
+)
+
+
+class FileStateDatabase:
+    """
+    Database of the state of source files.
+
+    For each file the modification time, size and content hash are
+    recorded.
+    A file is only hashed again if its modification time or size changed,
+    checking if the files of a package changed therefore mostly requires
+    a `stat` call per file.
+    The database also records the fingerprint of each package at its last
+    successful build.
+    """
+
+    def __init__(self, path):
+        """
+        Construct a file state database.
+
+        :param Path path: The path of the SQLite database
+        """
+        self.path = path
+        self._connection = None
+
+    def __enter__(self):  # noqa: D105
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # packages built in parallel share the database
+        self._connection = sqlite3.connect(str(self.path), timeout=60)
+        for statement in _SCHEMA:
+            self._connection.execute(statement)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):  # noqa: D105
+        if exc_type is None:
+            self._connection.commit()
+        self._connection.close()
+        self._connection = None
+
+    def get_hash(self, path):
+        """
+        Get the content hash of a file.
+
+        :param Path path: The path of the file
+        :returns: The hash, None if the file doesn't exist
+        :rtype: str
+        """
+        try:
+            st = os.stat(str(path))
+        except OSError:
+            return None
+        row = self._connection.execute(
+            'SELECT mtime_ns, size, hash FROM files WHERE path = ?',
+            (str(path), )).fetchone()
+        if row is not None and row[:2] == (st.st_mtime_ns, st.st_size):
+            return row[2]
+
+        digest = hashlib.sha256()
+        try:
+            with open(str(path), 'rb') as h:
+                for chunk in iter(lambda: h.read(1024 * 1024), b''):
+                    digest.update(chunk)
+        except OSError:
+            return None
+        file_hash = digest.hexdigest()
+        if time.time() * 10 ** 9 - st.st_mtime_ns >= MIN_AGE_NS:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                (str(path), st.st_mtime_ns, st.st_size, file_hash))
+        return file_hash
+
+    def get_fingerprint(self, paths, *, extra=()):
+        """
+        Get a fingerprint of the content of files.
+
+        :param paths: The paths of the files
+        :param extra: Additional strings to include, e.g. the command line
+        :rtype: str
+        """
+        digest = hashlib.sha256()
+        for value in extra:
+            digest.update(value.encode() + b'\0')
+        for path in sorted(str(p) for p in paths):
+            digest.update(
+                '{}\0{}\0'.format(path, self.get_hash(path)).encode())
+        return digest.hexdigest()
+
+    def get_package_fingerprint(self, name):
+        """
+        Get the fingerprint of a package at its last successful build.
+
+        :param str name: The name of the package
+        :returns: The fingerprint, None if unknown
+        :rtype: str
+        """
+        row = self._connection.execute(
+            'SELECT fingerprint FROM packages WHERE name = ?',
+            (name, )).fetchone()
+        return row[0] if row is not None else None
+
+    def set_package_fingerprint(self, name, fingerprint):
+        """
+        Record the fingerprint of a package.
+
+        :param str name: The name of the package
+        :param str fingerprint: The fingerprint, None to forget it
+        """
+        if fingerprint is None:
+            self._connection.execute(
+                'DELETE FROM packages WHERE name = ?', (name, ))
+            return
+        self._connection.execute(
+            'INSERT OR REPLACE INTO packages VALUES (?, ?)',
+            (name, fingerprint))
+
+
+def get_file_state_database(args):
+    """
+    Get the file state database shared by all packages of the workspace.
+
+    :param args: Arguments of package descriptor.
+    :rtype: FileStateDatabase
+    """
+    return FileStateDatabase(get_cache_base(args) / DATABASE_FILENAME)
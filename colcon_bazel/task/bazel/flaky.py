@@ -0,0 +1,217 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+from collections import OrderedDict
+import json
+import os
+from pathlib import Path
+import re
+from xml.etree import ElementTree
+
+from colcon_core.logging import colcon_logger
+
+logger = colcon_logger.getChild(__name__)
+
+BZL_BUILD_EVENT_JSON_FILE = '--build_event_json_file'
+BZL_FLAKY_TEST_ATTEMPTS = '--flaky_test_attempts'
+
+# Exit code of Bazel if the build succeeded but tests failed
+BZL_EXIT_TESTS_FAILED = 3
+
+BUILD_EVENTS_FILENAME = 'bazel_test_events.json'
+HISTORY_FILENAME = 'bazel_test_history.json'
+
+STATUS_PASSED = 'PASSED'
+STATUS_FLAKY = 'FLAKY'
+STATUS_FAILED = 'FAILED'
+
+
+def get_test_results(build_events):
+    """
+    Get the status of each test target from the Build Event Protocol.
+
+    The overall status of a test summary takes precedence over the status
+    of the individual test attempts.
+
+    :param Path build_events: The file written with
+      `--build_event_json_file`
+    :returns: The status by target label, e.g. `PASSED` or `FAILED`
+    :rtype: OrderedDict
+    """
+    results = OrderedDict()
+    summaries = {}
+    try:
+        h = Path(build_events).open('r', errors='replace')
+    except OSError:
+        return results
+    with h:
+        for line in h:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            event_id = event.get('id', {})
+            if 'testResult' in event_id:
+                label = event_id['testResult'].get('label')
+                status = event.get('testResult', {}).get('status')
+                # the status of the last attempt of a target is reported
+                # last
+                if label and status:
+                    results[label] = status
+            elif 'testSummary' in event_id:
+                label = event_id['testSummary'].get('label')
+                status = event.get('testSummary', {}).get('overallStatus')
+                if label and status:
+                    summaries[label] = status
+    results.update(summaries)
+    return results
+
+
+def get_test_results_from_xml(testlogs, since=None):
+    """
+    Get the status of each test target from the `test.xml` files.
+
+    :param Path testlogs: The `bazel-testlogs` directory
+    :param float since: Ignore files modified before this time (seconds
+      since the epoch)
+    :returns: The status by target label, either `PASSED` or `FAILED`
+    :rtype: OrderedDict
+    """
+    results = OrderedDict()
+    testlogs = Path(testlogs)
+    for dirpath, dirnames, filenames in os.walk(str(testlogs)):
+        dirnames.sort()
+        if 'test.xml' not in filenames:
+            continue
+        path = Path(dirpath) / 'test.xml'
+        try:
+            if since is not None and path.stat().st_mtime < since:
+                continue
+            root = ElementTree.parse(str(path)).getroot()
+        except (OSError, ElementTree.ParseError):
+            continue
+        failed = any(
+            int(element.get('failures') or 0) or
+            int(element.get('errors') or 0)
+            for element in root.iter()
+            if element.tag in ('testsuites', 'testsuite'))
+        # shards and runs are stored in sub-directories of the target
+        relative = Path(dirpath).relative_to(testlogs).parts
+        relative = [
+            part for part in relative
+            if not re.match(r'^(shard|run)_\d+_of_\d+$', part)]
+        if not relative:
+            continue
+        label = '//{}:{}'.format('/'.join(relative[:-1]), relative[-1])
+        if results.get(label) != STATUS_FAILED:
+            results[label] = STATUS_FAILED if failed else STATUS_PASSED
+    return results
+
+
+def get_test_results_from_output_path(output_path, since=None):
+    """
+    Get the status of each test target from the `test.xml` files.
+
+    The test logs of each configuration are in a separate directory, e.g.
+    `k8-opt/testlogs` if the tests were run with `-c opt`.
+    All of them are considered since the configuration depends on the
+    flags, the rc files and transitions of the targets.
+
+    :param Path output_path: The `output_path` reported by `bazel info`
+    :param float since: Ignore files modified before this time (seconds
+      since the epoch)
+    :returns: The status by target label, either `PASSED` or `FAILED`
+    :rtype: OrderedDict
+    """
+    results = OrderedDict()
+    for testlogs in sorted(Path(output_path).glob('*/testlogs')):
+        for label, status in get_test_results_from_xml(
+            testlogs, since=since
+        ).items():
+            if results.get(label) != STATUS_FAILED:
+                results[label] = status
+    return results
+
+
+def get_failed_targets(results):
+    """
+    Get the test targets which didn't pass.
+
+    :param dict results: The status by target label
+    :rtype: list
+    """
+    return [
+        label for label, status in results.items()
+        if status not in (STATUS_PASSED, STATUS_FLAKY)]
+
+
+def get_flaky_test_attempts_flags(labels, attempts):
+    """
+    Get the flags to retry specific test targets within Bazel.
+
+    :param labels: The labels of the test targets
+    :param int attempts: The number of attempts of each target
+    :rtype: list
+    """
+    return [
+        '{BZL_FLAKY_TEST_ATTEMPTS}=^{label}$@{attempts}'.format(
+            BZL_FLAKY_TEST_ATTEMPTS=BZL_FLAKY_TEST_ATTEMPTS,
+            label=re.escape(label), attempts=attempts)
+        for label in labels]
+
+
+class FlakinessHistory:
+    """
+    The history of the test results of the targets of a package.
+
+    For each target the number of runs, failed runs and flaky runs, which
+    passed only when retried, are recorded.
+    """
+
+    def __init__(self, path):
+        """
+        Load the history.
+
+        :param Path path: The history file
+        """
+        self.path = Path(path)
+        try:
+            self.targets = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            self.targets = {}
+
+    def get_flaky_targets(self):
+        """
+        Get the targets which were flaky before.
+
+        :rtype: list
+        """
+        return sorted(
+            label for label, counts in self.targets.items()
+            if counts.get('flaky'))
+
+    def add_results(self, attempts):
+        """
+        Add the results of a test run.
+
+        :param list attempts: The status by target label of each attempt,
+          the later attempts only contain the retried targets
+        """
+        failed_before = set()
+        for results in attempts:
+            for label, status in results.items():
+                counts = self.targets.setdefault(
+                    label, {'runs': 0, 'failures': 0, 'flaky': 0})
+                counts['runs'] += 1
+                if status not in (STATUS_PASSED, STATUS_FLAKY):
+                    counts['failures'] += 1
+                    failed_before.add(label)
+                elif status == STATUS_FLAKY or label in failed_before:
+                    counts['flaky'] += 1
+
+    def save(self):
+        """Write the history file."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.parent / (self.path.name + '.tmp')
+        tmp.write_text(json.dumps(self.targets, indent=2, sort_keys=True))
+        os.replace(str(tmp), str(self.path))
@@ -0,0 +1,298 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+import asyncio
+import json
+import os
+from pathlib import Path
+import shutil
+
+from colcon_bazel.task.bazel.client import get_bazel_client
+from colcon_core.logging import colcon_logger
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+logger = colcon_logger.getChild(__name__)
+
+# Linux ioctl to share the extents of a file (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+MANIFEST_FILENAME = 'bazel_install_manifest.json'
+
+LIBRARY_SUFFIXES = ('.a', '.dll', '.dylib', '.jar', '.lib', '.so')
+
+
+def get_install_query(target_patterns):
+    """
+    Get the query expression of the targets whose outputs are installed.
+
+    Test rules are excluded since their outputs are only used by
+    `bazel test`.
+    They are matched by their kind since cquery doesn't support the `tests`
+    function.
+
+    :param target_patterns: The target patterns, patterns starting with `-`
+      are subtracted
+    :returns: The expression, e.g.
+      `let targets = "//..." - "//a/..." in
+      $targets except kind(".*_test rule", $targets)`
+    :rtype: str
+    """
+    targets = ''
+    for pattern in target_patterns:
+        if pattern.startswith('-'):
+            if targets:
+                targets += ' - "{}"'.format(pattern[1:])
+        else:
+            targets += (' + ' if targets else '') + '"{}"'.format(pattern)
+    return 'let targets = {targets} in ' \
+        '$targets except kind(".*_test rule", $targets)'.format_map(locals())
+
+
+async def get_output_files(bazel_command, *, cwd, env=None):
+    """
+    Get the output files of the Bazel targets except tests.
+
+    The files are determined with `bazel cquery --output=files` which
+    reports them relative to the execution root.
+
+    :param BazelCommand bazel_command: The build command, its flags are
+      used to match the configuration of the build
+    :param str cwd: The working directory
+    :param dict env: The environment
+    :returns: The absolute paths of the existing output files
+    :rtype: list
+    """
+    client = get_bazel_client()
+    cquery_command = bazel_command.replace(
+        command='cquery', target_patterns=[
+            get_install_query(bazel_command.target_patterns)]
+    ).with_flags('--output=files')
+    info, output = await asyncio.gather(
+        client.get_info(bazel_command, ['execution_root'], cwd=cwd, env=env),
+        client.query(cquery_command, cwd=cwd, env=env))
+    execution_root = Path(info['execution_root'])
+
+    files = []
+    for line in output.decode().splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        path = execution_root / line
+        # skip source files and outputs of targets which weren't built
+        if line.startswith('bazel-out') and path.is_file():
+            files.append(path)
+    return files
+
+
+def get_install_destination(path, pkg_name, *, package_path=None):
+    """
+    Get the destination of an output file relative to the install prefix.
+
+    Libraries are installed into `lib`, executables into `bin` and all other
+    files into `share/<pkg_name>`.
+    The latter keep their path relative to the package to avoid collisions
+    of files with the same name in different subpackages.
+    The runfiles of an executable are installed next to it, see
+    :func:`get_runfiles`.
+
+    :param Path path: The output file
+    :param str pkg_name: The name of the package
+    :param str package_path: The path of the package relative to the
+      workspace root, e.g. `a/b`
+    :rtype: Path
+    """
+    name = path.name
+    if name.endswith(LIBRARY_SUFFIXES) or '.so.' in name:
+        return Path('lib') / name
+    if not path.suffix and os.access(str(path), os.X_OK):
+        return Path('bin') / name
+    return Path('share') / pkg_name / get_package_relative_path(
+        path, package_path)
+
+
+def get_package_relative_path(path, package_path=None):
+    """
+    Get the path of an output file relative to its package.
+
+    :param Path path: The output file, e.g. `bazel-out/k8-opt/bin/a/b/c.txt`
+    :param str package_path: The path of the package relative to the
+      workspace root, e.g. `a/b`
+    :returns: The path relative to the package, e.g. `c.txt`, the path
+      relative to the output directory of the configuration if the file
+      isn't an output of the package, the file name if the file isn't an
+      output at all
+    :rtype: Path
+    """
+    parts = path.parts
+    try:
+        index = len(parts) - 1 - parts[::-1].index('bazel-out')
+    except ValueError:
+        return Path(path.name)
+    # skip the configuration and the `bin` directory
+    relative = parts[index + 3:]
+    if not relative:
+        return Path(path.name)
+    prefix = Path(package_path or '.').parts
+    if prefix and tuple(relative[:len(prefix)]) == prefix and \
+            len(relative) > len(prefix):
+        relative = relative[len(prefix):]
+    return Path(*relative)
+
+
+def get_runfiles(path):
+    """
+    Get the runfiles of an executable.
+
+    Executables like `py_binary` or `sh_binary` targets with data find their
+    runfiles in the `<name>.runfiles` directory next to them.
+
+    :param Path path: The executable
+    :returns: The files of the runfiles tree and their paths relative to the
+      directory containing the tree
+    :rtype: list
+    """
+    runfiles = path.parent / (path.name + '.runfiles')
+    if not runfiles.is_dir():
+        return []
+    files = []
+    for dirpath, dirnames, filenames in os.walk(
+        str(runfiles), followlinks=True
+    ):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            src = Path(dirpath) / filename
+            # the symlink tree may contain dangling links
+            if src.is_file():
+                files.append((src, src.relative_to(path.parent)))
+    return files
+
+
+def install_files(
+    files, install_base, pkg_name, manifest_path, *, package_path=None,
+    symlink=False
+):
+    """
+    Install output files into the install prefix.
+
+    Files are reflinked or hardlinked where the filesystem supports it and
+    copied otherwise.
+    Executables are installed together with their runfiles.
+    A manifest of the installed files allows skipping the files which didn't
+    change since the last installation and removing files which aren't
+    produced anymore.
+
+    :param list files: The output files
+    :param str install_base: The install prefix
+    :param str pkg_name: The name of the package
+    :param Path manifest_path: The path of the manifest
+    :param str package_path: The path of the package relative to the
+      workspace root
+    :param bool symlink: The flag if the files should be symlinked instead
+    :returns: The number of installed and skipped files
+    :rtype: tuple
+    :raises OSError: if a file can't be installed
+    """
+    install_base = Path(install_base)
+    old_manifest = _read_manifest(manifest_path)
+    manifest = {}
+    installed = skipped = 0
+
+    destinations = []
+    for src in files:
+        dst = get_install_destination(
+            src, pkg_name, package_path=package_path)
+        destinations.append((src, dst))
+        if dst.parts[0] == 'bin':
+            destinations += [
+                (runfile, dst.parent / relative)
+                for runfile, relative in get_runfiles(src)]
+
+    for src, dst in destinations:
+        key = dst.as_posix()
+        if key in manifest:
+            logger.warning(
+                "Skipping '{src}', '{dst}' is already installed from "
+                "'{other}'".format(src=src, dst=dst, other=manifest[key][0]))
+            continue
+        state = _get_state(src, symlink)
+        manifest[key] = state
+        dst = install_base / dst
+        if old_manifest.get(key) == state and os.path.lexists(str(dst)):
+            skipped += 1
+            continue
+        _place_file(src, dst, symlink)
+        installed += 1
+
+    # remove files which were installed before but aren't anymore
+    for key in set(old_manifest) - set(manifest):
+        dst = install_base / key
+        if os.path.lexists(str(dst)):
+            os.remove(str(dst))
+
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    manifest_path.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+    return installed, skipped
+
+
+def is_installed(install_base, manifest_path):
+    """
+    Check if all files of the last installation are still installed.
+
+    :param str install_base: The install prefix
+    :param Path manifest_path: The path of the manifest
+    :rtype: bool
+    """
+    if not manifest_path.is_file():
+        return False
+    return all(
+        os.path.lexists(str(Path(install_base) / key))
+        for key in _read_manifest(manifest_path))
+
+
+def _get_state(src, symlink):
+    stat = src.stat()
+    return [str(src), stat.st_size, stat.st_mtime_ns, stat.st_ino, symlink]
+
+
+def _read_manifest(manifest_path):
+    try:
+        return json.loads(manifest_path.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def _place_file(src, dst, symlink):
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if os.path.lexists(str(dst)):
+        os.remove(str(dst))
+    if symlink:
+        os.symlink(str(src), str(dst))
+        return
+    if _reflink(src, dst):
+        return
+    if not src.is_symlink():
+        # a hardlink of a runfiles symlink would be one of the source file
+        try:
+            os.link(str(src), str(dst))
+            return
+        except OSError:
+            pass
+    shutil.copy2(str(src), str(dst))
+
+
+def _reflink(src, dst):
+    if fcntl is None:
+        return False
+    try:
+        with src.open('rb') as f_src, dst.open('wb') as f_dst:
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+    except OSError:
+        if dst.exists():
+            dst.unlink()
+        return False
+    shutil.copymode(str(src), str(dst))
+    return True
@@ -0,0 +1,352 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+import asyncio
+import os
+from pathlib import Path
+
+from colcon_bazel.task.bazel import BZL_BUILD_COMMANDS
+from colcon_bazel.task.bazel.client import get_bazel_client
+from colcon_bazel.task.bazel.client import get_command_output_base
+from colcon_bazel.task.bazel.output_base import ISOLATION_PACKAGE
+from colcon_bazel.task.bazel.workspace import get_group_root
+from colcon_core.environment_variable import EnvironmentVariable
+from colcon_core.logging import colcon_logger
+
+logger = colcon_logger.getChild(__name__)
+
+BZL_HOST_JVM_ARGS = '--host_jvm_args'
+BZL_LOCAL_RAM = '--local_ram_resources'
+BZL_MAX_IDLE_SECS = '--max_idle_secs'
+
+"""Environment variable to set the memory budget of a Bazel package"""
+BAZEL_MEMORY_PER_PACKAGE_ENVIRONMENT_VARIABLE = EnvironmentVariable(
+    'BAZEL_MEMORY_PER_PACKAGE',
+    'The memory budget in MiB of each concurrent Bazel package, enables '
+    'the memory governor limiting the concurrent Bazel servers')
+
+# Minimum heap size of the Bazel server JVM (MiB).
+MIN_JVM_HEAP = 512
+# Idle time after which the server of a governed package exits (seconds),
+# Bazel keeps idle servers and their heap for 3 hours by default.
+# Servers of a package's own output base are shut down explicitly, this
+# bounds the lifetime of shared servers.
+SERVER_MAX_IDLE_SECS = 30
+
+_CGROUP_ROOT = Path('/sys/fs/cgroup')
+_MEMINFO = Path('/proc/meminfo')
+_SELF_CGROUP = Path('/proc/self/cgroup')
+# cgroup v1 reports "no limit" as a value close to the max of a 64bit int.
+_CGROUP_V1_UNLIMITED = 1 << 60
+
+_governor = None
+
+
+def get_memory_per_package():
+    """
+    Get the memory budget of a single Bazel package.
+
+    The governor is only enabled if a budget is configured, otherwise the
+    Bazel defaults apply.
+
+    :returns: The budget in MiB, 0 if the governor is disabled
+    :rtype: int
+    """
+    value = os.getenv(BAZEL_MEMORY_PER_PACKAGE_ENVIRONMENT_VARIABLE.name)
+    if not value:
+        return 0
+    try:
+        return max(0, int(value))
+    except ValueError:
+        logger.warning(
+            "Invalid value '{value}' for environment variable '{name}'"
+            .format(
+                value=value,
+                name=BAZEL_MEMORY_PER_PACKAGE_ENVIRONMENT_VARIABLE.name))
+        return 0
+
+
+def get_available_memory():
+    """
+    Get the memory available to this process.
+
+    The result is the minimum of the cgroup (v2 or v1) limit minus its current
+    usage and the `MemAvailable` value of `/proc/meminfo`.
+
+    :returns: The available memory in MiB, None if unknown
+    :rtype: int
+    """
+    candidates = [
+        value for value in (_get_cgroup_available(), _get_meminfo_available())
+        if value is not None]
+    if not candidates:
+        return None
+    return min(candidates) // (1024 * 1024)
+
+
+def _get_meminfo_available():
+    try:
+        content = _MEMINFO.read_text()
+    except OSError:
+        return None
+    for line in content.splitlines():
+        if line.startswith('MemAvailable:'):
+            # the value is always reported in kB
+            return int(line.split()[1]) * 1024
+    return None
+
+
+def _get_cgroup_available():
+    for limit_file, usage_file in _get_cgroup_files():
+        limit = _read_int(limit_file)
+        if limit is None or limit >= _CGROUP_V1_UNLIMITED:
+            continue
+        usage = _read_int(usage_file) or 0
+        return max(0, limit - usage)
+    return None
+
+
+def _get_cgroup_files():
+    # cgroup v2 of the current process, then the root of the hierarchy
+    relative = ''
+    try:
+        for line in _SELF_CGROUP.read_text().splitlines():
+            if line.startswith('0::'):
+                relative = line[3:].lstrip('/')
+    except OSError:
+        pass
+    for path in (_CGROUP_ROOT / relative, _CGROUP_ROOT):
+        yield path / 'memory.max', path / 'memory.current'
+    # cgroup v1
+    v1 = _CGROUP_ROOT / 'memory'
+    yield v1 / 'memory.limit_in_bytes', v1 / 'memory.usage_in_bytes'
+
+
+def _read_int(path):
+    try:
+        return int(path.read_text().strip())
+    except (OSError, ValueError):
+        # e.g. the cgroup v2 value 'max'
+        return None
+
+
+class MemoryGovernor:
+    """
+    Share the available memory between concurrent Bazel packages.
+
+    Each package gets a fixed memory budget which is split between the heap
+    of the Bazel server JVM and the RAM Bazel assumes for local actions.
+    Only as many packages as fit into the available memory are allowed to
+    run concurrently, the others wait until a slot is released.
+    A package holds its slot for all of its Bazel calls, see
+    :meth:`reserve`, and releases it only once its server has been shut
+    down.
+    Shared servers exit after a short idle time instead of keeping their
+    heap for hours.
+    """
+
+    def __init__(self, *, available=None, per_package=None):
+        """
+        Construct a memory governor.
+
+        :param int available: The available memory in MiB, if None it is
+          determined from the system
+        :param int per_package: The memory budget of each package in MiB, if
+          None it is read from the environment
+        """
+        if per_package is None:
+            per_package = get_memory_per_package()
+        if available is None and per_package:
+            available = get_available_memory()
+        self.per_package = per_package
+        self.slots = None
+        if per_package and available is not None:
+            self.slots = max(1, available // per_package)
+            # a single package shouldn't be given more than there is
+            self.per_package = min(per_package, max(available, MIN_JVM_HEAP))
+        self._semaphore = None
+        self._loop = None
+
+    @property
+    def enabled(self):
+        """Check if the governor limits the memory of the packages."""
+        return bool(self.per_package)
+
+    def get_jvm_heap(self):
+        """
+        Get the maximum heap size of the Bazel server JVM.
+
+        :returns: The heap size in MiB
+        :rtype: int
+        """
+        return max(MIN_JVM_HEAP, self.per_package // 4)
+
+    def get_startup_options(self, startup_options=None):
+        """
+        Get the startup options limiting the Bazel server heap and lifetime.
+
+        :param list startup_options: The already present startup options
+        :returns: startup options
+        :rtype: list
+        """
+        if not self.enabled:
+            return []
+        options = []
+        if not _has_option(startup_options, BZL_HOST_JVM_ARGS, '-Xmx'):
+            options.append(
+                BZL_HOST_JVM_ARGS + '=-Xmx{}m'.format(self.get_jvm_heap()))
+        if not _has_option(startup_options, BZL_MAX_IDLE_SECS):
+            options.append(
+                BZL_MAX_IDLE_SECS + '={}'.format(SERVER_MAX_IDLE_SECS))
+        return options
+
+    def get_arguments(self, arguments=None):
+        """
+        Get the arguments limiting the RAM used by local actions.
+
+        :param list arguments: The already present arguments
+        :returns: arguments
+        :rtype: list
+        """
+        if not self.enabled or _has_option(arguments, BZL_LOCAL_RAM):
+            return []
+        ram = max(1, self.per_package - self.get_jvm_heap())
+        return [BZL_LOCAL_RAM + '={}'.format(ram)]
+
+    def apply(self, bazel_command):
+        """
+        Add the memory limits to a Bazel command line.
+
+        :param BazelCommand bazel_command: The command line
+        :rtype: BazelCommand
+        """
+        bazel_command = bazel_command.with_startup_options(
+            *self.get_startup_options(bazel_command.startup_options))
+        # only commands executing actions accept the resource flags
+        if bazel_command.command in BZL_BUILD_COMMANDS:
+            bazel_command = bazel_command.with_flags(
+                *self.get_arguments(bazel_command.flags))
+        return bazel_command
+
+    def reserve(self, args, pkg, bazel_command, *, env=None):
+        """
+        Reserve a slot for all Bazel calls of a package.
+
+        Bazel calls within the reservation must not use the governor again.
+        When the reservation ends the server of the package is shut down
+        before the slot is released, unless it is shared with other
+        packages, i.e. the package doesn't use its own output base or is
+        grouped by its workspace.
+
+        :param args: Arguments of package descriptor.
+        :param pkg: The package descriptor
+        :param BazelCommand bazel_command: A command using the server of the
+          package, the startup options must match the ones of all calls
+        :param dict env: The environment of the Bazel calls
+        :rtype: MemoryReservation
+        """
+        shutdown_command = None
+        if getattr(args, 'bazel_output_base', ISOLATION_PACKAGE) == \
+                ISOLATION_PACKAGE and get_group_root(args, pkg) is None:
+            shutdown_command = bazel_command.replace(
+                command='shutdown', flags=(), target_patterns=())
+        return MemoryReservation(
+            self, shutdown_command, cwd=args.path, env=env)
+
+    async def __aenter__(self):  # noqa: D105
+        semaphore = self._get_semaphore()
+        if semaphore is None:
+            return self
+        if semaphore.locked():
+            logger.info(
+                'Waiting for memory to become available '
+                '({self.slots} concurrent Bazel packages)'
+                .format_map(locals()))
+        await semaphore.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):  # noqa: D105
+        semaphore = self._get_semaphore()
+        if semaphore is not None:
+            semaphore.release()
+
+    def _get_semaphore(self):
+        if not self.enabled or self.slots is None:
+            return None
+        # the semaphore must be bound to the loop running the tasks
+        loop = asyncio.get_event_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.slots)
+            self._loop = loop
+        return self._semaphore
+
+
+class MemoryReservation:
+    """The slot of the memory governor held by a package."""
+
+    def __init__(
+        self, governor, shutdown_command=None, *, cwd=None, env=None
+    ):
+        """
+        Construct a reservation.
+
+        :param MemoryGovernor governor: The memory governor
+        :param BazelCommand shutdown_command: The command shutting down the
+          server of the package, None to keep the server running
+        :param str cwd: The working directory of the shutdown command
+        :param dict env: The environment of the shutdown command
+        """
+        self.governor = governor
+        self.shutdown_command = shutdown_command
+        self.cwd = cwd
+        self.env = env
+
+    async def __aenter__(self):  # noqa: D105
+        await self.governor.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):  # noqa: D105
+        try:
+            if self.governor._get_semaphore() is not None and \
+                    self.shutdown_command is not None:
+                await self._shutdown()
+        finally:
+            await self.governor.__aexit__(exc_type, exc, tb)
+
+    async def _shutdown(self):
+        # the heap of the server isn't freed until its JVM exits
+        try:
+            await get_bazel_client().check_output(
+                self.shutdown_command.to_list(), cwd=self.cwd, env=self.env,
+                output_base=get_command_output_base(
+                    self.shutdown_command, self.cwd))
+        except AssertionError as e:
+            logger.warning(
+                'Failed to shut down the Bazel server: {e}'.format(e=e))
+
+
+def get_memory_governor():
+    """
+    Get the memory governor shared by all Bazel tasks of this invocation.
+
+    :rtype: MemoryGovernor
+    """
+    global _governor
+    if _governor is None:
+        _governor = MemoryGovernor()
+        if _governor.enabled:
+            logger.debug(
+                'Bazel memory governor: {per_package} MiB per package, '
+                '{slots} concurrent packages'.format(
+                    per_package=_governor.per_package,
+                    slots=_governor.slots))
+    return _governor
+
+
+def _has_option(options, name, value_prefix=''):
+    for option in options or []:
+        if option.startswith(name + '=' + value_prefix):
+            return True
+        if option == name and not value_prefix:
+            return True
+    return False
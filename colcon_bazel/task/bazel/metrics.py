@@ -0,0 +1,278 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+import asyncio
+from collections import OrderedDict
+import json
+import os
+from pathlib import Path
+import time
+
+from colcon_core.environment_variable import EnvironmentVariable
+from colcon_core.logging import colcon_logger
+
+try:
+    import psutil
+except ImportError:  # pragma: no cover
+    psutil = None
+
+logger = colcon_logger.getChild(__name__)
+
+"""Environment variable to export the timings of the Bazel tasks"""
+BAZEL_METRICS_FILE_ENVIRONMENT_VARIABLE = EnvironmentVariable(
+    'BAZEL_METRICS_FILE',
+    'The file to write the timings of the Bazel tasks to at the end of the '
+    'invocation, as JSON lines if the extension is .jsonl and as '
+    'OpenMetrics text otherwise')
+
+JSON_LINES_SUFFIX = '.jsonl'
+
+# Interval of sampling the Bazel server process (seconds)
+SAMPLE_INTERVAL = 1.0
+
+# Metric names, unit and help text of the OpenMetrics export
+_METRICS = (
+    ('seconds', 'colcon_bazel_phase_seconds', 'seconds',
+     'Duration of a phase of a Bazel task'),
+    ('cpu_seconds', 'colcon_bazel_server_cpu_seconds', 'seconds',
+     'CPU time of the Bazel server during a phase'),
+    ('max_rss_bytes', 'colcon_bazel_server_max_rss_bytes', 'bytes',
+     'Peak resident memory of the Bazel server during a phase'),
+)
+
+_recorder = None
+
+
+class Measurement:
+    """The timing of a single phase of a package."""
+
+    def __init__(self, recorder, package, task, phase, output_base=None):
+        """
+        Construct a measurement.
+
+        :param MetricsRecorder recorder: The recorder to add the result to
+        :param str package: The package name, if None the measurement is
+          discarded unless the attribute is set before the phase ends
+        :param str task: The task, e.g. `build`
+        :param str phase: The phase of the task, e.g. `environment`
+        :param Path output_base: The output base of the Bazel server to
+          sample, only used in an `async with` statement
+        """
+        self.recorder = recorder
+        self.package = package
+        self.task = task
+        self.phase = phase
+        self.output_base = output_base
+        self.start = None
+        self.seconds = None
+        self.cpu_seconds = None
+        self.max_rss_bytes = None
+        self._monotonic_start = None
+        self._cpu_times = {}
+        self._sampler = None
+
+    def __enter__(self):  # noqa: D105
+        self.start = time.time()
+        self._monotonic_start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):  # noqa: D105
+        self.seconds = time.monotonic() - self._monotonic_start
+        if self.package is not None:
+            self.recorder.add(self)
+
+    async def __aenter__(self):  # noqa: D105
+        self.__enter__()
+        if self.output_base is not None and psutil is not None:
+            self._sample()
+            self._sampler = asyncio.ensure_future(self._sample_periodically())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):  # noqa: D105
+        if self._sampler is not None:
+            self._sampler.cancel()
+            try:
+                await self._sampler
+            except asyncio.CancelledError:
+                pass
+            self._sample()
+        self.__exit__(exc_type, exc, tb)
+
+    def to_dict(self):
+        """
+        Get the labels and values of the measurement.
+
+        :rtype: OrderedDict
+        """
+        data = OrderedDict()
+        for name in (
+            'package', 'task', 'phase', 'start', 'seconds', 'cpu_seconds',
+            'max_rss_bytes',
+        ):
+            value = getattr(self, name)
+            if value is not None:
+                data[name] = value
+        return data
+
+    async def _sample_periodically(self):
+        while True:
+            await asyncio.sleep(SAMPLE_INTERVAL)
+            self._sample()
+
+    def _sample(self):
+        # the server might only be started by the measured command and
+        # might be restarted with a different pid
+        pid_file = Path(self.output_base) / 'server' / 'server.pid.txt'
+        try:
+            process = psutil.Process(int(pid_file.read_text().strip()))
+            with process.oneshot():
+                cpu_times = process.cpu_times()
+                rss = process.memory_info().rss
+        except (OSError, ValueError, psutil.Error):
+            return
+        # the first and the last CPU time by pid
+        cpu = cpu_times.user + cpu_times.system
+        self._cpu_times.setdefault(process.pid, [cpu, cpu])[1] = cpu
+        self.cpu_seconds = sum(
+            last - first for first, last in self._cpu_times.values())
+        self.max_rss_bytes = max(self.max_rss_bytes or 0, rss)
+
+
+class MetricsRecorder:
+    """Record the timings of the phases of the Bazel tasks."""
+
+    def __init__(self, path=None):
+        """
+        Construct a metrics recorder.
+
+        :param Path path: The file to export the metrics to, if None the
+          recorder is disabled
+        """
+        self.path = path
+        self.measurements = []
+
+    @property
+    def enabled(self):
+        """Check if the metrics are recorded."""
+        return self.path is not None
+
+    def measure(self, package, task, phase, *, output_base=None):
+        """
+        Measure a phase of a task.
+
+        Use the result as a context manager around the phase.
+        Use it in an `async with` statement to also sample the Bazel server.
+
+        :param str package: The package name
+        :param str task: The task, e.g. `build`
+        :param str phase: The phase of the task, e.g. `environment`
+        :param Path output_base: The output base of the Bazel server to
+          sample, requires `psutil`
+        :rtype: Measurement
+        """
+        if not self.enabled:
+            package = None
+        return Measurement(
+            self, package, task, phase, output_base=output_base)
+
+    def add(self, measurement):
+        """
+        Add the result of a measurement.
+
+        :param Measurement measurement: The measurement
+        """
+        if self.enabled:
+            self.measurements.append(measurement)
+
+    def export(self):
+        """
+        Write the recorded metrics to the file.
+
+        The format depends on the extension of the file, see
+        :data:`BAZEL_METRICS_FILE_ENVIRONMENT_VARIABLE`.
+        The file is replaced atomically.
+        """
+        if not self.enabled:
+            return
+        path = Path(self.path)
+        if path.suffix == JSON_LINES_SUFFIX:
+            content = format_json_lines(self.measurements)
+        else:
+            content = format_openmetrics(self.measurements)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.parent / (path.name + '.tmp')
+        tmp.write_text(content)
+        os.replace(str(tmp), str(path))
+        logger.info(
+            "Wrote {count} Bazel metrics to '{path}'".format(
+                count=len(self.measurements), path=path))
+
+
+def get_metrics_recorder():
+    """
+    Get the metrics recorder shared by all Bazel tasks of this invocation.
+
+    :rtype: MetricsRecorder
+    """
+    global _recorder
+    if _recorder is None:
+        _recorder = MetricsRecorder(
+            os.getenv(BAZEL_METRICS_FILE_ENVIRONMENT_VARIABLE.name) or None)
+    return _recorder
+
+
+def format_json_lines(measurements):
+    """
+    Format measurements as JSON lines.
+
+    :param list measurements: The measurements
+    :rtype: str
+    """
+    return ''.join(
+        json.dumps(measurement.to_dict()) + '\n'
+        for measurement in measurements)
+
+
+def format_openmetrics(measurements):
+    """
+    Format measurements in the OpenMetrics text format.
+
+    Repeated measurements of the same phase of a package are summed up,
+    the peak memory is the maximum of them.
+
+    :param list measurements: The measurements
+    :rtype: str
+    """
+    lines = []
+    for attribute, name, unit, description in _METRICS:
+        samples = OrderedDict()
+        for measurement in measurements:
+            value = getattr(measurement, attribute)
+            if value is None:
+                continue
+            labels = (
+                measurement.package, measurement.task, measurement.phase)
+            if labels not in samples:
+                samples[labels] = value
+            elif attribute == 'max_rss_bytes':
+                samples[labels] = max(samples[labels], value)
+            else:
+                samples[labels] += value
+        if not samples:
+            continue
+        lines.append('# TYPE {name} gauge'.format_map(locals()))
+        lines.append('# UNIT {name} {unit}'.format_map(locals()))
+        lines.append('# HELP {name} {description}.'.format_map(locals()))
+        for (package, task, phase), value in samples.items():
+            lines.append(
+                '{name}{{package="{package}",task="{task}",phase="{phase}"}} '
+                '{value}'.format(
+                    name=name, package=_escape(package), task=_escape(task),
+                    phase=_escape(phase), value=value))
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
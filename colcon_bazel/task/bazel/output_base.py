@@ -0,0 +1,310 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+import hashlib
+import os
+from pathlib import Path
+import shutil
+import stat
+import subprocess
+import sys
+
+from colcon_core.logging import colcon_logger
+
+logger = colcon_logger.getChild(__name__)
+
+# Directory in the build base shared by all Bazel packages
+CACHE_DIRNAME = '.bazel'
+# Directory in the shared directory containing the install bases
+USER_ROOT_DIRNAME = 'user_root'
+
+# Seconds to wait for the Bazel server of an output base to shut down
+SHUTDOWN_TIMEOUT = 60
+
+ISOLATION_PACKAGE = 'package'
+ISOLATION_WORKSPACE = 'workspace'
+ISOLATION_SHARED = 'shared'
+ISOLATION_STRATEGIES = (
+    ISOLATION_PACKAGE, ISOLATION_WORKSPACE, ISOLATION_SHARED)
+
+# Files marking the root of a Bazel workspace
+WORKSPACE_FILENAMES = (
+    'MODULE.bazel', 'REPO.bazel', 'WORKSPACE.bazel', 'WORKSPACE')
+
+
+def get_cache_base(args):
+    """
+    Get the directory shared by all Bazel packages.
+
+    :param args: Arguments of package descriptor.
+    :rtype: Path
+    """
+    # the build base of a package is a sub-directory of the global one
+    return Path(args.build_base).parent / CACHE_DIRNAME
+
+
+def get_output_base(args, strategy=None):
+    """
+    Get the Bazel output base of a package.
+
+    :param args: Arguments of package descriptor.
+    :param str strategy: The isolation strategy, if None the one selected by
+      the arguments, grouped packages share the output base of their
+      workspace
+    :rtype: Path
+    """
+    if strategy is None and getattr(args, 'bazel_group_by_workspace', False):
+        strategy = ISOLATION_WORKSPACE
+    if strategy is None:
+        strategy = getattr(args, 'bazel_output_base', None) or \
+            ISOLATION_PACKAGE
+    if strategy == ISOLATION_PACKAGE:
+        return Path(args.build_base) / 'bazel'
+    output_bases = get_cache_base(args) / 'output_bases'
+    if strategy == ISOLATION_SHARED:
+        return output_bases / 'shared'
+    if strategy == ISOLATION_WORKSPACE:
+        root = find_workspace_root(args.path) or Path(args.path)
+        return output_bases / _get_hash(str(Path(root).resolve()))
+    raise ValueError(
+        "Unknown output base isolation strategy '{strategy}'"
+        .format_map(locals()))
+
+
+def get_output_user_root(args):
+    """
+    Get the Bazel output user root shared by all packages.
+
+    Since the output base is passed explicitly the output user root only
+    contains the install bases.
+    Bazel names each install base after the checksum of the embedded binary,
+    which also distinguishes the versions selected by a wrapper like
+    `bazelisk` behind the same executable.
+
+    :param args: Arguments of package descriptor.
+    :rtype: Path
+    """
+    return get_cache_base(args) / USER_ROOT_DIRNAME
+
+
+def get_repository_cache(args):
+    """
+    Get the Bazel repository cache shared by all packages.
+
+    :param args: Arguments of package descriptor.
+    :rtype: Path
+    """
+    return get_cache_base(args) / 'repository_cache'
+
+
+def find_workspace_root(path):
+    """
+    Find the root of the Bazel workspace containing a path.
+
+    :param path: The path to start from
+    :returns: The closest directory containing a workspace file, otherwise
+      None
+    :rtype: Path
+    """
+    path = Path(path).resolve()
+    for directory in [path] + list(path.parents):
+        for filename in WORKSPACE_FILENAMES:
+            if (directory / filename).is_file():
+                return directory
+    return None
+
+
+def get_output_bases(build_base):
+    """
+    Get all Bazel output bases within a build base.
+
+    :param Path build_base: The global build base
+    :rtype: list
+    """
+    build_base = Path(build_base)
+    candidates = []
+    if build_base.is_dir():
+        candidates += sorted(build_base.glob('*/bazel'))
+    shared = build_base / CACHE_DIRNAME / 'output_bases'
+    if shared.is_dir():
+        candidates += sorted(shared.iterdir())
+    return [path for path in candidates if path.is_dir()]
+
+
+def is_output_base_idle(output_base):
+    """
+    Check if no Bazel server is running for an output base.
+
+    :param Path output_base: The output base
+    :rtype: bool
+    """
+    pid_file = Path(output_base) / 'server' / 'server.pid.txt'
+    try:
+        pid = int(pid_file.read_text().strip())
+    except (OSError, ValueError):
+        return True
+    return not _is_process_running(pid)
+
+
+def shutdown_server(output_base, executable, *, output_user_root=None):
+    """
+    Shut down the Bazel server of an output base.
+
+    The server is only shut down if no command is currently running,
+    otherwise Bazel fails to acquire the lock of the output base.
+
+    :param Path output_base: The output base
+    :param str executable: The Bazel executable
+    :param Path output_user_root: The output user root the server was
+      started with
+    :returns: True if no server is running anymore
+    :rtype: bool
+    """
+    cmd = [str(executable), '--output_base=' + str(output_base)]
+    if output_user_root is not None:
+        cmd.append('--output_user_root=' + str(output_user_root))
+    cmd += ['--noblock_for_lock', 'shutdown']
+    try:
+        subprocess.run(
+            cmd, cwd=str(output_base), stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            timeout=SHUTDOWN_TIMEOUT)
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning(
+            "Failed to shut down the Bazel server of '{output_base}': {e}"
+            .format(output_base=output_base, e=e))
+    return is_output_base_idle(output_base)
+
+
+def get_last_use(output_base):
+    """
+    Get the time an output base was last used.
+
+    Bazel rewrites the `command.log` on every command.
+
+    :param Path output_base: The output base
+    :returns: The modification time in seconds since the epoch
+    :rtype: float
+    """
+    for path in (Path(output_base) / 'command.log', Path(output_base)):
+        try:
+            return path.stat().st_mtime
+        except OSError:
+            continue
+    return 0.0
+
+
+def get_size(path):
+    """
+    Get the disk usage of a directory.
+
+    Symlinks are not followed and hardlinked files are only counted once.
+
+    :param Path path: The directory
+    :returns: The size in bytes
+    :rtype: int
+    """
+    size = 0
+    seen = set()
+    for dirpath, dirnames, filenames in os.walk(str(path)):
+        for name in dirnames + filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, name))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            size += st.st_size
+    return size
+
+
+def expunge_output_bases(
+    build_base, budget, *, executable=None, dry_run=False
+):
+    """
+    Expunge output bases until their total size fits into a budget.
+
+    The least recently used output bases are expunged first.
+    The idle Bazel server of an output base is shut down before, output
+    bases with a command currently running are never expunged.
+
+    :param Path build_base: The global build base
+    :param int budget: The total size in bytes the output bases may use
+    :param str executable: The Bazel executable to shut down the servers
+      with, if None output bases with a running server are skipped
+    :param bool dry_run: The flag if the output bases should only be
+      reported but not removed
+    :returns: The expunged output bases and their sizes
+    :rtype: list
+    """
+    output_bases = [
+        (get_last_use(path), path, get_size(path))
+        for path in get_output_bases(build_base)]
+    total = sum(size for _, _, size in output_bases)
+
+    expunged = []
+    for _, path, size in sorted(output_bases, key=lambda o: o[0]):
+        if total <= budget:
+            break
+        if not is_output_base_idle(path) and (
+            executable is None or not dry_run and not shutdown_server(
+                path, executable, output_user_root=Path(build_base) /
+                CACHE_DIRNAME / USER_ROOT_DIRNAME)
+        ):
+            logger.info(
+                "Skipping output base '{path}' with a running Bazel server"
+                .format_map(locals()))
+            continue
+        if not dry_run:
+            logger.info("Expunging output base '{path}'".format_map(locals()))
+            _remove_tree(path)
+        expunged.append((path, size))
+        total -= size
+    return expunged
+
+
+def _is_process_running(pid):
+    if sys.platform == 'win32':
+        # os.kill() would send a CTRL_C_EVENT on Windows
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        process_query_limited_information = 0x1000
+        still_active = 259
+        handle = kernel32.OpenProcess(
+            process_query_limited_information, False, pid)
+        if not handle:
+            # the process doesn't exist or belongs to another user
+            return ctypes.GetLastError() == 5  # ERROR_ACCESS_DENIED
+        try:
+            exit_code = ctypes.c_ulong()
+            if not kernel32.GetExitCodeProcess(
+                handle, ctypes.byref(exit_code)
+            ):
+                return True
+            return exit_code.value == still_active
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # e.g. the process belongs to another user
+        pass
+    return True
+
+
+def _remove_tree(path):
+    # Bazel makes its outputs read-only
+    def onerror(func, p, _):
+        os.chmod(p, stat.S_IWUSR | stat.S_IRUSR | stat.S_IXUSR)
+        parent = os.path.dirname(p)
+        os.chmod(parent, stat.S_IWUSR | stat.S_IRUSR | stat.S_IXUSR)
+        func(p)
+
+    shutil.rmtree(str(path), onerror=onerror)
+
+
+def _get_hash(value):
+    return hashlib.sha256(value.encode()).hexdigest()[:16]
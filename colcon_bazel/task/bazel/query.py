@@ -0,0 +1,112 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+from pathlib import Path
+
+from colcon_bazel.task.bazel import add_bazel_arguments
+from colcon_bazel.task.bazel import create_bazel_command
+from colcon_bazel.task.bazel.environment import get_environment
+from colcon_bazel.task.bazel.memory import get_memory_governor
+from colcon_core.logging import colcon_logger
+from colcon_core.plugin_system import satisfies_version
+from colcon_core.subprocess import check_output
+from colcon_core.task import TaskExtensionPoint
+
+logger = colcon_logger.getChild(__name__)
+
+BZL_QUERY_COMMANDS = ('aquery', 'cquery', 'query')
+BZL_QUERY_OUTPUT = '--output'
+
+
+class BazelQueryTask(TaskExtensionPoint):
+    """Dump the targets of Bazel packages."""
+
+    def __init__(self):  # noqa: D107
+        super().__init__()
+        satisfies_version(TaskExtensionPoint.EXTENSION_POINT_VERSION, '^1.0')
+
+    def add_arguments(self, *, parser):  # noqa: D102
+        add_bazel_arguments(parser)
+
+    async def query(self, *, additional_hooks=None):  # noqa: D102
+        args = self.context.args
+
+        logger.info(
+            "Querying Bazel package in '{args.path}'".format_map(locals()))
+
+        try:
+            env = await get_environment(
+                'query', args, self.context.dependencies)
+        except RuntimeError as e:
+            logger.error(str(e))
+            return 1
+
+        # Use the same server as the other tasks
+        governor = get_memory_governor()
+        try:
+            bzl_cmd = governor.apply(create_bazel_command(args, 'query'))
+        except RuntimeError as e:
+            logger.error(str(e))
+            return 1
+        if bzl_cmd.command not in BZL_QUERY_COMMANDS:
+            logger.error(
+                "'{bzl_cmd.command}' is not a query command"
+                .format_map(locals()))
+            return 1
+        bzl_cmd = get_query_command(bzl_cmd)
+
+        self.progress(bzl_cmd.command)
+        try:
+            async with governor.reserve(
+                args, self.context.pkg, bzl_cmd, env=env
+            ):
+                output = await check_output(
+                    bzl_cmd.to_list(), cwd=args.path, env=env)
+        except AssertionError as e:
+            logger.error(str(e))
+            return 1
+
+        dump = Path(args.build_base) / get_query_filename(bzl_cmd.command)
+        dump.parent.mkdir(parents=True, exist_ok=True)
+        dump.write_bytes(output)
+        logger.info(
+            "Wrote result of 'bazel {bzl_cmd.command}' to '{dump}'"
+            .format_map(locals()))
+
+
+def get_query_command(bazel_command):
+    """
+    Adapt a Bazel command to the syntax of the query commands.
+
+    The query commands take a single expression instead of target patterns,
+    multiple patterns are therefore combined into one expression.
+
+    :param BazelCommand bazel_command: The query command
+    :rtype: BazelCommand
+    """
+    if not bazel_command.has_flag(BZL_QUERY_OUTPUT):
+        output = 'text' if bazel_command.command == 'aquery' else 'label_kind'
+        bazel_command = bazel_command.with_flags(
+            BZL_QUERY_OUTPUT + '=' + output)
+
+    patterns = bazel_command.target_patterns
+    if len(patterns) > 1:
+        expression = patterns[0]
+        for pattern in patterns[1:]:
+            # negative target patterns exclude targets
+            if pattern.startswith('-'):
+                expression += ' - ' + pattern[1:]
+            else:
+                expression += ' + ' + pattern
+        bazel_command = bazel_command.replace(target_patterns=[expression])
+    return bazel_command
+
+
+def get_query_filename(command):
+    """
+    Get the filename of the dumped query result.
+
+    :param str command: The query command
+    :rtype: str
+    """
+    return 'bazel_{command}.txt'.format_map(locals())
@@ -1,13 +1,42 @@
 # Copyright 2018 Mickael Gaillard
 # Licensed under the Apache License, Version 2.0
 
-from colcon_bazel.task.bazel import get_bazel_arguments
+from collections import OrderedDict
+import os
+from pathlib import Path
+import time
+
+from colcon_bazel.task.bazel import add_bazel_arguments
+from colcon_bazel.task.bazel import create_bazel_command
 from colcon_bazel.task.bazel import get_bazel_command
-from colcon_bazel.task.bazel import get_bazel_executable
-from colcon_bazel.task.bazel import get_bazel_startup_options
+from colcon_bazel.task.bazel import get_bazel_option_value
+from colcon_bazel.task.bazel.client import get_bazel_client
+from colcon_bazel.task.bazel.coverage import BazelCoverageTask
+from colcon_bazel.task.bazel.environment import get_environment
+from colcon_bazel.task.bazel.execution_profile import add_profile_arguments
+from colcon_bazel.task.bazel.execution_profile import apply_execution_limits
+from colcon_bazel.task.bazel.execution_profile import apply_execution_profile
+from colcon_bazel.task.bazel.execution_profile import is_auto_tuned
+from colcon_bazel.task.bazel.execution_profile import record_execution_profile
+from colcon_bazel.task.bazel.execution_profile import select_execution_profile
+from colcon_bazel.task.bazel.flaky import BUILD_EVENTS_FILENAME
+from colcon_bazel.task.bazel.flaky import BZL_BUILD_EVENT_JSON_FILE
+from colcon_bazel.task.bazel.flaky import BZL_EXIT_TESTS_FAILED
+from colcon_bazel.task.bazel.flaky import BZL_FLAKY_TEST_ATTEMPTS
+from colcon_bazel.task.bazel.flaky import FlakinessHistory
+from colcon_bazel.task.bazel.flaky import get_failed_targets
+from colcon_bazel.task.bazel.flaky import get_flaky_test_attempts_flags
+from colcon_bazel.task.bazel.flaky import get_test_results
+from colcon_bazel.task.bazel.flaky import get_test_results_from_output_path
+from colcon_bazel.task.bazel.flaky import HISTORY_FILENAME
+from colcon_bazel.task.bazel.memory import get_memory_governor
+from colcon_bazel.task.bazel.metrics import get_metrics_recorder
+from colcon_bazel.task.bazel.output_base import get_output_base
+from colcon_bazel.task.bazel.workspace import get_group_root
+from colcon_bazel.task.bazel.workspace import matches_pattern
+from colcon_bazel.task.bazel.workspace import run_bazel_command
 from colcon_core.logging import colcon_logger
 from colcon_core.plugin_system import satisfies_version
-from colcon_core.shell import get_command_environment
 from colcon_core.task import check_call
 from colcon_core.task import TaskExtensionPoint
 
@@ -22,52 +51,152 @@ class BazelTestTask(TaskExtensionPoint):
         satisfies_version(TaskExtensionPoint.EXTENSION_POINT_VERSION, '^1.0')
 
     def add_arguments(self, *, parser):  # noqa: D102
+        add_bazel_arguments(parser)
+        add_profile_arguments(parser)
         parser.add_argument(
-            '--bazel-args',
-            nargs='*', metavar='*', type=str.lstrip,
-            help='Pass arguments to Bazel projects. '
-            'Arguments matching other options must be prefixed by a space,\n'
-            'e.g. --bazel-args " --help"')
-        parser.add_argument(
-            '--bazel-task',
-            help='Run a specific task instead of the default task')
+            '--bazel-test-attempts',
+            type=int, default=1, metavar='N',
+            help='Run failed Bazel test targets up to N times in total, only '
+            'the failed targets are run again. Targets which were flaky '
+            'before are retried within the first run (default: 1)')
 
     async def test(self, *, additional_hooks=None):  # noqa: D102
         pkg = self.context.pkg
         args = self.context.args
 
+        # coverage runs the tests and gathers the workspace report
+        if get_bazel_command(args, 'test') == 'coverage':
+            task = BazelCoverageTask()
+            task.set_context(context=self.context)
+            return await task.coverage(additional_hooks=additional_hooks)
+
         logger.info(
             "Testing Bazel package in '{args.path}'".format_map(locals()))
 
         try:
-            env = await get_command_environment(
-                'test', args.build_base, self.context.dependencies)
+            with get_metrics_recorder().measure(
+                pkg.name, 'test', 'environment'
+            ):
+                env = await get_environment(
+                    'test', args, self.context.dependencies)
+        except RuntimeError as e:
+            logger.error(str(e))
+            return 1
+
+        # Limit the memory of the Bazel server and its local actions
+        governor = get_memory_governor()
+        try:
+            bzl_cmd = governor.apply(create_bazel_command(args, 'test'))
         except RuntimeError as e:
             logger.error(str(e))
             return 1
+        bzl_cmd, profile = apply_execution_profile(
+            bzl_cmd, select_execution_profile(args, pkg, 'test'))
+        bzl_cmd = apply_execution_limits(bzl_cmd, args, pkg)
+
+        # The build events report the result of each test target, grouped
+        # packages can only be batched with an identical command line
+        build_events = get_bazel_option_value(
+            bzl_cmd.flags, BZL_BUILD_EVENT_JSON_FILE)
+        if build_events is None and get_group_root(args, pkg) is None:
+            build_events = str(Path(args.build_base) / BUILD_EVENTS_FILENAME)
+            bzl_cmd = bzl_cmd.with_flags(
+                BZL_BUILD_EVENT_JSON_FILE + '=' + build_events)
+
+        attempts = max(1, getattr(args, 'bazel_test_attempts', None) or 1)
+        history = FlakinessHistory(Path(args.build_base) / HISTORY_FILENAME)
+        flaky = history.get_flaky_targets()
+        if attempts > 1 and flaky and \
+                not bzl_cmd.has_flag(BZL_FLAKY_TEST_ATTEMPTS):
+            bzl_cmd = bzl_cmd.with_flags(
+                *get_flaky_test_attempts_flags(flaky, attempts))
+
+        # hold the memory until the server is shut down, the calls
+        # determining the test results use the server as well
+        async with governor.reserve(args, pkg, bzl_cmd, env=env):
+            results = []
+            rc = await self._test(args, env, bzl_cmd)
+            if profile is not None and build_events is not None and \
+                    is_auto_tuned(args, pkg) and rc and not rc.returncode:
+                record_execution_profile(
+                    args, pkg, 'test', profile, self._bazel_seconds,
+                    build_events)
+            results.append(await self._get_test_results(
+                args, env, bzl_cmd, rc, build_events))
+            for attempt in range(2, attempts + 1):
+                failed = get_failed_targets(results[-1])
+                if not rc or rc.returncode != BZL_EXIT_TESTS_FAILED or \
+                        not failed:
+                    break
+                logger.info(
+                    'Running {count} failed Bazel test targets again '
+                    '(attempt {attempt} of {attempts})'.format(
+                        count=len(failed), attempt=attempt, attempts=attempts))
+                rc = await self._test(
+                    args, env, bzl_cmd.replace(target_patterns=failed))
+                results.append(await self._get_test_results(
+                    args, env, bzl_cmd, rc, build_events))
+
+        history.add_results(results)
+        history.save()
+        if len(results) > 1 and not (rc and rc.returncode):
+            logger.warning(
+                'Bazel test targets passed only when run again: ' +
+                ', '.join(get_failed_targets(results[0])))
 
-        rc = await self._test(args, env)
         if rc and rc.returncode:
             return rc.returncode
 
-    async def _test(self, args, env):
+    async def _get_test_results(self, args, env, bzl_cmd, rc, build_events):
+        results = OrderedDict()
+        if build_events is not None:
+            results = get_test_results(build_events)
+        if not results and rc and rc.returncode == BZL_EXIT_TESTS_FAILED:
+            # fall back to the test.xml files written by this run, the
+            # output path unlike `bazel-testlogs` doesn't depend on the
+            # configuration selected by the flags of the command
+            try:
+                info = await get_bazel_client().get_info(
+                    bzl_cmd, ['output_path'], cwd=args.path, env=env)
+            except AssertionError as e:
+                logger.warning(
+                    'Failed to determine the Bazel test logs: ' + str(e))
+            else:
+                results = get_test_results_from_output_path(
+                    info['output_path'], since=self._start_time)
+
+        if get_group_root(args, self.context.pkg) is not None:
+            # a batched invocation also tests targets of other packages
+            results = OrderedDict(
+                (label, status) for label, status in results.items()
+                if any(
+                    matches_pattern(label, pattern)
+                    for pattern in bzl_cmd.target_patterns))
+        return results
+
+    async def _test(self, args, env, bzl_cmd):
         self.progress('test')
+        self._start_time = time.time()
+        build_events = get_bazel_option_value(
+            bzl_cmd.flags, BZL_BUILD_EVENT_JSON_FILE)
+        if build_events is not None and os.path.exists(build_events) and \
+                get_group_root(args, self.context.pkg) is None:
+            # don't confuse the results of a previous run with this one
+            os.remove(build_events)
+
+        self._bazel_seconds = None
+
+        async def invoke(cmd, cwd):
+            async with get_metrics_recorder().measure(
+                self.context.pkg.name, 'test', 'bazel',
+                output_base=get_output_base(args)
+            ) as measurement:
+                rc = await check_call(
+                    self.context, cmd.to_list(), cwd=cwd, env=env)
+            # the time of a batched invocation isn't attributed to a package
+            if cmd == bzl_cmd:
+                self._bazel_seconds = measurement.seconds
+            return rc
 
-        bzl_exec_path = get_bazel_executable(args)
-        bzl_startup_options = get_bazel_startup_options(args)
-        bzl_command = get_bazel_command(args, 'test')
-        bzl_args = get_bazel_arguments(args)
-        bzl_target_patterns = ['//...']
-
-        # Make full command
-        # https://docs.bazel.build/versions/master/command-line-reference.html
-        cmd = [bzl_exec_path]
-        cmd.extend(bzl_startup_options)
-        cmd.append(bzl_command)
-        cmd.extend(bzl_args)
-        cmd.append('--')
-        cmd.extend(bzl_target_patterns)
-
-        # invoke build step
-        return await check_call(
-            self.context, cmd, cwd=args.path, env=env)
+        return await run_bazel_command(
+            args, self.context.pkg, bzl_cmd, invoke, env=env)
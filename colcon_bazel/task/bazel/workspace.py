@@ -0,0 +1,196 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+import asyncio
+from pathlib import Path
+
+from colcon_bazel.task.bazel.output_base import find_workspace_root
+from colcon_core.logging import colcon_logger
+
+logger = colcon_logger.getChild(__name__)
+
+# Metadata of a package descriptor with the root of its Bazel workspace
+WORKSPACE_ROOT_METADATA = 'bazel_workspace_root'
+
+_queue = None
+
+
+class WorkspaceQueue:
+    """
+    Coalesce the Bazel commands of packages sharing a workspace root.
+
+    Only one command runs at a time per workspace root, command line
+    (except the target patterns) and environment.
+    Commands submitted while another one is running are batched into the
+    next invocation with the union of their target patterns, which
+    amortizes the startup and analysis cost of Bazel.
+    """
+
+    def __init__(self):  # noqa: D107
+        self._queues = {}
+        self._loop = None
+
+    async def submit(self, bazel_command, invoke, *, cwd, env=None):
+        """
+        Run a command, possibly batched with commands of other packages.
+
+        The return code of a batched invocation is shared by all packages
+        of the batch.
+
+        :param BazelCommand bazel_command: The command
+        :param invoke: The coroutine function running a command, called
+          with the batched command and the working directory.
+          The function of the first package of a batch is used.
+        :param str cwd: The working directory, the workspace root
+        :param dict env: The environment
+        :returns: The result of `invoke`
+        """
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            # pending futures are bound to the running loop
+            self._queues = {}
+            self._loop = loop
+
+        key = (
+            str(cwd), tuple(bazel_command.replace(
+                target_patterns=()).to_list()),
+            tuple(sorted((env or {}).items())))
+        future = loop.create_future()
+        pending = self._queues.get(key)
+        if pending is None:
+            pending = self._queues[key] = []
+            asyncio.ensure_future(self._run(key, bazel_command, cwd))
+        pending.append((bazel_command.target_patterns, invoke, future))
+        return await future
+
+    async def _run(self, key, bazel_command, cwd):
+        batch = []
+        try:
+            # let requests arriving at the same time join the first batch
+            await asyncio.sleep(0)
+            while self._queues[key]:
+                batch, self._queues[key] = self._queues[key], []
+                target_patterns = []
+                for patterns, _, _ in batch:
+                    target_patterns += [
+                        p for p in patterns if p not in target_patterns]
+                if len(batch) > 1:
+                    logger.info(
+                        'Batching the Bazel commands of {count} packages in '
+                        "'{cwd}'".format(count=len(batch), cwd=cwd))
+                invoke = batch[0][1]
+                try:
+                    result = await invoke(
+                        bazel_command.replace(
+                            target_patterns=target_patterns), cwd)
+                except Exception as e:  # noqa: B902
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_result(result)
+        finally:
+            for _, _, future in batch + self._queues.pop(key, []):
+                if not future.done():
+                    future.cancel()
+
+
+def get_workspace_queue():
+    """
+    Get the workspace queue shared by all Bazel tasks of this invocation.
+
+    :rtype: WorkspaceQueue
+    """
+    global _queue
+    if _queue is None:
+        _queue = WorkspaceQueue()
+    return _queue
+
+
+def get_group_root(args, pkg=None):
+    """
+    Get the workspace root a package is grouped by.
+
+    :param args: Arguments of package descriptor.
+    :param pkg: The package descriptor, its metadata provides the root
+      determined during identification
+    :returns: The workspace root, None if grouping is disabled or the
+      package isn't within a workspace
+    :rtype: Path
+    """
+    if not getattr(args, 'bazel_group_by_workspace', False):
+        return None
+    root = None
+    if pkg is not None:
+        root = pkg.metadata.get(WORKSPACE_ROOT_METADATA)
+    if root is None:
+        root = find_workspace_root(args.path)
+    return Path(root) if root is not None else None
+
+
+def get_package_pattern(path, workspace_root):
+    """
+    Get the target pattern of all targets of a package within a workspace.
+
+    :param path: The path of the package
+    :param workspace_root: The root of the workspace
+    :returns: The pattern, e.g. `//a/b/...`
+    :rtype: str
+    """
+    relative = Path(path).resolve().relative_to(
+        Path(workspace_root).resolve()).as_posix()
+    if relative == '.':
+        return '//...'
+    return '//' + relative + '/...'
+
+
+def matches_pattern(label, pattern):
+    """
+    Check if a label is matched by a target pattern.
+
+    Relative patterns can't be checked without the working directory, they
+    are considered to match.
+
+    :param str label: The label, e.g. `//a/b:c`
+    :param str pattern: The target pattern, e.g. `//a/...` or `//a/b:all`
+    :rtype: bool
+    """
+    if not pattern.startswith('//'):
+        return not pattern.startswith('-')
+    for suffix in ('/...:all-targets', '/...:all', '/...:*', '/...'):
+        if pattern.endswith(suffix) or pattern == '/' + suffix:
+            package = pattern[:-len(suffix)]
+            if package == '/':
+                return label.startswith('//')
+            return label.startswith((package + ':', package + '/'))
+    package, _, name = pattern.partition(':')
+    if name in ('all', 'all-targets', '*'):
+        return label.startswith(package + ':')
+    if not name:
+        # the target named after the package
+        name = package.rsplit('/', 1)[-1]
+    return label == package + ':' + name
+
+
+async def run_bazel_command(args, pkg, bazel_command, invoke, *, env=None):
+    """
+    Run a Bazel command of a package.
+
+    In grouping mode the command is run from the workspace root and
+    batched with the commands of other packages of the same workspace.
+
+    :param args: Arguments of package descriptor.
+    :param pkg: The package descriptor
+    :param BazelCommand bazel_command: The command
+    :param invoke: The coroutine function running a command, called with
+      the command and the working directory
+    :param dict env: The environment
+    :returns: The result of `invoke`
+    """
+    root = get_group_root(args, pkg)
+    if root is None:
+        return await invoke(bazel_command, args.path)
+    return await get_workspace_queue().submit(
+        bazel_command, invoke, cwd=str(root), env=env)
@@ -0,0 +1,84 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+import argparse
+from pathlib import Path
+
+from colcon_bazel.task import bazel
+from colcon_bazel.task.bazel.output_base import expunge_output_bases
+from colcon_core.plugin_system import satisfies_version
+from colcon_core.verb import VerbExtensionPoint
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+class BazelCleanVerb(VerbExtensionPoint):
+    """Expunge the Bazel output bases exceeding a size budget."""
+
+    def __init__(self):  # noqa: D107
+        super().__init__()
+        satisfies_version(VerbExtensionPoint.EXTENSION_POINT_VERSION, '^1.0')
+
+    def add_arguments(self, *, parser):  # noqa: D102
+        parser.add_argument(
+            '--build-base',
+            default='build',
+            help='The base path for all build directories (default: build)')
+        parser.add_argument(
+            '--budget',
+            type=parse_size, default=0,
+            help='The total size the Bazel output bases may use, e.g. 20G. '
+            'The least recently used output bases are expunged until they '
+            'fit, their idle Bazel servers are shut down before (default: '
+            '0, expunge all output bases not running a command)')
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only show which output bases would be expunged')
+
+    def main(self, *, context):  # noqa: D102
+        args = context.args
+        expunged = expunge_output_bases(
+            Path(args.build_base), args.budget,
+            executable=bazel.BAZEL_EXECUTABLE, dry_run=args.dry_run)
+        for path, size in expunged:
+            print(
+                '{action} {path} ({size})'.format(
+                    action='Would expunge' if args.dry_run else 'Expunged',
+                    path=path, size=format_size(size)))
+        print('{count} output bases, {size} {verb} freed'.format(
+            count=len(expunged),
+            size=format_size(sum(size for _, size in expunged)),
+            verb='would be' if args.dry_run else 'were'))
+        return 0
+
+
+def parse_size(value):
+    """
+    Parse a size with an optional binary unit suffix.
+
+    :param str value: The size, e.g. `512M` or `20G`
+    :returns: The size in bytes
+    :rtype: int
+    """
+    value = value.strip().upper().rstrip('B').rstrip('I')
+    unit = value[-1:] if value[-1:] in SIZE_UNITS else ''
+    number = value[:-1] if unit else value
+    try:
+        return int(float(number) * SIZE_UNITS[unit])
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "invalid size '{value}'".format_map(locals()))
+
+
+def format_size(size):
+    """
+    Format a size in bytes with a binary unit suffix.
+
+    :param int size: The size in bytes
+    :rtype: str
+    """
+    for unit in ('T', 'G', 'M', 'K'):
+        if size >= SIZE_UNITS[unit]:
+            return '{:.1f} {}iB'.format(size / SIZE_UNITS[unit], unit)
+    return '{} B'.format(size)
@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+"""
+Hermetic stand-in for the `bazel` executable.
+
+It understands the subset of the Bazel command line used by colcon-bazel
+and is selected with the `BAZEL_COMMAND` environment variable.
+Every target pattern of a package is treated as the single target named
+after the package directory, e.g. `//a/b/...` as `//a/b:b`.
+
+The behavior can be configured with environment variables:
+
+- FAKE_BAZEL_LATENCY: seconds each invocation takes (default 0)
+- FAKE_BAZEL_EXIT_CODE: exit code of the build and test commands
+- FAKE_BAZEL_FAILING_TESTS: comma separated test targets which fail
+- FAKE_BAZEL_FLAKY_TESTS: comma separated test targets which only fail
+  the first time they run within an output base
+- FAKE_BAZEL_ACTIONS_EXECUTED: number of actions reported in the build
+  metrics (default one per target)
+- FAKE_BAZEL_LOG: file to append each invocation to as a JSON line
+- FAKE_BAZEL_TIMES: file to append the output base, command, start and end
+  time of each finished invocation to as a JSON line
+"""
+
+from contextlib import contextmanager
+import json
+import os
+from pathlib import Path
+import re
+import signal
+import sys
+import time
+
+CONFIGURATION = 'k8-fastbuild'
+
+# Exit codes of Bazel
+EXIT_SUCCESS = 0
+EXIT_BUILD_FAILURE = 1
+EXIT_COMMAND_LINE_ERROR = 2
+EXIT_TESTS_FAILED = 3
+
+
+def main(argv=sys.argv[1:]):
+    start = time.time()
+    try:
+        return run(argv)
+    finally:
+        times = os.environ.get('FAKE_BAZEL_TIMES')
+        if times:
+            startup_options, command, _, _ = parse(argv)
+            with open(times, 'a') as h:
+                h.write(json.dumps({
+                    'output_base': get_option(
+                        startup_options, '--output_base'),
+                    'command': command, 'start': start,
+                    'end': time.time()}) + '\n')
+
+
+def run(argv):
+    startup_options, command, flags, target_patterns = parse(argv)
+    if command is None:
+        print('Usage: bazel <command> <options> ...', file=sys.stderr)
+        return EXIT_COMMAND_LINE_ERROR
+
+    log = os.environ.get('FAKE_BAZEL_LOG')
+    if log:
+        with open(log, 'a') as h:
+            h.write(json.dumps({
+                'cwd': os.getcwd(), 'startup_options': startup_options,
+                'command': command, 'flags': flags,
+                'target_patterns': target_patterns}) + '\n')
+
+    start_time = time.time()
+    time.sleep(float(os.environ.get('FAKE_BAZEL_LATENCY') or 0))
+
+    output_base = Path(
+        get_option(startup_options, '--output_base') or
+        Path.cwd() / '.fake_bazel')
+    execution_root = output_base / 'execroot' / '__main__'
+    output_path = execution_root / 'bazel-out'
+    if command == 'cquery' and any('tests(' in p for p in target_patterns):
+        # like Bazel, which supports the function only in `query`
+        print(
+            'ERROR: function not supported by cquery: tests',
+            file=sys.stderr)
+        return EXIT_COMMAND_LINE_ERROR
+    if command == 'cquery' and len(target_patterns) == 1 and \
+            target_patterns[0].startswith('let '):
+        # every target is considered not to be a test
+        target_patterns = get_expression_patterns(target_patterns[0])
+    targets = get_targets(target_patterns)
+
+    if command == 'info':
+        return info(output_base, target_patterns)
+    if command in ('build', 'run'):
+        return build(output_path, targets, flags, start_time)
+    if command in ('test', 'coverage'):
+        rc = build(output_path, targets, flags, start_time)
+        if rc:
+            return rc
+        return run_tests(
+            output_base, targets, flags, command == 'coverage')
+    if command == 'cquery' and get_option(flags, '--output') == 'files':
+        for label in targets:
+            for path in get_outputs(output_path, get_name(label)):
+                print(path.relative_to(execution_root).as_posix())
+        return EXIT_SUCCESS
+    if command in ('query', 'cquery', 'aquery'):
+        for label in targets:
+            print('fake_rule rule {label}'.format_map(locals()))
+        return EXIT_SUCCESS
+    if command == 'shutdown':
+        return shutdown(output_base)
+    if command in ('clean', 'version'):
+        return EXIT_SUCCESS
+
+    print(
+        "Command '{command}' not supported by fake bazel".format_map(
+            locals()), file=sys.stderr)
+    return EXIT_COMMAND_LINE_ERROR
+
+
+def parse(argv):
+    startup_options = []
+    command = None
+    flags = []
+    target_patterns = []
+    argv = list(argv)
+    for i, arg in enumerate(argv):
+        if arg == '-c' and command is not None and i + 1 < len(argv):
+            # the short form of the compilation mode
+            argv[i + 1] = '--compilation_mode=' + argv[i + 1]
+            continue
+        if command is None:
+            if arg.startswith('-'):
+                startup_options.append(arg)
+            else:
+                command = arg
+        elif arg == '--':
+            target_patterns.extend(argv[i + 1:])
+            break
+        elif arg.startswith('-'):
+            flags.append(arg)
+        else:
+            target_patterns.append(arg)
+    return startup_options, command, flags, target_patterns
+
+
+def get_option(options, name):
+    value = None
+    for option in options:
+        if option.startswith(name + '='):
+            value = option.split('=', 1)[1]
+    return value
+
+
+def get_targets(target_patterns):
+    targets = []
+    for pattern in target_patterns or ['//...']:
+        if pattern.startswith('-'):
+            continue
+        if pattern in ('//...', '...'):
+            pattern = '//:' + Path.cwd().name
+        elif pattern.endswith('/...'):
+            package = pattern[:-len('/...')].lstrip('/')
+            pattern = '//{}:{}'.format(package, package.split('/')[-1])
+        package, _, name = pattern.lstrip('/').rpartition(':')
+        label = '//{package}:{name}'.format(
+            package=package, name=name.split('/')[-1])
+        if label not in targets:
+            targets.append(label)
+    return targets
+
+
+def get_expression_patterns(expression):
+    # the target patterns of `let targets = "a" + "b" - "c" in ...`
+    definition = expression.split(' in ', 1)[0]
+    return [
+        ('-' if sign == '-' else '') + pattern
+        for sign, pattern in re.findall(r'([=+-]) "([^"]*)"', definition)]
+
+
+def get_name(label):
+    return label.split(':')[-1]
+
+
+def get_package(label):
+    return label[2:].split(':')[0]
+
+
+def get_outputs(output_path, target):
+    bin_path = output_path / CONFIGURATION / 'bin'
+    return [bin_path / target, bin_path / ('lib' + target + '.so')]
+
+
+def info(output_base, keys):
+    execution_root = output_base / 'execroot' / '__main__'
+    output_path = execution_root / 'bazel-out'
+    values = {
+        'bazel-bin': output_path / CONFIGURATION / 'bin',
+        'bazel-testlogs': output_path / CONFIGURATION / 'testlogs',
+        'execution_root': execution_root,
+        'output_base': output_base,
+        'output_path': output_path,
+        'release': 'release 0.0.0-fake',
+        'workspace': Path.cwd(),
+    }
+    keys = [key for key in keys if not key.startswith('-')]
+    if len(keys) == 1:
+        print(values[keys[0]])
+        return EXIT_SUCCESS
+    for key in keys or sorted(values):
+        print('{key}: {value}'.format(key=key, value=values[key]))
+    return EXIT_SUCCESS
+
+
+def build(output_path, targets, flags, start_time):
+    exit_code = int(os.environ.get('FAKE_BAZEL_EXIT_CODE') or 0)
+    events = []
+    for label in targets:
+        for path in get_outputs(output_path, get_name(label)):
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(get_name(label))
+            if not path.suffix:
+                path.chmod(0o755)
+                create_runfiles(path)
+        events.append({
+            'id': {'targetCompleted': {'label': label}},
+            'completed': {'success': not exit_code}})
+    actions = os.environ.get('FAKE_BAZEL_ACTIONS_EXECUTED')
+    # int64 values are serialized as strings
+    milliseconds = str(int((time.time() - start_time) * 1000))
+    events.append({
+        'id': {'buildMetrics': {}},
+        'buildMetrics': {
+            'actionSummary': {
+                'actionsExecuted': actions or str(len(targets))},
+            'timingMetrics': {
+                'wallTimeInMs': milliseconds,
+                'executionPhaseTimeInMs': milliseconds}}})
+    write_build_events(flags, events)
+    return EXIT_BUILD_FAILURE if exit_code else EXIT_SUCCESS
+
+
+def create_runfiles(executable):
+    # the symlink tree of the executable and a data file
+    runfiles = executable.parent / (executable.name + '.runfiles') / '_main'
+    runfiles.mkdir(parents=True, exist_ok=True)
+    data = executable.parent / (executable.name + '.data')
+    data.write_text('data')
+    for path in (executable, data):
+        link = runfiles / path.name
+        if not os.path.lexists(str(link)):
+            link.symlink_to(path)
+
+
+def run_tests(output_base, targets, flags, coverage):
+    failing = get_target_set('FAKE_BAZEL_FAILING_TESTS')
+    flaky = get_target_set('FAKE_BAZEL_FLAKY_TESTS')
+    output_path = output_base / 'execroot' / '__main__' / 'bazel-out'
+    testlogs = output_path / get_configuration(flags) / 'testlogs'
+    events = []
+    for label in targets:
+        target = get_name(label)
+        failed = bool({target, label} & failing)
+        if {target, label} & flaky:
+            marker = output_base / ('flaky_' + target)
+            failed = failed or not marker.exists()
+            marker.parent.mkdir(parents=True, exist_ok=True)
+            marker.touch()
+        test_xml = testlogs / get_package(label) / target / 'test.xml'
+        test_xml.parent.mkdir(parents=True, exist_ok=True)
+        test_xml.write_text(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<testsuites>\n'
+            '  <testsuite name="{label}" tests="1" failures="{failures}">'
+            '\n'
+            '    <testcase name="{target}"{status}\n'
+            '  </testsuite>\n'
+            '</testsuites>\n'.format(
+                label=label, target=target, failures=int(failed),
+                status='><failure message="failed"/></testcase>'
+                if failed else '/>'))
+        events.append({
+            'id': {'testResult': {'label': label, 'run': 1,
+                                  'shard': 1, 'attempt': 1}},
+            'testResult': {
+                'status': 'FAILED' if failed else 'PASSED',
+                'testActionOutput': [{
+                    'name': 'test.xml', 'uri': test_xml.as_uri()}]}})
+    write_build_events(flags, events, mode='a')
+
+    if coverage:
+        report = output_path / '_coverage' / '_coverage_report.dat'
+        report.parent.mkdir(parents=True, exist_ok=True)
+        with report.open('w') as h:
+            for target in map(get_name, targets):
+                h.write(
+                    'SF:{target}.cc\nDA:1,1\nDA:2,0\nend_of_record\n'
+                    .format_map(locals()))
+
+    if any(event['testResult']['status'] != 'PASSED' for event in events):
+        return EXIT_TESTS_FAILED
+    return EXIT_SUCCESS
+
+
+def shutdown(output_base):
+    # the server is any process whose pid is recorded in the output base
+    pid_file = output_base / 'server' / 'server.pid.txt'
+    try:
+        pid = int(pid_file.read_text())
+    except (OSError, ValueError):
+        return EXIT_SUCCESS
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError:
+        pass
+    pid_file.unlink()
+    return EXIT_SUCCESS
+
+
+def get_configuration(flags):
+    mode = get_option(flags, '--compilation_mode')
+    return 'k8-' + mode if mode else CONFIGURATION
+
+
+def get_target_set(name):
+    return set(filter(None, (os.environ.get(name) or '').split(',')))
+
+
+def write_build_events(flags, events, mode='w'):
+    path = get_option(flags, '--build_event_json_file')
+    if not path:
+        return
+    with open(path, mode) as h:
+        for event in events:
+            h.write(json.dumps(event) + '\n')
+
+
+def create_executable(directory):
+    """Create an executable invoking this script with the current Python."""
+    path = Path(directory) / 'bazel'
+    path.write_text(
+        '#!/bin/sh\n'
+        'exec "{python}" "{script}" "$@"\n'.format(
+            python=sys.executable, script=Path(__file__).resolve()))
+    path.chmod(0o755)
+    return path
+
+
+# The helpers below are only used by the tests, the colcon modules are
+# imported lazily to keep the startup of the fake executable fast
+
+
+def create_context(basepath, path, *, name=None, verb='build', **arguments):
+    """
+    Create the task context of a Bazel package.
+
+    The build and install base of the package are within the base path.
+
+    :param str basepath: The base path of the colcon workspace
+    :param path: The path of the package
+    :param str name: The package name, by default the directory name
+    :param str verb: Either `build` or `test`
+    :param arguments: Additional package arguments, e.g. `bazel_args`
+    :rtype: TaskContext
+    """
+    from types import SimpleNamespace
+
+    from colcon_core.package_descriptor import PackageDescriptor
+    from colcon_core.task import TaskContext
+    from colcon_core.verb.build import BuildPackageArguments
+    from colcon_core.verb.test import TestPackageArguments
+
+    desc = PackageDescriptor(path)
+    desc.name = name or Path(path).name
+    desc.type = 'bazel'
+
+    args_verb = SimpleNamespace(
+        build_base=str(Path(basepath) / 'build'),
+        install_base=str(Path(basepath) / 'install'),
+        merge_install=False, symlink_install=False, test_result_base=None)
+    args_class = BuildPackageArguments if verb == 'build' \
+        else TestPackageArguments
+    args_pkg = args_class(desc, args_verb)
+    args_pkg.path = str(path)
+    args_pkg.build_base = str(Path(basepath) / 'build' / desc.name)
+    args_pkg.install_base = str(Path(basepath) / 'install' / desc.name)
+    args_pkg.symlink_install = False
+    args_pkg.bazel_args = None
+    args_pkg.bazel_task = None
+    for key, value in arguments.items():
+        setattr(args_pkg, key, value)
+
+    context = TaskContext(pkg=desc, args=args_pkg, dependencies={})
+    context.put_event_into_queue = lambda event: None
+    return context
+
+
+@contextmanager
+def patch_fake_bazel(basepath, **env):
+    """
+    Run the Bazel tasks with the fake executable.
+
+    The memory governor is disabled.
+
+    :param str basepath: The directory to create the executable in
+    :param env: Environment variables configuring the fake executable
+    """
+    from unittest.mock import patch
+
+    from colcon_bazel.task import bazel
+    from colcon_bazel.task.bazel import memory
+    from colcon_bazel.task.bazel.memory import MemoryGovernor
+
+    executable = str(create_executable(basepath))
+    env[bazel.BAZEL_COMMAND_ENVIRONMENT_VARIABLE.name] = executable
+    with patch.dict('os.environ', env), \
+            patch.object(memory, '_governor', MemoryGovernor(
+                per_package=0)), \
+            patch.object(bazel, 'BAZEL_EXECUTABLE', executable):
+        yield
+
+
+def read_log(path):
+    """
+    Read the invocations logged with `FAKE_BAZEL_LOG`.
+
+    :param Path path: The log file
+    :returns: The invocations, empty if there were none
+    :rtype: list
+    """
+    if not Path(path).exists():
+        return []
+    return [json.loads(line) for line in Path(path).read_text().splitlines()]
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,161 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+"""
+Load benchmark of the Bazel tasks using the fake bazel executable.
+
+Run it with
+`COLCON_BAZEL_BENCHMARK=1 pytest -s -m benchmark test/`.
+The overhead of a package is the part of its duration not covered by any
+of its Bazel invocations, which may run concurrently.
+The number of packages, the latency of each fake Bazel invocation and the
+number of parallel workers can be set with the environment variables
+COLCON_BAZEL_BENCHMARK_PACKAGES, COLCON_BAZEL_BENCHMARK_LATENCY and
+COLCON_BAZEL_BENCHMARK_WORKERS.
+"""
+
+import asyncio
+import json
+import os
+from pathlib import Path
+import statistics
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+import time
+
+from colcon_bazel.task.bazel.build import BazelBuildTask
+from colcon_bazel.task.bazel.test import BazelTestTask
+import pytest
+
+from .fake_bazel import create_context
+from .fake_bazel import create_executable
+from .fake_bazel import patch_fake_bazel
+
+
+def _create_packages(basepath, count):
+    paths = []
+    for i in range(count):
+        path = Path(basepath) / 'src' / 'pkg{i:04d}'.format_map(locals())
+        path.mkdir(parents=True)
+        (path / 'BUILD.bazel').write_text(
+            'cc_library(name = "{path.name}")\n'.format_map(locals()))
+        paths.append(path)
+    return paths
+
+
+async def _run_packages(paths, verb, basepath, workers):
+    semaphore = asyncio.Semaphore(workers)
+    durations = {}
+
+    async def run(path):
+        async with semaphore:
+            extension = BazelBuildTask() if verb == 'build' \
+                else BazelTestTask()
+            extension.set_context(
+                context=create_context(basepath, path, verb=verb))
+            start = time.time()
+            rc = await (
+                extension.build() if verb == 'build' else extension.test())
+            durations[path.name] = time.time() - start
+            assert not rc
+
+    start = time.monotonic()
+    await asyncio.gather(*[run(path) for path in paths])
+    return time.monotonic() - start, durations
+
+
+def _get_bazel_times(path, spawn_time):
+    # the intervals of the Bazel invocations by package, the output base of
+    # a package is `build/<name>/bazel`
+    intervals = {}
+    for line in path.read_text().splitlines():
+        invocation = json.loads(line)
+        name = Path(invocation['output_base']).parent.name
+        # the fake executable only measures after it has been spawned
+        intervals.setdefault(name, []).append(
+            (invocation['start'] - spawn_time, invocation['end']))
+    return {
+        name: (len(values), _get_union_length(values))
+        for name, values in intervals.items()}
+
+
+def _get_union_length(intervals):
+    length = 0.0
+    end = None
+    for start, stop in sorted(intervals):
+        if end is not None and start < end:
+            start = end
+        if stop > start:
+            length += stop - start
+        end = stop if end is None else max(end, stop)
+    return length
+
+
+def _get_spawn_time(executable, repetitions=10):
+    # the cost of starting the fake executable itself isn't overhead of
+    # colcon-bazel and is subtracted from the measurements
+    start = time.monotonic()
+    for _ in range(repetitions):
+        subprocess.run(
+            [str(executable), 'version'], check=True,
+            env=dict(os.environ, FAKE_BAZEL_LATENCY='0'))
+    return (time.monotonic() - start) / repetitions
+
+
+@pytest.mark.benchmark
+@pytest.mark.skipif(
+    not os.environ.get('COLCON_BAZEL_BENCHMARK'),
+    reason='set COLCON_BAZEL_BENCHMARK to run the benchmark')
+@pytest.mark.skipif(sys.platform == 'win32',
+                    reason='fake bazel requires a POSIX shell')
+@pytest.mark.asyncio
+@pytest.mark.parametrize('verb', ['build', 'test'])
+async def test_benchmark(verb):
+    count = int(os.environ.get('COLCON_BAZEL_BENCHMARK_PACKAGES') or 200)
+    latency = float(os.environ.get('COLCON_BAZEL_BENCHMARK_LATENCY') or 0)
+    workers_list = [
+        int(w) for w in (
+            os.environ.get('COLCON_BAZEL_BENCHMARK_WORKERS') or '1,4,16'
+        ).split(',')]
+
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        executable = create_executable(basepath)
+        spawn_time = _get_spawn_time(executable)
+
+        print()
+        print(
+            '{verb}: {count} packages, {latency:.3f}s latency, '
+            '{spawn_time:.3f}s to spawn fake bazel'.format_map(locals()))
+        print(
+            'workers | wall time | packages/s | per package | invocations '
+            '| overhead')
+        baseline = None
+        for workers in workers_list:
+            paths = _create_packages(
+                Path(basepath) / str(workers), count)
+            times = Path(basepath) / str(workers) / 'times.json'
+            with patch_fake_bazel(
+                basepath, FAKE_BAZEL_LATENCY=str(latency),
+                FAKE_BAZEL_TIMES=str(times)
+            ):
+                wall, durations = await _run_packages(
+                    paths, verb, str(Path(basepath) / str(workers)), workers)
+            bazel_times = _get_bazel_times(times, spawn_time)
+            per_package = statistics.mean(durations.values())
+            invocations = statistics.mean(
+                bazel_times[name][0] for name in durations)
+            overhead = statistics.mean(
+                duration - bazel_times[name][1]
+                for name, duration in durations.items())
+            if baseline is None:
+                baseline = wall
+            print(
+                '{workers:7d} | {wall:8.2f}s | {rate:10.1f} | '
+                '{per_package:10.3f}s | {invocations:11.1f} | '
+                '{overhead:7.3f}s (speedup {speedup:.1f}x)'.format(
+                    workers=workers, wall=wall, rate=count / wall,
+                    per_package=per_package, invocations=invocations,
+                    overhead=overhead, speedup=baseline / wall))
+            assert len(durations) == count
+            assert overhead >= -spawn_time
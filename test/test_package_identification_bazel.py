@@ -1,13 +1,22 @@
 # Copyright 2018 Mickael Gaillard
 # Licensed under the Apache License, Version 2.0
 
+from collections import defaultdict
+import copy
 from pathlib import Path
+import pickle
 from tempfile import TemporaryDirectory
+from unittest.mock import patch
 
 from colcon_bazel.package_identification.bazel \
     import BazelPackageIdentification
+from colcon_bazel.package_identification.bazel import evaluate_glob
 from colcon_bazel.package_identification.bazel import extract_content
 from colcon_bazel.package_identification.bazel import extract_data
+from colcon_bazel.package_identification.bazel import extract_depends
+from colcon_bazel.package_identification.bazel import extract_globs
+from colcon_bazel.package_identification.bazel import extract_sources
+from colcon_bazel.package_identification.bazel import LazyDependencies
 from colcon_core.package_descriptor import PackageDescriptor
 import pytest
 
@@ -111,3 +120,204 @@ def test_extract_content():
             ')\n')
         content = extract_content(basepath / 'BUILD.bazel')
         assert content == 'java_binary(\nname = "pkg-name",\n)\n'
+
+
+def test_identify_lazy_dependencies():
+    extension = BazelPackageIdentification()
+
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        desc = PackageDescriptor(basepath)
+        desc.dependencies['build'].add('known-dep')
+        (Path(basepath) / 'BUILD.bazel').write_text(
+            'java_binary(\n'
+            '    name = "pkg-name",\n'
+            '    deps = [":build-dep"],\n'
+            ')\n')
+
+        with patch(
+            'colcon_bazel.package_identification.bazel.extract_depends',
+            wraps=extract_depends
+        ) as extract:
+            assert extension.identify(desc) is None
+            assert desc.name == 'pkg-name'
+            assert desc.type == 'bazel'
+            assert isinstance(desc.dependencies, LazyDependencies)
+            assert not desc.dependencies.resolved
+            assert not extract.called
+
+            assert desc.dependencies['build'] == {'known-dep', 'build-dep'}
+            assert desc.dependencies.resolved
+            assert extract.call_count == 1
+            assert desc.get_dependencies() == {'known-dep', 'build-dep'}
+            assert extract.call_count == 1
+
+
+def test_lazy_dependencies():
+    def resolve(dependencies):
+        dependencies['build'].add('dep')
+
+    dependencies = LazyDependencies(resolve)
+    assert set(dependencies.keys()) == {'build'}
+
+    dependencies = LazyDependencies(resolve)
+    assert copy.deepcopy(dependencies) == {'build': {'dep'}}
+    assert type(copy.copy(dependencies)) is defaultdict
+
+    dependencies = LazyDependencies(resolve)
+    assert dict(pickle.loads(pickle.dumps(dependencies))) == {
+        'build': {'dep'}}
+
+    dependencies = LazyDependencies(resolve, {'run': {'other'}})
+    assert dependencies['test'] == set()
+    assert len(dependencies) == 3
+
+
+def test_extract_globs():
+    content = (
+        'cc_library(\n'
+        '    name = "lib",\n'
+        '    srcs = glob(["src/**/*.cc"], exclude = ["src/skip.cc"]),\n'
+        '    hdrs = glob(include = ["include/**/*.h"]) + ["extra.h"],\n'
+        '    data = glob(["data/*"], ["data/*.tmp"]),\n'
+        '    textual_hdrs = glob(HEADERS),\n'
+        ')\n'
+        'filegroup(name = "paren", srcs = glob(["a(b)/*.txt"]))\n')
+    assert extract_globs(content) == [
+        (['src/**/*.cc'], ['src/skip.cc']),
+        (['include/**/*.h'], []),
+        (['data/*'], ['data/*.tmp']),
+        (['a(b)/*.txt'], []),
+    ]
+
+
+def test_evaluate_glob():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        basepath = Path(basepath)
+        for path in (
+            'main.cc', 'src/a.cc', 'src/skip.cc', 'src/deep/b.cc',
+            'src/deep/b.h', 'nested/BUILD', 'nested/c.cc', '.hidden/d.cc',
+        ):
+            (basepath / path).parent.mkdir(parents=True, exist_ok=True)
+            (basepath / path).write_text('')
+
+        def relative(paths):
+            return [p.relative_to(basepath).as_posix() for p in paths]
+
+        assert relative(evaluate_glob(basepath, ['*.cc'])) == ['main.cc']
+        assert relative(evaluate_glob(
+            basepath, ['**/*.cc'], ['src/skip.cc'])) == [
+                'main.cc', 'src/a.cc', 'src/deep/b.cc']
+        assert relative(evaluate_glob(basepath, ['src/**'])) == [
+            'src/a.cc', 'src/deep/b.cc', 'src/deep/b.h', 'src/skip.cc']
+        assert evaluate_glob(basepath, []) == []
+
+
+def test_extract_sources():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        basepath = Path(basepath)
+        for path in (
+            'main.cc', 'util.cc', 'unused.cc', 'defs.bzl', 'src/a.cc',
+            'nested/c.cc', 'nested/d.cc',
+        ):
+            (basepath / path).parent.mkdir(parents=True, exist_ok=True)
+            (basepath / path).write_text('')
+        (basepath / 'BUILD.bazel').write_text(
+            'cc_binary(\n'
+            '    name = "main",\n'
+            '    srcs = ["main.cc", ":util.cc"] + glob(["src/*.cc"]),\n'
+            '    deps = ["//nested:c"],\n'
+            ')\n')
+        (basepath / 'nested' / 'BUILD').write_text(
+            'cc_library(name = "c", srcs = glob(["*.cc"]))\n')
+
+        sources = extract_sources(basepath)
+        assert [p.relative_to(basepath).as_posix() for p in sources] == [
+            'BUILD.bazel', 'defs.bzl', 'main.cc', 'nested/BUILD',
+            'nested/c.cc', 'nested/d.cc', 'src/a.cc', 'util.cc']
+
+
+def test_extract_sources_workspace_files():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        root = Path(basepath).resolve()
+        pkg = root / 'pkg'
+        pkg.mkdir()
+        for name in (
+            'MODULE.bazel', 'MODULE.bazel.lock', '.bazelrc', '.bazelversion',
+            'README.md',
+        ):
+            (root / name).write_text('')
+        for name in ('BUILD.bazel', 'a.cc', 'a.h', '.bazelrc'):
+            (pkg / name).write_text('')
+        (pkg / 'BUILD.bazel').write_text(
+            'cc_library(name = "a", srcs = ["a.cc"], hdrs = glob(["*.h"]))\n')
+
+        sources = extract_sources(pkg)
+        assert [p.relative_to(root).as_posix() for p in sources] == [
+            '.bazelrc', '.bazelversion', 'MODULE.bazel', 'MODULE.bazel.lock',
+            'pkg/.bazelrc', 'pkg/BUILD.bazel', 'pkg/a.cc', 'pkg/a.h']
+
+
+def test_extract_sources_labels_outside():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        root = Path(basepath).resolve()
+        (root / 'WORKSPACE').write_text('')
+        for path in (
+            'pkg/a.cc', 'tools/gen.cc', 'tools/BUILD', 'tools/common.bzl',
+        ):
+            (root / path).parent.mkdir(parents=True, exist_ok=True)
+            (root / path).write_text('')
+        (root / 'tools' / 'defs.bzl').write_text(
+            'load("//tools:common.bzl", "COMMON")\n')
+        (root / 'pkg' / 'BUILD.bazel').write_text(
+            'load("//tools:defs.bzl", "macro")\n'
+            'load("@rules_cc//cc:defs.bzl", "cc_binary")\n'
+            'cc_binary(\n'
+            '    name = "a",\n'
+            '    srcs = ["a.cc", "//tools:gen.cc"],\n'
+            '    visibility = ["//visibility:public"],\n'
+            ')\n')
+
+        sources = extract_sources(root / 'pkg')
+        assert [p.relative_to(root).as_posix() for p in sources] == [
+            'WORKSPACE', 'pkg/BUILD.bazel', 'pkg/a.cc', 'tools/common.bzl',
+            'tools/defs.bzl', 'tools/gen.cc']
+
+        # targets outside of the package must be dependencies
+        (root / 'pkg' / 'BUILD.bazel').write_text(
+            'cc_binary(name = "a", srcs = ["a.cc"], deps = ["//lib:lib"])\n')
+        assert extract_sources(root / 'pkg') is None
+        assert extract_sources(root / 'pkg', {'lib'}) == [
+            root / 'WORKSPACE', root / 'pkg' / 'BUILD.bazel',
+            root / 'pkg' / 'a.cc']
+
+
+def test_identify_sources():
+    extension = BazelPackageIdentification()
+
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        desc = PackageDescriptor(basepath)
+        (Path(basepath) / 'BUILD.bazel').write_text(
+            'java_binary(name = "pkg-name", srcs = glob(["*.java"]))\n')
+        (Path(basepath) / 'Main.java').write_text('')
+
+        assert extension.identify(desc) is None
+        assert desc.metadata['get_bazel_sources'](set()) == [
+            Path(basepath) / 'BUILD.bazel', Path(basepath) / 'Main.java']
+
+
+def test_identify_workspace_root():
+    extension = BazelPackageIdentification()
+
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        root = Path(basepath).resolve()
+        (root / 'pkg').mkdir()
+        (root / 'pkg' / 'BUILD.bazel').write_text(
+            'cc_library(name = "pkg")\n')
+        desc = PackageDescriptor(root / 'pkg')
+        extension.identify(desc)
+        assert 'bazel_workspace_root' not in desc.metadata
+
+        (root / 'WORKSPACE').write_text('')
+        desc = PackageDescriptor(root / 'pkg')
+        extension.identify(desc)
+        assert desc.metadata['bazel_workspace_root'] == root
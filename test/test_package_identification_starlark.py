@@ -0,0 +1,167 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from colcon_bazel.package_identification import starlark
+from colcon_bazel.package_identification.bazel import extract_depends
+from colcon_bazel.package_identification.bazel import extract_name
+from colcon_bazel.package_identification.starlark import evaluate_build_file
+from colcon_bazel.package_identification.starlark import resolve_label
+from colcon_bazel.package_identification.starlark import UNKNOWN
+import pytest
+
+
+def test_resolve_label():
+    root = Path('/ws')
+    directory = Path('/ws/pkg')
+    assert resolve_label('//tools:defs.bzl', directory, root) == \
+        Path('/ws/tools/defs.bzl')
+    assert resolve_label('@//tools:defs.bzl', directory, root) == \
+        Path('/ws/tools/defs.bzl')
+    assert resolve_label(':defs.bzl', directory, root) == \
+        Path('/ws/pkg/defs.bzl')
+    assert resolve_label('defs.bzl', directory, root) == \
+        Path('/ws/pkg/defs.bzl')
+    assert resolve_label('@rules_cc//cc:defs.bzl', directory, root) is None
+
+
+def test_evaluate_expressions():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        build_file = Path(basepath) / 'BUILD.bazel'
+        build_file.write_text(
+            'NAME = "pkg-name"\n'
+            'COMMON = [":common"]\n'
+            'cc_library(\n'
+            '    name = NAME,\n'
+            '    deps = COMMON + [":a"] + select({\n'
+            '        "//conditions:linux": [":linux", ":a"],\n'
+            '        "//conditions:default": [":other"],\n'
+            '    }) + unknown_function(),\n'
+            '    copts = ["-O" + str(2)],\n'
+            '    srcs = [UNDEFINED, "main.cc"],\n'
+            ')\n'
+            '[cc_test(name = n) for n in ["a", "b"]]\n')
+        module = evaluate_build_file(build_file, workspace_root=basepath)
+        assert module.constants['NAME'] == 'pkg-name'
+        assert module.rules == [('cc_library', {
+            'name': 'pkg-name',
+            'deps': [':common', ':a', ':linux', ':a', ':other'],
+            'copts': [],
+            'srcs': ['main.cc'],
+        })]
+
+        build_file.write_text('x = "a" + 1\n')
+        module = evaluate_build_file(build_file, workspace_root=basepath)
+        assert module.constants['x'] is UNKNOWN
+
+        build_file.write_text('cc_library(name = "a",\n')
+        with pytest.raises(SyntaxError):
+            evaluate_build_file(build_file, workspace_root=basepath)
+
+
+def test_evaluate_macros():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        basepath = Path(basepath)
+        (basepath / 'WORKSPACE').write_text('')
+        (basepath / 'tools').mkdir()
+        (basepath / 'tools' / 'deps.bzl').write_text(
+            'COMMON_DEPS = ["//common:lib"]\n')
+        (basepath / 'tools' / 'defs.bzl').write_text(
+            'load("@rules_cc//cc:defs.bzl", "cc_library")\n'
+            'load(":deps.bzl", "COMMON_DEPS")\n'
+            'DEPS = COMMON_DEPS + ["//base:base"]\n'
+            'def my_library(name, **kwargs):\n'
+            '    cc_library(name = name, **kwargs)\n'
+            'def my_program(name, deps = []):\n'
+            '    native.cc_binary(name = name, deps = deps + DEPS)\n'
+            'def my_thing(**kwargs):\n'
+            '    pass\n')
+        pkg = basepath / 'pkg'
+        pkg.mkdir()
+        (pkg / 'BUILD.bazel').write_text(
+            'load(\n'
+            '    "//tools:defs.bzl", "DEPS", "my_library", "my_thing",\n'
+            '    program = "my_program")\n'
+            'load("@rules_java//java:defs.bzl", lib = "java_library")\n'
+            'my_library(name = "pkg", deps = DEPS + [":lib-dep"])\n'
+            'program(name = "main", deps = [":bin-dep"])\n'
+            'lib(name = "java", deps = [":java-dep"])\n'
+            'my_thing(name = "thing", deps = [":thing-dep"])\n')
+
+        with patch.object(starlark, '_modules', {}) as modules:
+            module = evaluate_build_file(pkg / 'BUILD.bazel')
+            assert module.rules == [
+                ('cc_library', {
+                    'name': 'pkg',
+                    'deps': ['//common:lib', '//base:base', ':lib-dep']}),
+                ('cc_binary', {'name': 'main', 'deps': [':bin-dep']}),
+                ('java_library', {'name': 'java', 'deps': [':java-dep']}),
+            ]
+            assert len(modules) == 2
+
+            # loaded files are memoized
+            with patch.object(
+                starlark, '_evaluate', wraps=starlark._evaluate
+            ) as evaluate:
+                evaluate_build_file(pkg / 'BUILD.bazel')
+            assert evaluate.call_count == 1
+
+            # the kinds of macros can be configured
+            name = starlark.BAZEL_MACRO_KINDS_ENVIRONMENT_VARIABLE.name
+            with patch.dict(
+                'os.environ', {name: 'my_thing=cc_test,invalid'}
+            ):
+                module = evaluate_build_file(pkg / 'BUILD.bazel')
+            assert module.rules[-1] == (
+                'cc_test', {'name': 'thing', 'deps': [':thing-dep']})
+
+            depends = extract_depends(pkg / 'BUILD.bazel', 'pkg')
+        assert depends['build'] == {'lib', 'base', 'lib-dep', 'bin-dep',
+                                    'java-dep'}
+
+
+def test_extract_name_constant():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        build_file = Path(basepath) / 'BUILD.bazel'
+        build_file.write_text(
+            'NAME = "pkg-name"\n'
+            'package(default_visibility = ["//visibility:public"])\n'
+            'java_binary(name = NAME)\n')
+        assert extract_name(build_file) == 'pkg-name'
+
+        # files which aren't valid Starlark fall back to the grammar
+        build_file.write_text(
+            'java_binary(\n'
+            '    name = "other-name",\n'
+            '    deps = [":dep"]\n'
+            '    runtime_deps = [":run-dep"]\n'
+            ')\n')
+        assert extract_name(build_file) == 'other-name'
+        depends = extract_depends(build_file, 'other-name')
+        assert depends['build'] == {'dep'}
+        assert depends['run'] == {'run-dep'}
+
+
+def test_extract_name_without_loading():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        (Path(basepath) / 'WORKSPACE').write_text('')
+        (Path(basepath) / 'defs.bzl').write_text('NAME = "loaded-name"\n')
+        build_file = Path(basepath) / 'BUILD.bazel'
+        build_file.write_text(
+            'load(":defs.bzl", "NAME")\n'
+            'java_binary(name = "pkg-name")\n')
+        with patch.object(
+            starlark, 'load_module', wraps=starlark.load_module
+        ) as load_module:
+            assert extract_name(build_file) == 'pkg-name'
+            assert not load_module.called
+
+            # a loaded constant requires evaluating the loaded file
+            build_file.write_text(
+                'load(":defs.bzl", "NAME")\n'
+                'java_binary(name = NAME)\n')
+            assert extract_name(build_file) == 'loaded-name'
+            assert load_module.called
@@ -0,0 +1,126 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from colcon_bazel.task.bazel import BazelCommand
+from colcon_bazel.task.bazel import create_bazel_command
+from colcon_bazel.task.bazel import get_bazel_arguments
+from colcon_bazel.task.bazel import get_bazel_startup_options
+from colcon_bazel.task.bazel import has_bazel_option
+from colcon_bazel.task.bazel import parse_bazel_arguments
+import pytest
+
+
+def _get_args(bazel_args=None, bazel_task=None):
+    return SimpleNamespace(
+        path='/tmp/pkg', build_base='/tmp/build/pkg',
+        install_base='/tmp/install/pkg', bazel_args=bazel_args,
+        bazel_task=bazel_task)
+
+
+def test_bazel_command():
+    command = BazelCommand(
+        'bazel', 'build', startup_options=['--batch'], flags=['--jobs=4'],
+        target_patterns=['//...'])
+    assert command.to_list() == [
+        'bazel', '--batch', 'build', '--jobs=4', '--', '//...']
+    assert command.has_startup_option('--batch')
+    assert command.has_startup_option('--nobatch')
+    assert not command.has_flag('--batch')
+    assert command.has_flag('--jobs')
+
+    with pytest.raises(AttributeError):
+        command.command = 'test'
+
+    derived = command.replace(command='test').with_flags('--keep_going')
+    assert derived.to_list() == [
+        'bazel', '--batch', 'test', '--jobs=4', '--keep_going', '--',
+        '//...']
+    assert command.command == 'build'
+    assert derived != command
+    assert derived.replace(command='build', flags=['--jobs=4']) == command
+
+    info = command.replace(command='info', flags=(), target_patterns=())
+    assert info.to_list() == ['bazel', '--batch', 'info']
+
+
+def test_parse_bazel_arguments():
+    assert parse_bazel_arguments([]) == ([], [], [])
+    assert parse_bazel_arguments([
+        '--host_jvm_args=-Xmx2g', '--config', 'opt', '//foo:bar',
+        '--keep_going', '--', '//baz/...', '-//baz:qux',
+    ]) == (
+        ['--host_jvm_args=-Xmx2g'],
+        ['--config', 'opt', '--keep_going'],
+        ['//foo:bar', '//baz/...', '-//baz:qux'])
+    assert parse_bazel_arguments(['--host_jvm_args', '-Xmx2g']) == (
+        ['--host_jvm_args', '-Xmx2g'], [], [])
+    assert parse_bazel_arguments([
+        '--nohome_rc', '--digest_function', 'SHA256', '--block_for_lock',
+        '-c', 'opt', '--keep_going', 'a/b:c', '...', '-a/...',
+    ]) == (
+        ['--nohome_rc', '--digest_function', 'SHA256', '--block_for_lock'],
+        ['-c', 'opt', '--keep_going'],
+        ['a/b:c', '...', '-a/...'])
+    assert parse_bazel_arguments([
+        '--config=opt', 'a:b', '--noshow_progress', 'c/...',
+    ]) == ([], ['--config=opt', '--noshow_progress'], ['a:b', 'c/...'])
+
+
+def test_has_bazel_option():
+    options = ['--noshow_progress', '--jobs=4', '--symlink_prefix=/']
+    assert has_bazel_option(options, '--show_progress')
+    assert has_bazel_option(options, '--noshow_progress')
+    assert has_bazel_option(options, '--jobs')
+    assert has_bazel_option(options, '--symlink_prefix')
+    assert not has_bazel_option(options, '--show_result')
+
+
+@patch('colcon_bazel.task.bazel.BAZEL_EXECUTABLE', '/usr/bin/bazel')
+def test_create_bazel_command():
+    args = _get_args()
+    command = create_bazel_command(args)
+    assert command.executable == '/usr/bin/bazel'
+    assert command.command == 'build'
+    assert command.startup_options == (
+        '--output_base=/tmp/build/pkg/bazel',
+        '--output_user_root=/tmp/build/.bazel/user_root')
+    assert '--repository_cache=/tmp/build/.bazel/repository_cache' in \
+        command.flags
+    assert '--symlink_prefix=/' in command.flags
+    assert '--noshow_progress' in command.flags
+    assert command.target_patterns == ('//...',)
+
+    args = _get_args(
+        ['--symlink_prefix=bazel-', '--show_progress', '//foo/...'], 'run')
+    command = create_bazel_command(args, 'test')
+    assert command.command == 'run'
+    assert '--symlink_prefix=/' not in command.flags
+    assert '--symlink_prefix=bazel-' in command.flags
+    assert '--noshow_progress' not in command.flags
+    assert '--show_progress' in command.flags
+    assert command.target_patterns == ('//foo/...',)
+
+    # the arguments of the package are not modified
+    assert args.bazel_args == [
+        '--symlink_prefix=bazel-', '--show_progress', '//foo/...']
+    assert get_bazel_arguments(args) == get_bazel_arguments(args)
+    assert args.bazel_args == [
+        '--symlink_prefix=bazel-', '--show_progress', '//foo/...']
+
+    # relative target patterns replace the default ones
+    command = create_bazel_command(
+        _get_args(['--verbose_failures', 'foo/...', 'bar:baz']))
+    assert command.target_patterns == ('foo/...', 'bar:baz')
+
+    assert get_bazel_startup_options(args)[0] == \
+        '--output_base=/tmp/build/pkg/bazel'
+
+    args.bazel_output_base = 'shared'
+    assert get_bazel_startup_options(args)[0] == \
+        '--output_base=/tmp/build/.bazel/output_bases/shared'
+
+    with pytest.raises(RuntimeError):
+        create_bazel_command(_get_args(['--output_base=/tmp/other']))
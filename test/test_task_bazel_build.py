@@ -1,14 +1,27 @@
 # Copyright 2018 Mickael Gaillard
 # Licensed under the Apache License, Version 2.0
 
+import asyncio
+from functools import partial
+import json
+from pathlib import Path
+import sys
 from tempfile import TemporaryDirectory
+from unittest.mock import patch
 
+from colcon_bazel.package_identification.bazel import extract_sources
+from colcon_bazel.task.bazel import build
 from colcon_bazel.task.bazel.build import BazelBuildTask
+from colcon_bazel.task.bazel.workspace import run_bazel_command
 from colcon_core.package_descriptor import PackageDescriptor
 from colcon_core.task import TaskContext
 from colcon_core.verb.build import BuildPackageArguments
 import pytest
 
+from .fake_bazel import create_context
+from .fake_bazel import patch_fake_bazel
+from .fake_bazel import read_log
+
 
 class MockArgs(object):
 
@@ -44,3 +57,205 @@ async def test_task_build():
         ret = await extension.build()
 
         assert ret
+
+
+@pytest.mark.skipif(sys.platform == 'win32',
+                    reason='fake bazel requires a POSIX shell')
+@pytest.mark.asyncio
+async def test_task_build_fake_bazel():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        pkg_path = Path(basepath) / 'src' / 'pkg'
+        pkg_path.mkdir(parents=True)
+        (pkg_path / 'BUILD.bazel').write_text('')
+        log = Path(basepath) / 'bazel.log'
+        context = create_context(basepath, pkg_path)
+
+        extension = BazelBuildTask()
+        extension.set_context(context=context)
+        with patch_fake_bazel(basepath, FAKE_BAZEL_LOG=str(log)):
+            ret = await extension.build()
+
+        assert not ret
+        commands = [call['command'] for call in read_log(log)]
+        # the outputs are queried concurrently with the execution root
+        assert commands[0] == 'build'
+        assert sorted(commands[1:]) == ['cquery', 'info']
+
+        install_base = Path(context.args.install_base)
+        assert (install_base / 'bin' / 'pkg').is_file()
+        assert (install_base / 'lib' / 'libpkg.so').is_file()
+        assert (install_base / 'share' / 'pkg' / 'package.dsv').is_file()
+        # the runfiles are installed next to the executable
+        assert (
+            install_base / 'bin' / 'pkg.runfiles' / '_main' / 'pkg.data'
+        ).read_text() == 'data'
+
+        # failing to install the outputs fails the build
+        extension = BazelBuildTask()
+        extension.set_context(context=context)
+        with patch_fake_bazel(basepath), patch.object(
+            build, 'install_files', side_effect=OSError('read-only')
+        ):
+            assert await extension.build() == 1
+
+
+@pytest.mark.skipif(sys.platform == 'win32',
+                    reason='fake bazel requires a POSIX shell')
+@pytest.mark.asyncio
+async def test_task_build_skip_unchanged():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        pkg_path = Path(basepath) / 'src' / 'pkg'
+        pkg_path.mkdir(parents=True)
+        (pkg_path / 'BUILD.bazel').write_text(
+            'cc_binary(name = "pkg", srcs = glob(["*.cc"]))\n')
+        (pkg_path / 'main.cc').write_text('int main() {}')
+        log = Path(basepath) / 'bazel.log'
+        context = create_context(
+            basepath, pkg_path, bazel_skip_unchanged=True)
+        context.pkg.metadata['get_bazel_sources'] = \
+            partial(extract_sources, pkg_path)
+
+        async def build(dependencies=None):
+            context.dependencies = dependencies or {}
+            extension = BazelBuildTask()
+            extension.set_context(context=context)
+            if log.exists():
+                log.unlink()
+            with patch_fake_bazel(basepath, FAKE_BAZEL_LOG=str(log)):
+                assert not await extension.build()
+            return log.exists()
+
+        assert await build()
+        # nothing changed
+        assert not await build()
+
+        (pkg_path / 'main.cc').write_text('int main() { return 0; }')
+        assert await build()
+        assert not await build()
+
+        # changes of the workspace, e.g. of external dependencies
+        (Path(basepath) / 'src' / 'MODULE.bazel').write_text(
+            'bazel_dep(name = "rules_cc", version = "0.0.9")\n')
+        assert await build()
+        assert not await build()
+        (Path(basepath) / 'src' / 'MODULE.bazel').write_text(
+            'bazel_dep(name = "rules_cc", version = "0.0.10")\n')
+        assert await build()
+        assert not await build()
+
+        # files of other Bazel packages referenced by labels
+        tools = Path(basepath) / 'src' / 'tools'
+        tools.mkdir()
+        (tools / 'gen.cc').write_text('')
+        (pkg_path / 'BUILD.bazel').write_text(
+            'cc_binary(name = "pkg", srcs = ["main.cc", "//tools:gen.cc"])\n')
+        assert await build()
+        assert not await build()
+        (tools / 'gen.cc').write_text('int gen() { return 0; }')
+        assert await build()
+        assert not await build()
+
+        # removed outputs are installed again
+        (Path(context.args.install_base) / 'bin' / 'pkg').unlink()
+        assert await build()
+        assert not await build()
+
+        # changes of dependencies which weren't built by Bazel are unknown
+        hook = Path(basepath, 'install', 'other', 'share', 'other')
+        hook.mkdir(parents=True)
+        (hook / 'package.sh').write_text('')
+        assert await build({'other': basepath + '/install/other'})
+        assert await build({'other': basepath + '/install/other'})
+
+
+@pytest.mark.skipif(sys.platform == 'win32',
+                    reason='fake bazel requires a POSIX shell')
+@pytest.mark.asyncio
+async def test_task_build_group_by_workspace():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        root = Path(basepath).resolve() / 'src' / 'ws'
+        root.mkdir(parents=True)
+        (root / 'WORKSPACE').write_text('')
+        log = Path(basepath) / 'bazel.log'
+        names = ('a', 'b', 'c')
+
+        extensions = []
+        for name in names:
+            (root / name).mkdir()
+            (root / name / 'BUILD.bazel').write_text('')
+            context = create_context(
+                basepath, root / name, bazel_group_by_workspace=True)
+            context.pkg.metadata['bazel_workspace_root'] = root
+            extension = BazelBuildTask()
+            extension.set_context(context=context)
+            extensions.append(extension)
+
+        # submit the commands once all packages are ready
+        ready = []
+        all_ready = asyncio.Event()
+
+        async def run_when_all_ready(*args, **kwargs):
+            ready.append(args[1].name)
+            if len(ready) == len(names):
+                all_ready.set()
+            await all_ready.wait()
+            return await run_bazel_command(*args, **kwargs)
+
+        with patch_fake_bazel(basepath, FAKE_BAZEL_LOG=str(log)), \
+                patch.object(build, 'run_bazel_command', run_when_all_ready):
+            rcs = await asyncio.gather(
+                *(extension.build() for extension in extensions))
+
+        assert rcs == [None, None, None]
+        calls = read_log(log)
+        builds = [call for call in calls if call['command'] == 'build']
+        # the three packages are built by a single invocation from the root
+        assert len(builds) == 1
+        assert builds[0]['cwd'] == str(root)
+        assert sorted(builds[0]['target_patterns']) == [
+            '//a/...', '//b/...', '//c/...']
+        # sharing the output base of the workspace
+        assert len({
+            tuple(call['startup_options']) for call in calls}) == 1
+
+        for name in names:
+            install_base = Path(basepath) / 'install' / name
+            assert (install_base / 'bin' / name).is_file()
+
+
+@pytest.mark.skipif(sys.platform == 'win32',
+                    reason='fake bazel requires a POSIX shell')
+@pytest.mark.asyncio
+async def test_task_build_execution_profile():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        pkg_path = Path(basepath) / 'src' / 'pkg'
+        pkg_path.mkdir(parents=True)
+        (pkg_path / 'BUILD.bazel').write_text('')
+        log = Path(basepath) / 'bazel.log'
+        context = create_context(basepath, pkg_path)
+        context.pkg.metadata['bazel_profile'] = 'auto'
+
+        # the second build doesn't execute any action
+        for actions in ('', '0', '', '', ''):
+            extension = BazelBuildTask()
+            extension.set_context(context=context)
+            with patch_fake_bazel(
+                basepath, FAKE_BAZEL_LOG=str(log),
+                FAKE_BAZEL_ACTIONS_EXECUTED=actions
+            ):
+                assert not await extension.build()
+
+        strategies = [
+            [flag for flag in call['flags']
+             if flag.startswith('--spawn_strategy')]
+            for call in read_log(log) if call['command'] == 'build']
+        assert strategies == [['--spawn_strategy=sandboxed']] * 4 + [
+            ['--spawn_strategy=local']]
+
+        history = json.loads(
+            (Path(basepath) / 'build' / '.bazel' / 'execution_profiles.json')
+            .read_text())
+        assert sorted(history['pkg']['build']['profiles']) == [
+            'local-fast', 'sandboxed']
+        assert len(
+            history['pkg']['build']['profiles']['sandboxed']['samples']) == 3
@@ -0,0 +1,152 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+import asyncio
+from unittest.mock import patch
+
+from colcon_bazel.task.bazel import BazelCommand
+from colcon_bazel.task.bazel import client
+from colcon_bazel.task.bazel.client import BazelClient
+from colcon_bazel.task.bazel.client import get_command_output_base
+from colcon_bazel.task.bazel.client import parse_info
+import pytest
+
+
+INFO = {
+    'execution_root': '/out/execroot/__main__',
+    'output_path': '/out/execroot/__main__/bazel-out',
+    'release': 'release 7.0.0',
+}
+
+
+def test_parse_info():
+    assert parse_info('/out/execroot\n', ['execution_root']) == {
+        'execution_root': '/out/execroot'}
+    assert parse_info(
+        'execution_root: /out/execroot\nrelease: release 7.0.0\n',
+        ['execution_root', 'release']) == {
+            'execution_root': '/out/execroot', 'release': 'release 7.0.0'}
+    with pytest.raises(AssertionError):
+        parse_info('release: release 7.0.0\n', ['execution_root', 'release'])
+
+
+def test_get_command_output_base():
+    command = BazelCommand(
+        'bazel', 'build', startup_options=['--output_base=/out'])
+    assert get_command_output_base(command, '/src') == '/out'
+    assert get_command_output_base(
+        BazelCommand('bazel', 'build'), '/src') == '/src'
+
+
+class FakeCheckOutput:
+
+    def __init__(self, *, fail=False):
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+        self.fail = fail
+
+    async def __call__(self, cmd, **kwargs):
+        self.calls.append(cmd)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(0.01)
+            if self.fail:
+                raise AssertionError('bazel failed')
+            if 'info' in cmd:
+                keys = cmd[cmd.index('info') + 1:]
+                if len(keys) == 1:
+                    return INFO[keys[0]].encode()
+                return ''.join(
+                    '{}: {}\n'.format(key, INFO[key]) for key in keys
+                ).encode()
+            return cmd[-1].encode()
+        finally:
+            self.running -= 1
+
+
+@pytest.mark.asyncio
+async def test_get_info():
+    bazel_client = BazelClient()
+    command = BazelCommand(
+        'bazel', 'build', startup_options=['--output_base=/out'],
+        flags=['--jobs=4'], target_patterns=['//...'])
+    check_output = FakeCheckOutput()
+    with patch.object(client, 'check_output', check_output):
+        info = await bazel_client.get_info(
+            command, ['execution_root', 'output_path'], cwd='/src')
+        assert info == {
+            'execution_root': INFO['execution_root'],
+            'output_path': INFO['output_path']}
+        # the keys are batched into a single call without flags
+        assert check_output.calls == [[
+            'bazel', '--output_base=/out', 'info', 'execution_root',
+            'output_path']]
+
+        # memoized values are reused, only missing keys are requested
+        info = await bazel_client.get_info(
+            command, ['output_path', 'release'], cwd='/src')
+        assert info['release'] == INFO['release']
+        assert check_output.calls[1] == [
+            'bazel', '--output_base=/out', 'info', 'release']
+
+        # concurrent requests of the same key share a single call
+        other = command.replace(startup_options=['--output_base=/other'])
+        results = await asyncio.gather(*[
+            bazel_client.get_info(other, ['release'], cwd='/src')
+            for _ in range(3)])
+        assert all(r == {'release': INFO['release']} for r in results)
+        assert len(check_output.calls) == 3
+
+        # the values depend on the workspace
+        await bazel_client.get_info(command, ['release'], cwd='/other-src')
+        assert len(check_output.calls) == 4
+
+        bazel_client.clear()
+        await bazel_client.get_info(command, ['release'], cwd='/src')
+        assert len(check_output.calls) == 5
+
+
+@pytest.mark.asyncio
+async def test_get_info_failure():
+    bazel_client = BazelClient()
+    command = BazelCommand('bazel', 'build')
+    with patch.object(client, 'check_output', FakeCheckOutput(fail=True)):
+        results = await asyncio.gather(*[
+            bazel_client.get_info(command, ['release'], cwd='/src')
+            for _ in range(2)], return_exceptions=True)
+        assert all(isinstance(r, AssertionError) for r in results)
+
+    # failures aren't memoized
+    with patch.object(client, 'check_output', FakeCheckOutput()):
+        assert await bazel_client.get_info(
+            command, ['release'], cwd='/src') == {'release': INFO['release']}
+
+
+@pytest.mark.asyncio
+async def test_query_concurrency():
+    bazel_client = BazelClient(concurrency=2)
+    check_output = FakeCheckOutput()
+    with patch.object(client, 'check_output', check_output):
+        results = await asyncio.gather(*[
+            bazel_client.query(
+                BazelCommand('bazel', 'query', target_patterns=[str(i)]),
+                cwd='/src')
+            for i in range(6)])
+    assert results == [str(i).encode() for i in range(6)]
+    assert check_output.max_running == 2
+
+    # the calls are only bounded per output base
+    bazel_client = BazelClient()
+    check_output = FakeCheckOutput()
+    with patch.object(client, 'check_output', check_output):
+        await asyncio.gather(*[
+            bazel_client.query(
+                BazelCommand(
+                    'bazel', 'query',
+                    startup_options=['--output_base=/out' + str(i % 3)],
+                    target_patterns=[str(i)]),
+                cwd='/src')
+            for i in range(6)])
+    assert check_output.max_running == 3
@@ -0,0 +1,157 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+import asyncio
+from pathlib import Path
+import sys
+from tempfile import TemporaryDirectory
+
+from colcon_bazel.task.bazel.coverage import add_to_workspace_report
+from colcon_bazel.task.bazel.coverage import BazelCoverageTask
+from colcon_bazel.task.bazel.coverage import merge_lcov_reports
+from colcon_bazel.task.bazel.coverage import WORKSPACE_REPORT_FILENAME
+import pytest
+
+from .fake_bazel import create_context
+from .fake_bazel import patch_fake_bazel
+
+
+def test_merge_lcov_reports():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        basepath = Path(basepath)
+        report_a = basepath / 'a.dat'
+        report_a.write_text(
+            'TN:\n'
+            'SF:src/foo.cc\n'
+            'FN:3,foo\n'
+            'FNDA:1,foo\n'
+            'BRDA:4,0,0,1\n'
+            'BRDA:4,0,1,-\n'
+            'DA:3,1\n'
+            'DA:4,1\n'
+            'DA:5,0\n'
+            'end_of_record\n')
+        report_b = basepath / 'b.dat'
+        report_b.write_text(
+            'SF:src/foo.cc\n'
+            'FN:3,foo\n'
+            'FNDA:2,foo\n'
+            'BRDA:4,0,0,-\n'
+            'BRDA:4,0,1,-\n'
+            'DA:3,2\n'
+            'DA:5,3\n'
+            'end_of_record\n'
+            'SF:src/bar.cc\n'
+            'DA:1,0\n'
+            'end_of_record\n')
+
+        output = basepath / 'merged.info'
+        merge_lcov_reports([report_a, report_b], output)
+        assert output.read_text() == (
+            'SF:src/foo.cc\n'
+            'FN:3,foo\n'
+            'FNDA:3,foo\n'
+            'FNF:1\n'
+            'FNH:1\n'
+            'BRDA:4,0,0,1\n'
+            'BRDA:4,0,1,-\n'
+            'BRF:2\n'
+            'BRH:1\n'
+            'DA:3,3\n'
+            'DA:4,1\n'
+            'DA:5,3\n'
+            'LF:3\n'
+            'LH:3\n'
+            'end_of_record\n'
+            'SF:src/bar.cc\n'
+            'FNF:0\n'
+            'FNH:0\n'
+            'DA:1,0\n'
+            'LF:1\n'
+            'LH:0\n'
+            'end_of_record\n')
+
+        # the output can be one of the inputs
+        merge_lcov_reports([output, report_a], output)
+        assert 'DA:3,4\n' in output.read_text()
+
+
+def test_merge_lcov_reports_lcov2():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        basepath = Path(basepath)
+        report = basepath / 'a.dat'
+        report.write_text(
+            'SF:src/foo.cc\n'
+            'FN:3,9,foo\n'
+            'FN:12,bar<int, int>\n'
+            'FNDA:1,foo\n'
+            'BRDA:4,e0,(a, b),1\n'
+            'BRDA:4,broken\n'
+            'DA:3,1\n'
+            'DA:x,1\n'
+            'FNL:0,3,9\n'
+            'end_of_record\n')
+
+        output = basepath / 'merged.info'
+        merge_lcov_reports([report, report], output)
+        assert output.read_text() == (
+            'SF:src/foo.cc\n'
+            'FN:3,9,foo\n'
+            'FN:12,bar<int, int>\n'
+            'FNDA:2,foo\n'
+            'FNDA:0,bar<int, int>\n'
+            'FNF:2\n'
+            'FNH:1\n'
+            'BRDA:4,e0,(a, b),2\n'
+            'BRF:1\n'
+            'BRH:1\n'
+            'DA:3,2\n'
+            'LF:1\n'
+            'LH:1\n'
+            'end_of_record\n')
+
+
+def test_add_to_workspace_report():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        basepath = Path(basepath)
+        report = basepath / 'pkg.dat'
+        report.write_text('SF:foo.cc\nDA:1,1\nend_of_record\n')
+        workspace_report = basepath / 'build' / 'bazel_coverage.info'
+        workspace_report.parent.mkdir()
+        # left over from a previous invocation
+        workspace_report.write_text('SF:foo.cc\nDA:1,5\nend_of_record\n')
+
+        add_to_workspace_report(report, workspace_report)
+        assert 'DA:1,1\n' in workspace_report.read_text()
+
+        add_to_workspace_report(report, workspace_report)
+        assert 'DA:1,2\n' in workspace_report.read_text()
+
+
+@pytest.mark.skipif(sys.platform == 'win32',
+                    reason='fake bazel requires a POSIX shell')
+@pytest.mark.asyncio
+async def test_task_coverage_shared_output_base():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        extensions = []
+        for name in ('a', 'b'):
+            path = Path(basepath) / 'src' / name
+            path.mkdir(parents=True)
+            (path / 'BUILD.bazel').write_text('')
+            extension = BazelCoverageTask()
+            extension.set_context(context=create_context(
+                basepath, path, verb='test', bazel_task='coverage',
+                bazel_output_base='shared'))
+            extensions.append(extension)
+
+        # the packages share the combined report of the output base
+        with patch_fake_bazel(basepath, FAKE_BAZEL_LATENCY='0.1'):
+            assert not any(await asyncio.gather(
+                *[extension.coverage() for extension in extensions]))
+
+        report = Path(basepath) / 'build' / WORKSPACE_REPORT_FILENAME
+        content = report.read_text()
+        for name in ('a', 'b'):
+            record = content.split('SF:{name}.cc\n'.format_map(locals()))[1]
+            assert record.split('end_of_record')[0] == (
+                'FNF:0\nFNH:0\nDA:1,1\nDA:2,0\nLF:2\nLH:1\n')
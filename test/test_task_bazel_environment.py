@@ -0,0 +1,122 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+from collections import OrderedDict
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from colcon_bazel.task.bazel import environment
+from colcon_bazel.task.bazel.environment import clear_environment_cache
+from colcon_bazel.task.bazel.environment import get_environment
+from colcon_bazel.task.bazel.environment import get_hook_files
+from colcon_bazel.task.bazel.environment import get_minimal_environment
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_get_environment():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        basepath = Path(basepath)
+        prefix = basepath / 'install' / 'dep'
+        (prefix / 'share' / 'dep' / 'hook').mkdir(parents=True)
+        (prefix / 'share' / 'dep' / 'package.sh').write_text('')
+        hook = prefix / 'share' / 'dep' / 'hook' / 'path.dsv'
+        hook.write_text('prepend-non-duplicate;PATH;bin\n')
+        dependencies = OrderedDict([('dep', str(prefix))])
+
+        calls = []
+
+        async def get_command_environment(task_name, build_base, deps):
+            calls.append(task_name)
+            return dict(os.environ, DEP_VAR=str(len(calls)))
+
+        def get_args(name):
+            return SimpleNamespace(
+                build_base=str(basepath / 'build' / name),
+                bazel_minimal_env=False)
+
+        clear_environment_cache()
+        with patch.object(
+            environment, 'get_command_environment', get_command_environment
+        ):
+            # shared between tasks and packages with the same dependencies
+            env = await get_environment('build', get_args('a'), dependencies)
+            assert env['DEP_VAR'] == '1'
+            env = await get_environment('test', get_args('b'), dependencies)
+            assert env['DEP_VAR'] == '1'
+            assert calls == ['build']
+
+            # persisted across invocations
+            clear_environment_cache()
+            env = await get_environment('test', get_args('a'), dependencies)
+            assert env['DEP_VAR'] == '1'
+            assert calls == ['build']
+
+            # invalidated by a reinstalled dependency
+            hook.write_text('prepend-non-duplicate;PATH;sbin\n')
+            env = await get_environment('test', get_args('a'), dependencies)
+            assert env['DEP_VAR'] == '2'
+
+            # invalidated by a different order of the dependencies
+            (basepath / 'install' / 'other').mkdir()
+            dependencies['other'] = str(basepath / 'install' / 'other')
+            dependencies.move_to_end('dep')
+            env = await get_environment('test', get_args('a'), dependencies)
+            assert env['DEP_VAR'] == '3'
+
+            args = get_args('a')
+            args.bazel_minimal_env = True
+            with patch.dict(os.environ, {'UNRELATED': 'value'}):
+                env = await get_environment('test', args, dependencies)
+            assert env['DEP_VAR'] == '4'
+            assert 'UNRELATED' not in env
+
+            # only the changes of the dependencies are persisted
+            with patch.dict(os.environ, {'SECRET_TOKEN': 'secret'}):
+                env = await get_environment(
+                    'test', get_args('a'), dependencies)
+                assert env['DEP_VAR'] == '5'
+                assert env['SECRET_TOKEN'] == 'secret'
+                cache = basepath / 'build' / '.bazel' / 'environment'
+                for path in cache.iterdir():
+                    assert 'secret' not in path.read_text()
+
+                clear_environment_cache()
+                env = await get_environment(
+                    'test', get_args('a'), dependencies)
+                assert env['DEP_VAR'] == '5'
+                assert env['SECRET_TOKEN'] == 'secret'
+        clear_environment_cache()
+
+
+def test_get_hook_files():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        share = Path(basepath) / 'share'
+        (share / 'dep' / 'hook').mkdir(parents=True)
+        (share / 'dep' / 'hook' / 'path.sh').write_text('')
+        (share / 'dep' / 'package.dsv').write_text('')
+        (Path(basepath) / 'local_setup.sh').write_text('')
+        # other installed resources don't affect the environment
+        (share / 'dep' / 'data').mkdir()
+        (share / 'dep' / 'data' / 'model.bin').write_text('')
+        (share / 'dep' / 'cmake').mkdir()
+        (share / 'dep' / 'cmake' / 'depConfig.cmake').write_text('')
+        assert get_hook_files('dep', basepath) == [
+            Path(basepath) / 'local_setup.sh',
+            share / 'colcon-core' / 'packages' / 'dep',
+            share / 'dep' / 'hook' / 'path.sh',
+            share / 'dep' / 'package.dsv',
+            share / 'dep' / 'package.sh']
+
+
+def test_get_minimal_environment():
+    env = {'HOME': '/home', 'NEW': '1', 'CHANGED': 'b', 'SAME': 'c'}
+    with patch.dict(
+        os.environ, {'HOME': '/home', 'CHANGED': 'a', 'SAME': 'c'},
+        clear=True
+    ):
+        assert get_minimal_environment(env) == {
+            'CHANGED': 'b', 'HOME': '/home', 'NEW': '1'}
@@ -0,0 +1,181 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+import json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+
+from colcon_bazel.task.bazel import BazelCommand
+from colcon_bazel.task.bazel.execution_profile import apply_execution_limits
+from colcon_bazel.task.bazel.execution_profile import apply_execution_profile
+from colcon_bazel.task.bazel.execution_profile import get_execution_metrics
+from colcon_bazel.task.bazel.execution_profile import get_profile_name
+from colcon_bazel.task.bazel.execution_profile import ProfileHistory
+from colcon_bazel.task.bazel.execution_profile import record_execution_profile
+from colcon_bazel.task.bazel.execution_profile import select_execution_profile
+from colcon_core.package_descriptor import PackageDescriptor
+
+
+def test_get_profile_name():
+    desc = PackageDescriptor('/pkg')
+    desc.name = 'pkg'
+    args = SimpleNamespace(bazel_profile=None)
+    assert get_profile_name(args, desc) is None
+
+    args.bazel_profile = 'sandboxed'
+    assert get_profile_name(args, desc) == 'sandboxed'
+
+    # the metadata of the package takes precedence
+    desc.metadata['bazel_profile'] = 'local-fast'
+    assert get_profile_name(args, desc) == 'local-fast'
+
+    desc.metadata['bazel_profile'] = 'unknown'
+    assert get_profile_name(args, desc) is None
+
+
+def test_apply_execution_profile():
+    bzl_cmd = BazelCommand('bazel', 'build', flags=['--keep_going'])
+    assert apply_execution_profile(bzl_cmd, None) == (bzl_cmd, None)
+
+    cmd, profile = apply_execution_profile(bzl_cmd, 'local-fast')
+    assert profile == 'local-fast'
+    assert cmd.flags == ('--keep_going', '--spawn_strategy=local')
+
+    # commands which don't execute actions
+    query = bzl_cmd.replace(command='query')
+    assert apply_execution_profile(query, 'local-fast') == (query, None)
+
+    # an explicit strategy of the user
+    for flag in ('--spawn_strategy=remote', '--strategy=CppCompile=local'):
+        cmd = bzl_cmd.with_flags(flag)
+        assert apply_execution_profile(cmd, 'local-fast') == (cmd, None)
+
+
+def test_apply_execution_limits():
+    desc = PackageDescriptor('/pkg')
+    desc.name = 'pkg'
+    args = SimpleNamespace(bazel_jobs=None, bazel_worker_instances=None)
+    bzl_cmd = BazelCommand('bazel', 'build')
+    assert apply_execution_limits(bzl_cmd, args, desc) == bzl_cmd
+
+    args.bazel_jobs = 4
+    args.bazel_worker_instances = 2
+    assert apply_execution_limits(bzl_cmd, args, desc).flags == (
+        '--jobs=4', '--worker_max_instances=2')
+
+    # the metadata of the package takes precedence
+    desc.metadata['bazel_jobs'] = '8'
+    assert apply_execution_limits(bzl_cmd, args, desc).flags == (
+        '--jobs=8', '--worker_max_instances=2')
+
+    # an explicit flag of the user takes precedence over both
+    cmd = bzl_cmd.with_flags('--jobs=1')
+    assert apply_execution_limits(cmd, args, desc).flags == (
+        '--jobs=1', '--worker_max_instances=2')
+
+    desc.metadata['bazel_jobs'] = 'many'
+    assert apply_execution_limits(bzl_cmd, args, desc).flags == (
+        '--worker_max_instances=2', )
+
+    # commands which don't execute actions
+    query = bzl_cmd.replace(command='query')
+    assert apply_execution_limits(query, args, desc) == query
+
+
+def test_profile_history():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        path = Path(basepath) / 'history.json'
+        history = ProfileHistory(path)
+
+        # each profile is tried first
+        selected = []
+        for seconds in (3, 4, 3, 1, 2, 1, 5, 6, 5):
+            profile = history.select('pkg', 'build')
+            selected.append(profile)
+            history.add('pkg', 'build', profile, seconds)
+        assert selected == \
+            ['sandboxed'] * 3 + ['local-fast'] * 3 + \
+            ['persistent-workers'] * 3
+        assert history.select('pkg', 'build') == 'local-fast'
+        # the tasks are tuned independently
+        assert history.select('pkg', 'test') == 'sandboxed'
+
+        # the least recently run profile is sampled again periodically
+        history.add('pkg', 'build', 'local-fast', 1)
+        assert history.select('pkg', 'build') == 'sandboxed'
+        history.add('pkg', 'build', 'sandboxed', 0.5)
+        assert history.select('pkg', 'build') == 'local-fast'
+
+        # a profile getting slower loses
+        for _ in range(10):
+            history.add('pkg', 'build', 'local-fast', 10)
+        assert history.get_samples('pkg', 'build')['local-fast'] == [10] * 5
+        assert history.select('pkg', 'build') == 'sandboxed'
+
+        history.save()
+        assert ProfileHistory(path).packages == history.packages
+
+        # entries of an unknown format are discarded
+        path.write_text('{"pkg": {"build": {"sandboxed": [1, 2]}}}')
+        assert ProfileHistory(path).get_samples('pkg', 'build') == {}
+
+
+def write_build_metrics(path, actions, milliseconds=None):
+    metrics = {'actionSummary': {'actionsExecuted': str(actions)}}
+    if milliseconds is not None:
+        metrics['timingMetrics'] = {
+            'executionPhaseTimeInMs': str(milliseconds)}
+    path.write_text(
+        json.dumps({'id': {'progress': {}}, 'progress': {}}) + '\n' +
+        json.dumps({'id': {'buildMetrics': {}}, 'buildMetrics': metrics}) +
+        '\n')
+
+
+def test_get_execution_metrics():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        path = Path(basepath) / 'events.json'
+        assert get_execution_metrics(path) is None
+
+        path.write_text('not json\n')
+        assert get_execution_metrics(path) is None
+
+        write_build_metrics(path, 12, 3000)
+        assert get_execution_metrics(path) == (12, 3)
+
+        write_build_metrics(path, 0)
+        assert get_execution_metrics(path) == (0, None)
+
+
+def test_select_execution_profile():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        desc = PackageDescriptor(basepath)
+        desc.name = 'pkg'
+        desc.metadata['bazel_profile'] = 'auto'
+        args = SimpleNamespace(build_base=basepath + '/build/pkg')
+        events = Path(basepath) / 'events.json'
+
+        for profile in ('sandboxed', 'local-fast', 'persistent-workers'):
+            # the cold build executes many more actions
+            write_build_metrics(events, 100, 10000)
+            assert select_execution_profile(args, desc, 'build') == profile
+            record_execution_profile(
+                args, desc, 'build', profile, 11, str(events))
+
+            # a no-op build isn't recorded
+            write_build_metrics(events, 0, 0)
+            assert select_execution_profile(args, desc, 'build') == profile
+            record_execution_profile(
+                args, desc, 'build', profile, 1, str(events))
+
+            for _ in range(2):
+                write_build_metrics(
+                    events, 5,
+                    None if profile == 'persistent-workers' else 1000)
+                assert select_execution_profile(
+                    args, desc, 'build') == profile
+                # without the execution time the wall time is used
+                record_execution_profile(
+                    args, desc, 'build', profile, 0.25, str(events))
+        assert select_execution_profile(
+            args, desc, 'build') == 'persistent-workers'
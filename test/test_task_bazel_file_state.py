@@ -0,0 +1,68 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from colcon_bazel.task.bazel import file_state
+from colcon_bazel.task.bazel.file_state import FileStateDatabase
+
+
+def test_get_hash():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        basepath = Path(basepath)
+        source = basepath / 'main.cc'
+        source.write_text('int main() {}')
+        os.utime(str(source), (0, 0))
+        database_path = basepath / 'build' / '.bazel' / 'state.sqlite3'
+
+        with FileStateDatabase(database_path) as database:
+            file_hash = database.get_hash(source)
+            assert file_hash is not None
+            assert database.get_hash(basepath / 'missing') is None
+        assert database_path.is_file()
+
+        # the recorded hash is used as long as mtime and size match
+        with FileStateDatabase(database_path) as database:
+            with patch.object(file_state.hashlib, 'sha256') as sha256:
+                assert database.get_hash(source) == file_hash
+            assert not sha256.called
+
+        source.write_text('int main() { return 1; }')
+        with FileStateDatabase(database_path) as database:
+            assert database.get_hash(source) != file_hash
+
+            # recently modified files are hashed every time
+            with patch.object(
+                file_state.hashlib, 'sha256', wraps=file_state.hashlib.sha256
+            ) as sha256:
+                database.get_hash(source)
+            assert sha256.called
+
+
+def test_fingerprint():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        basepath = Path(basepath)
+        sources = [basepath / 'a.cc', basepath / 'b.cc']
+        for source in sources:
+            source.write_text(source.name)
+
+        with FileStateDatabase(basepath / 'state.sqlite3') as database:
+            fingerprint = database.get_fingerprint(sources)
+            assert fingerprint == database.get_fingerprint(sources[::-1])
+            assert fingerprint != database.get_fingerprint(
+                sources, extra=['bazel build'])
+            assert fingerprint != database.get_fingerprint(sources[:1])
+
+            assert database.get_package_fingerprint('pkg') is None
+            database.set_package_fingerprint('pkg', fingerprint)
+
+        with FileStateDatabase(basepath / 'state.sqlite3') as database:
+            assert database.get_package_fingerprint('pkg') == fingerprint
+            sources[0].write_text('changed')
+            assert database.get_fingerprint(sources) != fingerprint
+
+            database.set_package_fingerprint('pkg', None)
+            assert database.get_package_fingerprint('pkg') is None
@@ -0,0 +1,103 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+import json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from colcon_bazel.task.bazel.flaky import FlakinessHistory
+from colcon_bazel.task.bazel.flaky import get_failed_targets
+from colcon_bazel.task.bazel.flaky import get_flaky_test_attempts_flags
+from colcon_bazel.task.bazel.flaky import get_test_results
+from colcon_bazel.task.bazel.flaky import get_test_results_from_output_path
+from colcon_bazel.task.bazel.flaky import get_test_results_from_xml
+
+
+def test_get_test_results():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        path = Path(basepath) / 'events.json'
+        assert get_test_results(path) == {}
+
+        events = [
+            {'id': {'started': {}}},
+            {'id': {'testResult': {'label': '//a:a', 'attempt': 1}},
+             'testResult': {'status': 'FAILED'}},
+            {'id': {'testResult': {'label': '//a:a', 'attempt': 2}},
+             'testResult': {'status': 'PASSED'}},
+            {'id': {'testResult': {'label': '//b:b'}},
+             'testResult': {'status': 'FAILED'}},
+            {'id': {'testSummary': {'label': '//a:a'}},
+             'testSummary': {'overallStatus': 'FLAKY'}},
+        ]
+        path.write_text(
+            ''.join(json.dumps(event) + '\n' for event in events) +
+            '{"truncated')
+        results = get_test_results(path)
+        assert results == {'//a:a': 'FLAKY', '//b:b': 'FAILED'}
+        assert get_failed_targets(results) == ['//b:b']
+
+
+def test_get_test_results_from_xml():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        testlogs = Path(basepath)
+        for directory, failures in (
+            ('pkg/ok', 0),
+            ('pkg/sharded/shard_1_of_2', 0),
+            ('pkg/sharded/shard_2_of_2', 1),
+        ):
+            (testlogs / directory).mkdir(parents=True)
+            (testlogs / directory / 'test.xml').write_text(
+                '<testsuites><testsuite tests="1" failures="{}"/>'
+                '</testsuites>'.format(failures))
+        (testlogs / 'pkg' / 'broken').mkdir()
+        (testlogs / 'pkg' / 'broken' / 'test.xml').write_text('<')
+
+        results = get_test_results_from_xml(testlogs)
+        assert results == {
+            '//pkg:ok': 'PASSED', '//pkg:sharded': 'FAILED'}
+        assert get_test_results_from_xml(testlogs, since=2 ** 40) == {}
+
+
+def test_get_test_results_from_output_path():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        output_path = Path(basepath)
+        for configuration, failures in (
+            ('k8-fastbuild', 1), ('k8-opt', 0), ('k8-opt-exec', 0),
+        ):
+            directory = output_path / configuration / 'testlogs' / 'pkg'
+            for name in ('both', configuration):
+                (directory / name).mkdir(parents=True)
+                (directory / name / 'test.xml').write_text(
+                    '<testsuites><testsuite tests="1" failures="{}"/>'
+                    '</testsuites>'.format(failures))
+        (output_path / 'k8-opt' / 'bin').mkdir()
+
+        assert get_test_results_from_output_path(output_path) == {
+            '//pkg:both': 'FAILED', '//pkg:k8-fastbuild': 'FAILED',
+            '//pkg:k8-opt': 'PASSED', '//pkg:k8-opt-exec': 'PASSED'}
+
+
+def test_get_flaky_test_attempts_flags():
+    assert get_flaky_test_attempts_flags(['//a:b.c'], 3) == [
+        r'--flaky_test_attempts=^//a:b\.c$@3']
+
+
+def test_flakiness_history():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        path = Path(basepath) / 'history' / 'history.json'
+        history = FlakinessHistory(path)
+        assert history.get_flaky_targets() == []
+
+        history.add_results([
+            {'//:a': 'FAILED', '//:b': 'PASSED', '//:c': 'FAILED',
+             '//:d': 'FLAKY'},
+            {'//:a': 'PASSED', '//:c': 'FAILED'},
+        ])
+        history.save()
+
+        history = FlakinessHistory(path)
+        assert history.get_flaky_targets() == ['//:a', '//:d']
+        assert history.targets['//:a'] == {
+            'runs': 2, 'failures': 1, 'flaky': 1}
+        assert history.targets['//:c'] == {
+            'runs': 2, 'failures': 2, 'flaky': 0}
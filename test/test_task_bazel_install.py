@@ -0,0 +1,204 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from colcon_bazel.task.bazel import BazelCommand
+from colcon_bazel.task.bazel import client
+from colcon_bazel.task.bazel import install
+from colcon_bazel.task.bazel.client import BazelClient
+from colcon_bazel.task.bazel.install import get_install_destination
+from colcon_bazel.task.bazel.install import get_install_query
+from colcon_bazel.task.bazel.install import get_output_files
+from colcon_bazel.task.bazel.install import get_runfiles
+from colcon_bazel.task.bazel.install import install_files
+import pytest
+
+
+def _create_outputs(basepath):
+    outputs = basepath / 'bazel-out' / 'k8-fastbuild' / 'bin'
+    outputs.mkdir(parents=True)
+    (outputs / 'libfoo.so').write_text('library')
+    (outputs / 'foo').write_text('executable')
+    (outputs / 'foo').chmod(0o755)
+    (outputs / 'foo.txt').write_text('data')
+    return outputs
+
+
+def test_get_install_destination():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        outputs = _create_outputs(Path(basepath))
+        assert get_install_destination(outputs / 'libfoo.so', 'pkg') == \
+            Path('lib/libfoo.so')
+        assert get_install_destination(outputs / 'libfoo.so.1', 'pkg') == \
+            Path('lib/libfoo.so.1')
+        assert get_install_destination(outputs / 'foo.jar', 'pkg') == \
+            Path('lib/foo.jar')
+        if os.name != 'nt':
+            assert get_install_destination(outputs / 'foo', 'pkg') == \
+                Path('bin/foo')
+        assert get_install_destination(outputs / 'foo.txt', 'pkg') == \
+            Path('share/pkg/foo.txt')
+
+        # other files keep their path relative to the package
+        assert get_install_destination(
+            outputs / 'a' / 'b' / 'sub' / 'foo.txt', 'pkg',
+            package_path='a/b') == Path('share/pkg/sub/foo.txt')
+        assert get_install_destination(
+            outputs / 'other' / 'foo.txt', 'pkg', package_path='a/b') == \
+            Path('share/pkg/other/foo.txt')
+
+
+def test_get_install_query():
+    assert get_install_query(['//...']) == \
+        'let targets = "//..." in ' \
+        '$targets except kind(".*_test rule", $targets)'
+    assert get_install_query(['//a/...', '//b:c', '-//a/x/...']) == \
+        'let targets = "//a/..." + "//b:c" - "//a/x/..." in ' \
+        '$targets except kind(".*_test rule", $targets)'
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='requires symlink support')
+def test_install_files_runfiles():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        basepath = Path(basepath)
+        outputs = _create_outputs(basepath)
+        runfiles = outputs / 'foo.runfiles' / '_main'
+        runfiles.mkdir(parents=True)
+        (runfiles / 'foo').symlink_to(outputs / 'foo')
+        (runfiles / 'foo.txt').symlink_to(outputs / 'foo.txt')
+        (runfiles / 'dangling').symlink_to(outputs / 'missing')
+
+        assert get_runfiles(outputs / 'libfoo.so') == []
+        assert get_runfiles(outputs / 'foo') == [
+            (runfiles / 'foo', Path('foo.runfiles/_main/foo')),
+            (runfiles / 'foo.txt', Path('foo.runfiles/_main/foo.txt'))]
+
+        install_base = basepath / 'install'
+        manifest = basepath / 'build' / install.MANIFEST_FILENAME
+        installed, _ = install_files(
+            [outputs / 'foo'], str(install_base), 'pkg', manifest)
+        assert installed == 3
+        assert (
+            install_base / 'bin' / 'foo.runfiles' / '_main' / 'foo.txt'
+        ).read_text() == 'data'
+        # the targets of the runfiles symlinks aren't hardlinked
+        assert not os.path.samefile(
+            str(install_base / 'bin' / 'foo.runfiles' / '_main' / 'foo.txt'),
+            str(outputs / 'foo.txt'))
+
+
+@pytest.mark.asyncio
+async def test_get_output_files():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        basepath = Path(basepath)
+        outputs = _create_outputs(basepath)
+
+        async def check_output(cmd, **kwargs):
+            if cmd[1] == 'info':
+                assert cmd == ['bazel', 'info', 'execution_root']
+                return str(basepath).encode() + b'\n'
+            assert cmd[-2:] == [
+                '--',
+                'let targets = "//..." in '
+                '$targets except kind(".*_test rule", $targets)']
+            assert '--output=files' in cmd
+            return (
+                b'bazel-out/k8-fastbuild/bin/libfoo.so\n'
+                b'bazel-out/k8-fastbuild/bin/foo\n'
+                b'bazel-out/k8-fastbuild/bin/missing\n'
+                b'\n'
+                b'src/foo.cc\n')
+
+        with patch.object(client, 'check_output', check_output), \
+                patch.object(client, '_client', BazelClient()):
+            files = await get_output_files(
+                BazelCommand('bazel', 'build', target_patterns=['//...']),
+                cwd=basepath)
+        assert files == [outputs / 'libfoo.so', outputs / 'foo']
+
+
+def test_install_files():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        basepath = Path(basepath)
+        outputs = _create_outputs(basepath)
+        install_base = basepath / 'install'
+        manifest = basepath / 'build' / install.MANIFEST_FILENAME
+        files = [outputs / 'libfoo.so', outputs / 'foo.txt']
+
+        installed, skipped = install_files(
+            files, str(install_base), 'pkg', manifest)
+        assert (installed, skipped) == (2, 0)
+        assert (install_base / 'lib' / 'libfoo.so').read_text() == 'library'
+        assert (install_base / 'share' / 'pkg' / 'foo.txt').read_text() == \
+            'data'
+        assert manifest.is_file()
+
+        # unchanged files are skipped
+        installed, skipped = install_files(
+            files, str(install_base), 'pkg', manifest)
+        assert (installed, skipped) == (0, 2)
+
+        # changed files are installed again, removed files are uninstalled
+        (outputs / 'libfoo.so').unlink()
+        (outputs / 'libfoo.so').write_text('changed library')
+        installed, skipped = install_files(
+            [outputs / 'libfoo.so'], str(install_base), 'pkg', manifest)
+        assert (installed, skipped) == (1, 0)
+        assert (install_base / 'lib' / 'libfoo.so').read_text() == \
+            'changed library'
+        assert not (install_base / 'share' / 'pkg' / 'foo.txt').exists()
+
+        # conflicting destinations are only installed once
+        other = outputs / 'other'
+        other.mkdir()
+        (other / 'libfoo.so').write_text('other library')
+        installed, skipped = install_files(
+            [outputs / 'libfoo.so', other / 'libfoo.so'], str(install_base),
+            'pkg', manifest)
+        assert (installed, skipped) == (0, 1)
+
+        # data files with the same name in different subpackages don't
+        (other / 'foo.txt').write_text('other data')
+        installed, skipped = install_files(
+            [outputs / 'foo.txt', other / 'foo.txt'], str(install_base),
+            'pkg', manifest)
+        assert (installed, skipped) == (2, 0)
+        assert (install_base / 'share' / 'pkg' / 'other' / 'foo.txt'
+                ).read_text() == 'other data'
+
+
+def test_install_files_copy_fallback():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        basepath = Path(basepath)
+        outputs = _create_outputs(basepath)
+        install_base = basepath / 'install'
+        manifest = basepath / 'build' / install.MANIFEST_FILENAME
+
+        with patch('os.link', side_effect=OSError), \
+                patch.object(install, 'fcntl', None):
+            installed, _ = install_files(
+                [outputs / 'foo.txt'], str(install_base), 'pkg', manifest)
+        assert installed == 1
+        dst = install_base / 'share' / 'pkg' / 'foo.txt'
+        assert dst.read_text() == 'data'
+        assert not os.path.samefile(str(dst), str(outputs / 'foo.txt'))
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='requires symlink support')
+def test_install_files_symlink():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        basepath = Path(basepath)
+        outputs = _create_outputs(basepath)
+        install_base = basepath / 'install'
+        manifest = basepath / 'build' / install.MANIFEST_FILENAME
+
+        install_files(
+            [outputs / 'foo.txt'], str(install_base), 'pkg', manifest,
+            symlink=True)
+        dst = install_base / 'share' / 'pkg' / 'foo.txt'
+        assert dst.is_symlink()
+        assert os.readlink(str(dst)) == str(outputs / 'foo.txt')
@@ -0,0 +1,165 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+from argparse import Namespace
+import asyncio
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from colcon_bazel.task.bazel import BazelCommand
+from colcon_bazel.task.bazel import client
+from colcon_bazel.task.bazel import memory
+from colcon_bazel.task.bazel.client import BazelClient
+from colcon_bazel.task.bazel.memory import get_available_memory
+from colcon_bazel.task.bazel.memory import get_memory_per_package
+from colcon_bazel.task.bazel.memory import MemoryGovernor
+import pytest
+
+
+def test_get_memory_per_package():
+    name = memory.BAZEL_MEMORY_PER_PACKAGE_ENVIRONMENT_VARIABLE.name
+    # the governor is opt-in
+    with patch.dict('os.environ', {name: ''}):
+        assert get_memory_per_package() == 0
+    with patch.dict('os.environ', {name: '2048'}):
+        assert get_memory_per_package() == 2048
+    with patch.dict('os.environ', {name: '0'}):
+        assert get_memory_per_package() == 0
+    with patch.dict('os.environ', {name: 'invalid'}):
+        assert get_memory_per_package() == 0
+    with patch.dict('os.environ', {name: ''}):
+        assert not MemoryGovernor().enabled
+
+
+def test_get_available_memory():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        basepath = Path(basepath)
+        meminfo = basepath / 'meminfo'
+        meminfo.write_text(
+            'MemTotal:       32000000 kB\n'
+            'MemAvailable:   16777216 kB\n')
+        self_cgroup = basepath / 'cgroup'
+        self_cgroup.write_text('0::/colcon\n')
+        cgroup = basepath / 'sys'
+        (cgroup / 'colcon').mkdir(parents=True)
+        (cgroup / 'colcon' / 'memory.max').write_text('max\n')
+
+        with patch.object(memory, '_MEMINFO', meminfo), \
+                patch.object(memory, '_SELF_CGROUP', self_cgroup), \
+                patch.object(memory, '_CGROUP_ROOT', cgroup):
+            # no cgroup limit
+            assert get_available_memory() == 16384
+
+            # cgroup v2 limit of the current process
+            (cgroup / 'colcon' / 'memory.max').write_text(
+                str(8 * 1024 ** 3))
+            (cgroup / 'colcon' / 'memory.current').write_text(
+                str(1024 ** 3))
+            assert get_available_memory() == 7168
+
+            # cgroup v1 limit
+            (cgroup / 'colcon' / 'memory.max').unlink()
+            (cgroup / 'memory').mkdir()
+            (cgroup / 'memory' / 'memory.limit_in_bytes').write_text(
+                str(4 * 1024 ** 3))
+            assert get_available_memory() == 4096
+
+        with patch.object(memory, '_MEMINFO', basepath / 'missing'), \
+                patch.object(memory, '_SELF_CGROUP', basepath / 'missing'), \
+                patch.object(memory, '_CGROUP_ROOT', basepath / 'missing'):
+            assert get_available_memory() is None
+
+
+def test_memory_governor_options():
+    governor = MemoryGovernor(available=32768, per_package=4096)
+    assert governor.enabled
+    assert governor.slots == 8
+    assert governor.get_startup_options() == [
+        '--host_jvm_args=-Xmx1024m', '--max_idle_secs=30']
+    assert governor.get_arguments() == ['--local_ram_resources=3072']
+
+    # explicit user options are not overridden
+    assert governor.get_startup_options(
+        ['--host_jvm_args=-Xmx2g', '--max_idle_secs=600']) == []
+    assert governor.get_startup_options(
+        ['--host_jvm_args=-Dfoo=bar', '--max_idle_secs=600']) == [
+        '--host_jvm_args=-Xmx1024m']
+    assert governor.get_arguments(['--local_ram_resources=HOST_RAM*.5']) == []
+
+    command = governor.apply(BazelCommand('bazel', 'build'))
+    assert command.to_list() == [
+        'bazel', '--host_jvm_args=-Xmx1024m', '--max_idle_secs=30', 'build',
+        '--local_ram_resources=3072']
+    # commands which don't execute actions don't accept resource flags
+    command = governor.apply(BazelCommand('bazel', 'query'))
+    assert command.to_list() == [
+        'bazel', '--host_jvm_args=-Xmx1024m', '--max_idle_secs=30', 'query']
+
+    # the budget of a single package is limited to the available memory
+    governor = MemoryGovernor(available=2048, per_package=4096)
+    assert governor.slots == 1
+    assert governor.per_package == 2048
+
+    governor = MemoryGovernor(available=32768, per_package=0)
+    assert not governor.enabled
+    assert governor.get_startup_options() == []
+    assert governor.get_arguments() == []
+
+
+@pytest.mark.asyncio
+async def test_memory_governor_gate():
+    governor = MemoryGovernor(available=8192, per_package=4096)
+    assert governor.slots == 2
+
+    running = []
+    max_running = 0
+
+    async def job():
+        nonlocal max_running
+        async with governor:
+            running.append(None)
+            max_running = max(max_running, len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+
+    await asyncio.gather(*[job() for _ in range(6)])
+    assert max_running == 2
+
+    # without a known amount of memory the packages are not gated
+    governor = MemoryGovernor(available=None, per_package=0)
+    async with governor:
+        pass
+
+
+@pytest.mark.asyncio
+async def test_memory_governor_reserve():
+    governor = MemoryGovernor(available=4096, per_package=4096)
+    assert governor.slots == 1
+    command = BazelCommand(
+        'bazel', 'build', startup_options=['--output_base=/tmp/pkg'],
+        flags=['--jobs=4'], target_patterns=['//...'])
+    events = []
+
+    async def check_output(cmd, **kwargs):
+        events.append(cmd)
+        return b''
+
+    async def package(name, args):
+        async with governor.reserve(args, None, command):
+            events.append(name)
+            await asyncio.sleep(0.01)
+
+    with patch.object(client, 'check_output', check_output), \
+            patch.object(client, '_client', BazelClient()):
+        # the server of a package is shut down before the slot is released
+        args = Namespace(path='/tmp', bazel_output_base='package')
+        await asyncio.gather(package('a', args), package('b', args))
+        shutdown = ['bazel', '--output_base=/tmp/pkg', 'shutdown']
+        assert events == ['a', shutdown, 'b', shutdown]
+
+        # shared servers are kept
+        events.clear()
+        args = Namespace(path='/tmp', bazel_output_base='shared')
+        await asyncio.gather(package('a', args), package('b', args))
+        assert events == ['a', 'b']
@@ -0,0 +1,183 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+import json
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from colcon_bazel.event_handler.metrics import BazelMetricsEventHandler
+from colcon_bazel.task.bazel import metrics
+from colcon_bazel.task.bazel.metrics import format_json_lines
+from colcon_bazel.task.bazel.metrics import format_openmetrics
+from colcon_bazel.task.bazel.metrics import get_metrics_recorder
+from colcon_bazel.task.bazel.metrics import MetricsRecorder
+from colcon_core.event.job import JobEnded
+from colcon_core.event.job import JobStarted
+from colcon_core.event_reactor import EventReactorShutdown
+import pytest
+
+
+def test_recorder_disabled():
+    recorder = MetricsRecorder()
+    assert not recorder.enabled
+    with recorder.measure('pkg', 'build', 'environment') as measurement:
+        measurement.package = 'pkg'
+    assert measurement.seconds >= 0
+    assert recorder.measurements == []
+    recorder.export()
+
+    name = metrics.BAZEL_METRICS_FILE_ENVIRONMENT_VARIABLE.name
+    with patch.object(metrics, '_recorder', None), \
+            patch.dict('os.environ', {name: '/tmp/metrics.prom'}):
+        assert get_metrics_recorder().enabled
+        assert get_metrics_recorder() is get_metrics_recorder()
+
+
+def test_recorder():
+    recorder = MetricsRecorder('metrics.prom')
+    with recorder.measure('pkg', 'build', 'environment') as measurement:
+        pass
+    with recorder.measure(None, 'identify', 'identify'):
+        pass
+    with recorder.measure(None, 'identify', 'identify') as identified:
+        identified.package = 'pkg'
+    assert recorder.measurements == [measurement, identified]
+    assert measurement.seconds >= 0
+    assert measurement.to_dict()['package'] == 'pkg'
+    assert 'cpu_seconds' not in measurement.to_dict()
+
+
+def _measurement(package, phase, seconds, **kwargs):
+    values = {
+        'package': package, 'task': 'build', 'phase': phase, 'start': 1.5,
+        'seconds': seconds, 'cpu_seconds': None, 'max_rss_bytes': None}
+    values.update(kwargs)
+    return SimpleNamespace(to_dict=lambda: values, **values)
+
+
+def test_format_openmetrics():
+    measurements = [
+        _measurement('a', 'bazel', 2.0, cpu_seconds=1.0, max_rss_bytes=10),
+        _measurement('a', 'bazel', 1.0, cpu_seconds=0.5, max_rss_bytes=30),
+        _measurement('b"\\', 'hooks', 0.25),
+    ]
+    assert format_openmetrics(measurements) == (
+        '# TYPE colcon_bazel_phase_seconds gauge\n'
+        '# UNIT colcon_bazel_phase_seconds seconds\n'
+        '# HELP colcon_bazel_phase_seconds '
+        'Duration of a phase of a Bazel task.\n'
+        'colcon_bazel_phase_seconds'
+        '{package="a",task="build",phase="bazel"} 3.0\n'
+        'colcon_bazel_phase_seconds'
+        '{package="b\\"\\\\",task="build",phase="hooks"} 0.25\n'
+        '# TYPE colcon_bazel_server_cpu_seconds gauge\n'
+        '# UNIT colcon_bazel_server_cpu_seconds seconds\n'
+        '# HELP colcon_bazel_server_cpu_seconds '
+        'CPU time of the Bazel server during a phase.\n'
+        'colcon_bazel_server_cpu_seconds'
+        '{package="a",task="build",phase="bazel"} 1.5\n'
+        '# TYPE colcon_bazel_server_max_rss_bytes gauge\n'
+        '# UNIT colcon_bazel_server_max_rss_bytes bytes\n'
+        '# HELP colcon_bazel_server_max_rss_bytes '
+        'Peak resident memory of the Bazel server during a phase.\n'
+        'colcon_bazel_server_max_rss_bytes'
+        '{package="a",task="build",phase="bazel"} 30\n'
+        '# EOF\n')
+    assert format_openmetrics([]) == '# EOF\n'
+
+
+def test_export():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        for filename in ('metrics.jsonl', 'metrics.json', 'metrics.prom'):
+            path = Path(basepath) / 'ci' / filename
+            recorder = MetricsRecorder(str(path))
+            with recorder.measure('pkg', 'build', 'bazel'):
+                pass
+            recorder.export()
+            content = path.read_text()
+            if path.suffix == '.jsonl':
+                assert content == format_json_lines(recorder.measurements)
+                data = json.loads(content)
+                assert data['package'] == 'pkg'
+                assert data['seconds'] >= 0
+            else:
+                assert content.endswith('# EOF\n')
+
+
+class FakeProcess:
+
+    def __init__(self, pid):
+        if pid != os.getpid():
+            raise FakePsutil.Error()
+        self.pid = pid
+        self.cpu = FakePsutil.cpu.pop(0)
+
+    def oneshot(self):
+        return patch.object(self, 'pid', self.pid)
+
+    def cpu_times(self):
+        return SimpleNamespace(user=self.cpu, system=1.0)
+
+    def memory_info(self):
+        return SimpleNamespace(rss=int(self.cpu * 100))
+
+
+class FakePsutil:
+
+    cpu = []
+    Error = type('Error', (Exception, ), {})
+    Process = FakeProcess
+
+
+@pytest.mark.asyncio
+async def test_sample_server():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        output_base = Path(basepath)
+        recorder = MetricsRecorder('metrics.prom')
+
+        # no server running
+        with patch.object(metrics, 'psutil', FakePsutil):
+            async with recorder.measure(
+                'pkg', 'build', 'bazel', output_base=output_base
+            ) as measurement:
+                pass
+        assert measurement.cpu_seconds is None
+        assert measurement.max_rss_bytes is None
+
+        (output_base / 'server').mkdir()
+        (output_base / 'server' / 'server.pid.txt').write_text(
+            str(os.getpid()))
+        FakePsutil.cpu = [1.0, 2.0, 1.5, 4.0]
+        with patch.object(metrics, 'psutil', FakePsutil), \
+                patch.object(metrics, 'SAMPLE_INTERVAL', 0.001):
+            async with recorder.measure(
+                'pkg', 'build', 'bazel', output_base=output_base
+            ) as measurement:
+                while FakePsutil.cpu[1:]:
+                    await metrics.asyncio.sleep(0.001)
+        assert measurement.cpu_seconds == 3.0
+        assert measurement.max_rss_bytes == 400
+
+
+def test_event_handler():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        path = Path(basepath) / 'metrics.jsonl'
+        recorder = MetricsRecorder(str(path))
+        extension = BazelMetricsEventHandler()
+        with patch.object(metrics, '_recorder', recorder):
+            extension((JobStarted('pkg'), None))
+            extension((JobEnded('pkg', 0), None))
+            extension((JobEnded('other', 0), None))
+            assert not path.exists()
+            extension((EventReactorShutdown(), None))
+        data = json.loads(path.read_text())
+        assert (data['package'], data['task'], data['phase']) == (
+            'pkg', 'job', 'total')
+
+        # nothing is recorded unless a file is configured
+        with patch.object(metrics, '_recorder', MetricsRecorder()):
+            extension((JobStarted('pkg'), None))
+            extension((EventReactorShutdown(), None))
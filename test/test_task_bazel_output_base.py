@@ -0,0 +1,153 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+import os
+from pathlib import Path
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+
+from colcon_bazel.task.bazel.output_base import expunge_output_bases
+from colcon_bazel.task.bazel.output_base import find_workspace_root
+from colcon_bazel.task.bazel.output_base import get_output_base
+from colcon_bazel.task.bazel.output_base import get_output_bases
+from colcon_bazel.task.bazel.output_base import get_output_user_root
+from colcon_bazel.task.bazel.output_base import get_size
+from colcon_bazel.task.bazel.output_base import is_output_base_idle
+from colcon_bazel.task.bazel.output_base import shutdown_server
+import pytest
+
+from .fake_bazel import create_executable
+
+
+def test_find_workspace_root():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        basepath = Path(basepath).resolve()
+        pkg = basepath / 'repo' / 'pkg' / 'sub'
+        pkg.mkdir(parents=True)
+        assert find_workspace_root(pkg) is None
+
+        (basepath / 'repo' / 'MODULE.bazel').write_text('')
+        assert find_workspace_root(pkg) == basepath / 'repo'
+
+        (basepath / 'repo' / 'pkg' / 'WORKSPACE').write_text('')
+        assert find_workspace_root(pkg) == basepath / 'repo' / 'pkg'
+
+
+def test_get_output_base():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        basepath = Path(basepath)
+        (basepath / 'src' / 'repo' / 'a').mkdir(parents=True)
+        (basepath / 'src' / 'repo' / 'b').mkdir(parents=True)
+        (basepath / 'src' / 'repo' / 'WORKSPACE').write_text('')
+
+        def get_args(name, strategy=None):
+            return SimpleNamespace(
+                path=str(basepath / 'src' / 'repo' / name),
+                build_base=str(basepath / 'build' / name),
+                bazel_output_base=strategy)
+
+        assert get_output_base(get_args('a')) == \
+            basepath / 'build' / 'a' / 'bazel'
+        assert get_output_base(get_args('a', 'package')) == \
+            basepath / 'build' / 'a' / 'bazel'
+
+        shared = get_output_base(get_args('a', 'shared'))
+        assert shared == get_output_base(get_args('b', 'shared'))
+        assert shared.parent == basepath / 'build' / '.bazel' / 'output_bases'
+
+        workspace = get_output_base(get_args('a', 'workspace'))
+        assert workspace == get_output_base(get_args('b', 'workspace'))
+        assert workspace not in (shared, get_output_base(get_args('a')))
+
+        with pytest.raises(ValueError):
+            get_output_base(get_args('a'), 'unknown')
+
+        assert get_output_user_root(get_args('a')) == \
+            get_output_user_root(get_args('b'))
+        assert get_output_user_root(get_args('a')).parent == \
+            basepath / 'build' / '.bazel'
+
+
+def test_is_output_base_idle():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        output_base = Path(basepath)
+        assert is_output_base_idle(output_base)
+
+        (output_base / 'server').mkdir()
+        pid_file = output_base / 'server' / 'server.pid.txt'
+        pid_file.write_text(str(os.getpid()))
+        assert not is_output_base_idle(output_base)
+
+        pid_file.write_text('invalid')
+        assert is_output_base_idle(output_base)
+
+
+def test_expunge_output_bases():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        build_base = Path(basepath) / 'build'
+        output_bases = [
+            build_base / 'a' / 'bazel',
+            build_base / 'b' / 'bazel',
+            build_base / '.bazel' / 'output_bases' / 'shared',
+        ]
+        for i, output_base in enumerate(output_bases):
+            (output_base / 'execroot').mkdir(parents=True)
+            (output_base / 'execroot' / 'out').write_bytes(b'x' * 1000)
+            # Bazel makes its outputs read-only
+            (output_base / 'execroot').chmod(0o555)
+            (output_base / 'command.log').write_text('')
+            os.utime(str(output_base / 'command.log'), (i, i))
+        # a running server
+        (output_bases[0] / 'server').mkdir()
+        (output_bases[0] / 'server' / 'server.pid.txt').write_text(
+            str(os.getpid()))
+        # not an output base
+        (build_base / 'c').mkdir()
+
+        assert sorted(get_output_bases(build_base)) == sorted(output_bases)
+        size = get_size(output_bases[1])
+        assert size >= 1000
+
+        # everything fits
+        assert expunge_output_bases(build_base, 10 ** 9) == []
+
+        # dry run
+        expunged = expunge_output_bases(build_base, 0, dry_run=True)
+        assert [path for path, _ in expunged] == output_bases[1:]
+        assert all(path.exists() for path in output_bases)
+
+        # the least recently used idle output base is expunged first
+        total = sum(get_size(path) for path in output_bases)
+        expunged = expunge_output_bases(build_base, total - 1)
+        assert expunged == [(output_bases[1], size)]
+        assert not output_bases[1].exists()
+        assert output_bases[0].exists()
+        assert output_bases[2].exists()
+
+
+def test_shutdown_server():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        executable = create_executable(basepath)
+        build_base = Path(basepath) / 'build'
+        output_base = build_base / 'pkg' / 'bazel'
+        (output_base / 'server').mkdir(parents=True)
+        (output_base / 'command.log').write_text('')
+        assert shutdown_server(output_base, executable)
+
+        # an idle server is shut down before expunging the output base
+        server = subprocess.Popen([sys.executable, '-c', 'input()'],
+                                  stdin=subprocess.PIPE)
+        try:
+            (output_base / 'server' / 'server.pid.txt').write_text(
+                str(server.pid))
+            assert not is_output_base_idle(output_base)
+            assert expunge_output_bases(build_base, 0) == []
+            expunged = expunge_output_bases(
+                build_base, 0, executable=executable)
+            assert [path for path, _ in expunged] == [output_base]
+            assert not output_base.exists()
+            server.wait(timeout=10)
+        finally:
+            server.kill()
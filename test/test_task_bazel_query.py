@@ -0,0 +1,26 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+from colcon_bazel.task.bazel import BazelCommand
+from colcon_bazel.task.bazel.query import get_query_command
+from colcon_bazel.task.bazel.query import get_query_filename
+
+
+def test_get_query_command():
+    command = BazelCommand('bazel', 'query', target_patterns=['//...'])
+    assert get_query_command(command).to_list() == [
+        'bazel', 'query', '--output=label_kind', '--', '//...']
+
+    command = BazelCommand(
+        'bazel', 'cquery', flags=['--output=files'],
+        target_patterns=['//foo/...', '//bar:baz', '-//foo:qux'])
+    assert get_query_command(command).to_list() == [
+        'bazel', 'cquery', '--output=files', '--',
+        '//foo/... + //bar:baz - //foo:qux']
+
+    command = BazelCommand('bazel', 'aquery', target_patterns=['//...'])
+    assert '--output=text' in get_query_command(command).flags
+
+
+def test_get_query_filename():
+    assert get_query_filename('cquery') == 'bazel_cquery.txt'
@@ -1,14 +1,22 @@
 # Copyright 2018 Mickael Gaillard
 # Licensed under the Apache License, Version 2.0
 
+import json
+from pathlib import Path
+import sys
 from tempfile import TemporaryDirectory
 
+from colcon_bazel.task.bazel.query import BazelQueryTask
 from colcon_bazel.task.bazel.test import BazelTestTask
 from colcon_core.package_descriptor import PackageDescriptor
 from colcon_core.task import TaskContext
 from colcon_core.verb.test import TestPackageArguments
 import pytest
 
+from .fake_bazel import create_context
+from .fake_bazel import patch_fake_bazel
+from .fake_bazel import read_log
+
 
 class MockArgs(object):
 
@@ -42,3 +50,133 @@ async def test_task_test():
         ret = await extension.test()
 
         assert ret
+
+
+@pytest.mark.skipif(sys.platform == 'win32',
+                    reason='fake bazel requires a POSIX shell')
+@pytest.mark.asyncio
+@pytest.mark.parametrize('failing,bazel_task,expected', [
+    ('', None, 0),
+    ('pkg', None, 3),
+    ('', 'coverage', 0),
+])
+async def test_task_test_fake_bazel(failing, bazel_task, expected):
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        pkg_path = Path(basepath) / 'src' / 'pkg'
+        pkg_path.mkdir(parents=True)
+        (pkg_path / 'BUILD.bazel').write_text('')
+        context = create_context(
+            basepath, pkg_path, verb='test', bazel_task=bazel_task)
+
+        extension = BazelTestTask()
+        extension.set_context(context=context)
+        with patch_fake_bazel(basepath, FAKE_BAZEL_FAILING_TESTS=failing):
+            ret = await extension.test()
+
+        assert (ret or 0) == expected
+        testlogs = Path(context.args.build_base) / 'bazel' / 'execroot' / \
+            '__main__' / 'bazel-out' / 'k8-fastbuild' / 'testlogs'
+        assert (testlogs / 'pkg' / 'test.xml').is_file()
+        if bazel_task == 'coverage':
+            report = Path(basepath) / 'build' / 'bazel_coverage.info'
+            assert 'SF:pkg.cc\n' in report.read_text()
+
+
+@pytest.mark.skipif(sys.platform == 'win32',
+                    reason='fake bazel requires a POSIX shell')
+@pytest.mark.asyncio
+@pytest.mark.parametrize('bazel_task', [None, 'coverage', 'query'])
+async def test_task_test_invalid_arguments(bazel_task):
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        pkg_path = Path(basepath) / 'src' / 'pkg'
+        pkg_path.mkdir(parents=True)
+        (pkg_path / 'BUILD.bazel').write_text('')
+        log = Path(basepath) / 'bazel.log'
+        context = create_context(
+            basepath, pkg_path, verb='test', bazel_task=bazel_task,
+            bazel_args=['--output_base=/tmp/other'])
+
+        if bazel_task == 'query':
+            extension = BazelQueryTask()
+            extension.set_context(context=context)
+            run = extension.query
+        else:
+            extension = BazelTestTask()
+            extension.set_context(context=context)
+            run = extension.test
+        with patch_fake_bazel(basepath, FAKE_BAZEL_LOG=str(log)):
+            assert await run() == 1
+        assert read_log(log) == []
+
+
+@pytest.mark.skipif(sys.platform == 'win32',
+                    reason='fake bazel requires a POSIX shell')
+@pytest.mark.asyncio
+@pytest.mark.parametrize('flaky,failing,attempts,expected', [
+    ('pkg', '', 1, 3),
+    ('pkg', '', 2, 0),
+    ('', 'pkg', 3, 3),
+])
+async def test_task_test_fake_bazel_attempts(
+    flaky, failing, attempts, expected
+):
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        pkg_path = Path(basepath) / 'src' / 'pkg'
+        pkg_path.mkdir(parents=True)
+        (pkg_path / 'BUILD.bazel').write_text('')
+        log = Path(basepath) / 'bazel.log'
+        context = create_context(
+            basepath, pkg_path, verb='test', bazel_test_attempts=attempts)
+
+        extension = BazelTestTask()
+        extension.set_context(context=context)
+        with patch_fake_bazel(
+            basepath, FAKE_BAZEL_FAILING_TESTS=failing,
+            FAKE_BAZEL_FLAKY_TESTS=flaky, FAKE_BAZEL_LOG=str(log)
+        ):
+            ret = await extension.test()
+
+        assert (ret or 0) == expected
+        tests = [call for call in read_log(log) if call['command'] == 'test']
+        assert len(tests) == min(attempts, 2 if flaky else attempts)
+        # only the failed targets are run again
+        for call in tests[1:]:
+            assert call['target_patterns'] == ['//:pkg']
+
+        history = json.loads(
+            (Path(context.args.build_base) / 'bazel_test_history.json')
+            .read_text())
+        assert history['//:pkg']['runs'] == len(tests)
+        assert history['//:pkg']['flaky'] == int(expected == 0)
+
+
+@pytest.mark.skipif(sys.platform == 'win32',
+                    reason='fake bazel requires a POSIX shell')
+@pytest.mark.asyncio
+async def test_task_test_group_by_workspace():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        root = Path(basepath).resolve() / 'src'
+        pkg_path = root / 'pkg'
+        pkg_path.mkdir(parents=True)
+        (pkg_path / 'BUILD.bazel').write_text('')
+        (root / 'MODULE.bazel').write_text('')
+        log = Path(basepath) / 'bazel.log'
+        # the test logs of another configuration than the default one
+        context = create_context(
+            basepath, pkg_path, verb='test', bazel_args=['-c', 'opt'],
+            bazel_test_attempts=2, bazel_group_by_workspace=True)
+
+        extension = BazelTestTask()
+        extension.set_context(context=context)
+        with patch_fake_bazel(
+            basepath, FAKE_BAZEL_FLAKY_TESTS='pkg', FAKE_BAZEL_LOG=str(log)
+        ):
+            ret = await extension.test()
+
+        assert not ret
+        tests = [call for call in read_log(log) if call['command'] == 'test']
+        assert [call['cwd'] for call in tests] == [str(root)] * 2
+        # the failed target is determined from the test.xml files
+        assert all('--compilation_mode=opt' in call['flags'] for call in tests)
+        assert [call['target_patterns'] for call in tests] == [
+            ['//pkg/...'], ['//pkg:pkg']]
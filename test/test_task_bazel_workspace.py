@@ -0,0 +1,108 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+import asyncio
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+
+from colcon_bazel.task.bazel import BazelCommand
+from colcon_bazel.task.bazel.workspace import get_group_root
+from colcon_bazel.task.bazel.workspace import get_package_pattern
+from colcon_bazel.task.bazel.workspace import matches_pattern
+from colcon_bazel.task.bazel.workspace import WorkspaceQueue
+from colcon_core.package_descriptor import PackageDescriptor
+import pytest
+
+
+def test_get_package_pattern():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        root = Path(basepath)
+        (root / 'a' / 'b').mkdir(parents=True)
+        assert get_package_pattern(root, root) == '//...'
+        assert get_package_pattern(root / 'a' / 'b', root) == '//a/b/...'
+
+
+@pytest.mark.parametrize('label,pattern,expected', [
+    ('//a/b:c', '//...', True),
+    ('//a/b:c', '//a/...', True),
+    ('//a:c', '//a/...', True),
+    ('//ab:c', '//a/...', False),
+    ('//a/b:c', '//a/b:all', True),
+    ('//a/b/c:d', '//a/b:*', False),
+    ('//a/b:b', '//a/b', True),
+    ('//a/b:c', '//a/b:c', True),
+    ('//a/b:c', '//a/b:d', False),
+    ('//a:c', '-//a/...', False),
+    ('//a:c', 'relative/...', True),
+])
+def test_matches_pattern(label, pattern, expected):
+    assert matches_pattern(label, pattern) == expected
+
+
+def test_get_group_root():
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        root = Path(basepath).resolve()
+        (root / 'pkg').mkdir()
+        (root / 'MODULE.bazel').write_text('')
+        args = SimpleNamespace(
+            path=str(root / 'pkg'), bazel_group_by_workspace=False)
+        assert get_group_root(args) is None
+
+        args.bazel_group_by_workspace = True
+        assert get_group_root(args) == root
+
+        desc = PackageDescriptor(root / 'pkg')
+        desc.metadata['bazel_workspace_root'] = root / 'other'
+        assert get_group_root(args, desc) == root / 'other'
+
+
+@pytest.mark.asyncio
+async def test_workspace_queue():
+    queue = WorkspaceQueue()
+    bzl_cmd = BazelCommand('bazel', 'build')
+    invocations = []
+    release = asyncio.Event()
+
+    async def invoke(bzl_cmd, cwd):
+        invocations.append((list(bzl_cmd.target_patterns), cwd))
+        await release.wait()
+        return list(bzl_cmd.target_patterns)
+
+    def submit(pattern, env=None):
+        return asyncio.ensure_future(queue.submit(
+            bzl_cmd.replace(target_patterns=[pattern]), invoke, cwd='/ws',
+            env=env))
+
+    # requests arriving at the same time are batched
+    first = [submit('//a/...'), submit('//b/...'), submit('//a/...')]
+    # a different environment requires a separate invocation
+    other = submit('//c/...', env={'VAR': 'value'})
+    await asyncio.sleep(0.01)
+    assert invocations == [
+        (['//a/...', '//b/...'], '/ws'), (['//c/...'], '/ws')]
+
+    # requests arriving while the command runs are batched into the next
+    second = [submit('//d/...'), submit('//e/...')]
+    await asyncio.sleep(0.01)
+    assert len(invocations) == 2
+    release.set()
+    assert await asyncio.gather(*first) == [['//a/...', '//b/...']] * 3
+    assert await other == ['//c/...']
+    assert await asyncio.gather(*second) == [['//d/...', '//e/...']] * 2
+    assert len(invocations) == 3
+
+
+@pytest.mark.asyncio
+async def test_workspace_queue_exception():
+    queue = WorkspaceQueue()
+    bzl_cmd = BazelCommand('bazel', 'build')
+
+    async def invoke(bzl_cmd, cwd):
+        raise RuntimeError('failure')
+
+    results = await asyncio.gather(
+        queue.submit(bzl_cmd, invoke, cwd='/ws'),
+        queue.submit(bzl_cmd, invoke, cwd='/ws'),
+        return_exceptions=True)
+    assert all(isinstance(result, RuntimeError) for result in results)
@@ -0,0 +1,50 @@
+# Copyright 2018 Mickael Gaillard
+# Licensed under the Apache License, Version 2.0
+
+import argparse
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+
+from colcon_bazel.verb.bazel_clean import BazelCleanVerb
+from colcon_bazel.verb.bazel_clean import format_size
+from colcon_bazel.verb.bazel_clean import parse_size
+import pytest
+
+
+def test_parse_size():
+    assert parse_size('0') == 0
+    assert parse_size('512') == 512
+    assert parse_size('2k') == 2048
+    assert parse_size('1.5G') == 1536 * 1024 ** 2
+    assert parse_size('20GiB') == 20 * 1024 ** 3
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_size('many')
+
+
+def test_format_size():
+    assert format_size(12) == '12 B'
+    assert format_size(1536) == '1.5 KiB'
+    assert format_size(3 * 1024 ** 3) == '3.0 GiB'
+
+
+def test_main(capsys):
+    extension = BazelCleanVerb()
+    parser = argparse.ArgumentParser()
+    extension.add_arguments(parser=parser)
+
+    with TemporaryDirectory(prefix='test_colcon_') as basepath:
+        output_base = Path(basepath) / 'pkg' / 'bazel'
+        output_base.mkdir(parents=True)
+        (output_base / 'command.log').write_text('log')
+
+        args = parser.parse_args(
+            ['--build-base', basepath, '--budget', '0', '--dry-run'])
+        assert extension.main(context=SimpleNamespace(args=args)) == 0
+        assert output_base.exists()
+        assert 'Would expunge' in capsys.readouterr().out
+
+        args = parser.parse_args(['--build-base', basepath])
+        assert extension.main(context=SimpleNamespace(args=args)) == 0
+        assert not output_base.exists()
+        assert '1 output bases' in capsys.readouterr().out